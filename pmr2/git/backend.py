@@ -0,0 +1,592 @@
+import json
+import os
+import re
+import tempfile
+import zlib
+from distutils.spawn import find_executable
+from os.path import dirname
+from subprocess import Popen, PIPE
+
+from pygit2 import Repository
+
+from dulwich.object_store import DiskObjectStore
+from dulwich.server import Backend
+from dulwich.repo import Repo
+from dulwich import web
+from dulwich.web import get_text_file
+from dulwich.web import handle_service_request
+from dulwich.web import get_info_packs, get_repo
+from dulwich.web import HTTP_OK, HTTP_FORBIDDEN
+
+from pmr2.git import uploadpack
+from pmr2.git.derived import DerivedData
+from pmr2.git.largefile import OID, LargeFileIndex
+from pmr2.git.largefile import chunks_of, large_file_store
+from pmr2.git.lock import locked_refs, write_lock
+
+HTTP_NOT_MODIFIED = '304 Not Modified'
+HTTP_BAD_REQUEST = '400 Bad Request'
+HTTP_TOO_LARGE = '413 Request Entity Too Large'
+HTTP_UNPROCESSABLE = '422 Unprocessable Entity'
+
+LFS_TYPE = 'application/vnd.git-lfs+json'
+
+# The most bytes of a batch request that are read; git-lfs sends at most
+# a hundred objects per batch, far below this.
+LFS_BATCH_MAX = 1 << 20
+
+# The url of the workspace, for the links given by the Git LFS API; set
+# in the environment by the protocol view and the standalone server.
+URL_KEY = 'pmr2.git.url'
+
+# Whether the request may push to the workspace, as a callable that may
+# also raise for the credentials to be asked for; set in the environment
+# alongside the url, for the uploads of the Git LFS API.
+PUSH_CHECK_KEY = 'pmr2.git.check_push'
+
+# Objects and packs are addressed by their hash, so their content at a
+# given url never changes.
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+push_patt = re.compile('/git-receive-pack$')
+lfs_object_patt = re.compile('/info/lfs/objects/([0-9a-f]{64})$')
+push_warning = """
+Please push a branch named either "master" or "main", otherwise the
+workspace may appear to be missing your files.
+
+To correct, please first checkout your desired branch to push and
+rename it to `main` before pushing it by running:
+
+    git branch -m main
+
+"""
+
+
+def get_info_refs(req, backend, mat):
+    if (uploadpack.protocol_version(req.environ) == 2 and
+            'service=git-upload-pack' in req.environ.get('QUERY_STRING', '')):
+        return uploadpack.get_info_refs(req, backend, mat)
+    return web.get_info_refs(req, backend, mat)
+
+
+def handle_upload_pack(req, backend, mat):
+    if uploadpack.protocol_version(req.environ) == 2:
+        return uploadpack.handle_upload_pack(req, backend, mat)
+    return handle_service_request(req, backend, mat)
+
+
+class ObjectFile(object):
+    """
+    Response body streaming a file from disk in chunks, closing it once
+    done.  The size is available for servers that need the length.
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.size = size
+
+    def __iter__(self):
+        try:
+            while True:
+                data = self.fileobj.read(self.chunk_size)
+                if not data:
+                    break
+                yield data
+        finally:
+            self.close()
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        self.fileobj.close()
+
+
+def _etag_matches(etag, if_none_match):
+    if not if_none_match:
+        return False
+    candidates = [c.strip() for c in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates
+
+
+def send_content_addressed(req, backend, mat, sha, content_type):
+    """
+    Respond with the content addressed file at the matched path, with a
+    strong ETag and headers that mark it as immutable.  Returns an
+    ObjectFile for the body.
+    """
+
+    repo = get_repo(backend, mat)
+    path = os.path.join(repo.controldir(), mat.group().lstrip('/'))
+    try:
+        fileobj = open(path, 'rb')
+    except (IOError, OSError):
+        return [req.not_found('File not found')]
+    return _send_file(req, fileobj, sha, content_type)
+
+
+def _send_file(req, fileobj, sha, content_type):
+    etag = '"%s"' % sha
+    headers = [
+        ('ETag', etag),
+        ('Cache-Control', IMMUTABLE),
+    ]
+    if _etag_matches(etag, req.environ.get('HTTP_IF_NONE_MATCH')):
+        fileobj.close()
+        req.respond(HTTP_NOT_MODIFIED, None, headers)
+        return []
+
+    size = os.fstat(fileobj.fileno()).st_size
+    headers.append(('Content-Length', str(size)))
+    req.respond(HTTP_OK, content_type, headers)
+    return ObjectFile(fileobj, size)
+
+
+def get_loose_object(req, backend, mat):
+    # served as stored, rather than inflated and deflated again.
+    return send_content_addressed(req, backend, mat,
+        mat.group(1) + mat.group(2), 'application/x-git-loose-object')
+
+
+def get_pack_file(req, backend, mat):
+    return send_content_addressed(req, backend, mat,
+        mat.group(1), 'application/x-git-packed-objects')
+
+
+def get_idx_file(req, backend, mat):
+    return send_content_addressed(req, backend, mat,
+        mat.group(1), 'application/x-git-packed-objects-toc')
+
+
+def _lfs_href(req, oid):
+    return '%s/info/lfs/objects/%s' % (req.environ.get(URL_KEY, ''), oid)
+
+
+def _lfs_index(backend, mat):
+    repo = get_repo(backend, mat)
+    return (Repository(repo.controldir()),
+        LargeFileIndex(DerivedData(repo.controldir())))
+
+
+def _may_push(req):
+    check = req.environ.get(PUSH_CHECK_KEY)
+    return check is not None and check()
+
+
+def handle_lfs_batch(req, backend, mat):
+    """
+    The batch API of Git LFS, linking the objects asked for to where
+    they are to be downloaded from (or uploaded to) the large file
+    store, with the basic transfer.
+
+    As the store is shared by all workspaces, only the objects that are
+    referenced by the repository are available for download from it,
+    and uploads require the permission to push.
+    """
+
+    largefiles = large_file_store()
+    if largefiles is None:
+        return [req.not_found('Large files not enabled')]
+    try:
+        batch = json.loads(req.environ['wsgi.input'].read(LFS_BATCH_MAX))
+        operation = batch['operation']
+        objects = list(batch['objects'])
+    except (ValueError, KeyError, TypeError):
+        req.respond(HTTP_BAD_REQUEST, 'text/plain')
+        return ['Invalid batch request']
+    if operation not in ('download', 'upload'):
+        req.respond(HTTP_UNPROCESSABLE, 'text/plain')
+        return ['Unsupported operation']
+    if operation == 'upload' and not _may_push(req):
+        req.respond(HTTP_FORBIDDEN, LFS_TYPE)
+        return [json.dumps({'message': 'Push access required'})]
+
+    repo, index = _lfs_index(backend, mat)
+    result = []
+    for item in objects:
+        if not isinstance(item, dict):
+            continue
+        oid = item.get('oid')
+        size = item.get('size')
+        obj = {'oid': oid, 'size': size}
+        result.append(obj)
+        if (not isinstance(oid, basestring) or not OID.match(oid) or
+                not isinstance(size, (int, long)) or size < 0):
+            obj['error'] = {'code': 422, 'message': 'Invalid object'}
+        elif largefiles.has(oid) and index.referenced(oid, repo):
+            # nothing to upload for objects already available.
+            if operation == 'download':
+                obj['actions'] = {'download': {'href': _lfs_href(req, oid)}}
+        elif operation == 'download':
+            obj['error'] = {'code': 404, 'message': 'Object does not exist'}
+        elif size > largefiles.maximum:
+            obj['error'] = {'code': 422, 'message': 'Object too large'}
+        else:
+            # stored objects are uploaded again all the same, as the
+            # contents must be had to be referenced by this repository.
+            obj['actions'] = {'upload': {'href': _lfs_href(req, oid)}}
+
+    req.respond(HTTP_OK, LFS_TYPE)
+    return [json.dumps({'transfer': 'basic', 'objects': result})]
+
+
+def get_lfs_object(req, backend, mat):
+    largefiles = large_file_store()
+    oid = mat.group(1)
+    if largefiles is None or not largefiles.has(oid):
+        return [req.not_found('Object not found')]
+    repo, index = _lfs_index(backend, mat)
+    fileobj = index.referenced(oid, repo) and largefiles.open(oid)
+    if not fileobj:
+        return [req.not_found('Object not found')]
+    return _send_file(req, fileobj, oid, 'application/octet-stream')
+
+
+def put_lfs_object(req, backend, mat):
+    largefiles = large_file_store()
+    if largefiles is None:
+        return [req.not_found('Large files not enabled')]
+    try:
+        length = int(req.environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length > largefiles.maximum:
+        req.respond(HTTP_TOO_LARGE, 'text/plain')
+        return ['Object too large']
+    oid = mat.group(1)
+    # the contents are checked even if already stored, such that only
+    # the objects that were had can be referenced by the repository.
+    try:
+        largefiles.add(chunks_of(req.environ['wsgi.input']), oid=oid)
+    except ValueError:
+        req.respond(HTTP_UNPROCESSABLE, 'text/plain')
+        return ['Contents do not match the object']
+    repo, index = _lfs_index(backend, mat)
+    index.add(oid)
+    req.respond(HTTP_OK, 'text/plain')
+    return []
+
+
+# The git smart/dumb HTTP services, shared between the Zope based
+# protocol view and the standalone server.
+services = {
+    ('GET', re.compile('/HEAD$')): get_text_file,
+    ('GET', re.compile('/info/refs$')): get_info_refs,
+    ('GET', re.compile('/objects/info/alternates$')): get_text_file,
+    ('GET', re.compile('/objects/info/http-alternates$')): get_text_file,
+    ('GET', re.compile('/objects/info/packs$')): get_info_packs,
+    ('GET', re.compile('/objects/([0-9a-f]{2})/([0-9a-f]{38})$')):
+        get_loose_object,
+    ('GET', re.compile('/objects/pack/pack-([0-9a-f]{40})\\.pack$')):
+        get_pack_file,
+    ('GET', re.compile('/objects/pack/pack-([0-9a-f]{40})\\.idx$')):
+        get_idx_file,
+
+    ('POST', re.compile('/git-upload-pack$')): handle_upload_pack,
+    ('POST', push_patt): handle_service_request,
+
+    ('POST', re.compile('/info/lfs/objects/batch$')): handle_lfs_batch,
+    ('GET', lfs_object_patt): get_lfs_object,
+    ('PUT', lfs_object_patt): put_lfs_object,
+}
+
+
+# The handlers with responses that may be worth compressing.
+compressible_services = set([get_info_refs, handle_upload_pack])
+
+
+def match_service(method, pathinfo, services=services):
+    """
+    Return the (handler, pattern, match) for the service that handles
+    the method and path, or a tuple of None if nothing matches.
+    """
+
+    for smethod, spath in services.iterkeys():
+        if smethod != method:
+            continue
+        match = spath.search(pathinfo)
+        if match:
+            return services[smethod, spath], spath, match
+    return None, None, None
+
+
+def is_push(method, pathinfo, query_string):
+    """
+    Whether the request is part of a push (either the ref advertisement
+    for receive-pack, the receive-pack itself, or the upload of a large
+    file).
+    """
+
+    if method == 'POST' and push_patt.search(pathinfo):
+        return True
+    if method == 'PUT' and lfs_object_patt.search(pathinfo):
+        return True
+    return (pathinfo.endswith('/info/refs') and
+        'service=git-receive-pack' in query_string)
+
+
+def fix_head(path):
+    """
+    Ensure that HEAD of the repository at path resolves after a push by
+    pointing it at `main` if that is available.  Returns False if no
+    usable HEAD could be found, so the caller can warn the client.
+    """
+
+    with write_lock(path):
+        repo = Repository(path)
+        try:
+            repo.revparse_single('HEAD')
+        except KeyError:
+            # attempt to set reference to main instead
+            try:
+                repo.revparse_single('main')
+            except KeyError:
+                return False
+            else:
+                repo.head = 'refs/heads/main'
+    return True
+
+
+def push_warning_pkt(warning=push_warning):
+    """
+    Format the warning as a side-band progress (channel 2) pkt-line.
+    """
+
+    return '%04X\x02%s' % (len(warning) + 5, warning)
+
+
+class GzipInput(object):
+    """
+    Decompress a gzip encoded request body as it is read, rather than
+    requiring the entire (seekable) body to be available up front.
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self._decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = ''
+        self._eof = False
+
+    def _fill(self, size):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            data = self.fileobj.read(self.chunk_size)
+            if not data:
+                self._buffer += self._decomp.flush()
+                self._eof = True
+                break
+            self._buffer += self._decomp.decompress(data)
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            result, self._buffer = self._buffer, ''
+        else:
+            result, self._buffer = self._buffer[:size], self._buffer[size:]
+        return result
+
+
+# Responses that are worth compressing; the others are either pack data
+# (already compressed) or small.
+COMPRESSIBLE_TYPES = set([
+    'application/x-git-upload-pack-advertisement',
+    'application/x-git-receive-pack-advertisement',
+    'application/x-git-upload-pack-result',
+])
+
+# Smaller responses are sent as is.
+COMPRESS_MIN_SIZE = 1024
+# How much of a response is held back to look for the start of a pack
+# before committing to compress it.
+COMPRESS_MAX_BUFFER = 1048576
+
+# The start of a pack, either in the data side-band or directly after
+# the acknowledgement pkt-line.
+PACK_SIGNATURES = ('\x01PACK', '\nPACK')
+
+
+def has_pack(data):
+    return data.startswith('PACK') or any(
+        signature in data for signature in PACK_SIGNATURES)
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Whether the Accept-Encoding header value permits gzip.
+    """
+
+    for item in (accept_encoding or '').split(','):
+        parts = [p.strip() for p in item.split(';')]
+        if parts[0] not in ('gzip', 'x-gzip'):
+            continue
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def should_compress(content_type, data, min_size=COMPRESS_MIN_SIZE):
+    """
+    Whether a response of content_type starting with data should be
+    compressed, which is not the case for small responses or ones that
+    carry a pack.
+    """
+
+    return (content_type in COMPRESSIBLE_TYPES and len(data) >= min_size
+        and not has_pack(data))
+
+
+def gzip_compressor():
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def gzip_body(data):
+    compressor = gzip_compressor()
+    return compressor.compress(data) + compressor.flush()
+
+
+def _header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+class GzipResponse(object):
+    """
+    Stand-in for the start_response of a WSGI request that gzip encodes
+    the body if it turns out to be worth compressing.
+
+    The start of the body (up to max_buffer) is held back along with the
+    headers until that can be decided, so negotiation responses (which
+    come before any pack data) can be compressed while packs are passed
+    through as is.  The body is passed to write, and finish must be
+    called once the response is complete.
+    """
+
+    def __init__(self, start_response, min_size=COMPRESS_MIN_SIZE,
+            max_buffer=COMPRESS_MAX_BUFFER):
+        self._start_response = start_response
+        self.min_size = min_size
+        self.max_buffer = max_buffer
+        self.status = None
+        self.headers = None
+        self.compressor = None
+        self._buffer = []
+        self._buffered = 0
+        self._tail = ''
+        self._write = None
+
+    def __call__(self, status, headers, exc_info=None):
+        self.status = status
+        self.headers = list(headers)
+        return self.write
+
+    def _decide(self):
+        data = ''.join(self._buffer)
+        self._buffer = []
+        content_type = _header(self.headers, 'Content-Type')
+        if content_type in COMPRESSIBLE_TYPES:
+            self.headers.append(('Vary', 'Accept-Encoding'))
+        if should_compress(content_type, data, self.min_size):
+            self.compressor = gzip_compressor()
+            self.headers = [h for h in self.headers
+                if h[0].lower() != 'content-length']
+            self.headers.append(('Content-Encoding', 'gzip'))
+        self._write = self._start_response(self.status, self.headers)
+        self.write(data)
+
+    def write(self, data):
+        if self._write is None:
+            self._buffer.append(data)
+            self._buffered += len(data)
+            # the signature may straddle the writes.
+            tail = self._tail + data
+            self._tail = tail[-4:]
+            if self._buffered >= self.max_buffer or has_pack(tail):
+                self._decide()
+            return
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        if data:
+            self._write(data)
+
+    def finish(self):
+        if self.status is None:
+            return
+        if self._write is None:
+            self._decide()
+        if self.compressor is not None:
+            self._write(self.compressor.flush())
+            self.compressor = None
+
+
+class SpoolingObjectStore(DiskObjectStore):
+    """
+    Object store that spools pushed packs to disk as they are received,
+    and then indexes them with `git index-pack` (which resolves deltas
+    using multiple threads) where git is available, so that neither the
+    size of the push nor the speed of the client dictates the memory or
+    time spent holding on to the indexer.  Falls back to indexing the
+    spooled pack with dulwich.
+    """
+
+    spool_chunk_size = 65536
+    # 0 lets git use one thread per processor.
+    index_pack_threads = 0
+    git_executable = find_executable('git')
+
+    def add_thin_pack(self, read_all, read_some):
+        fd, path = tempfile.mkstemp(dir=self.pack_dir, prefix='tmp_spool_')
+        try:
+            read = read_some or read_all
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    data = read(self.spool_chunk_size)
+                    if not data:
+                        break
+                    f.write(data)
+            if self.git_executable:
+                return self._index_pack(path)
+            with open(path, 'rb') as f:
+                return DiskObjectStore.add_thin_pack(self, f.read, None)
+        finally:
+            os.remove(path)
+
+    def _index_pack(self, path):
+        cmd = [self.git_executable, 'index-pack', '--stdin', '--fix-thin',
+            '--threads=%d' % self.index_pack_threads]
+        env = dict(os.environ)
+        env['GIT_DIR'] = dirname(self.path)
+        with open(path, 'rb') as f:
+            p = Popen(cmd, stdin=f, stdout=PIPE, stderr=PIPE, env=env)
+            out, err = p.communicate()
+        if p.returncode != 0:
+            lines = err.strip().splitlines() or ['unknown error']
+            raise IOError('index-pack failed: %s' % lines[-1])
+        basename = os.path.join(self.pack_dir, 'pack-' + out.split()[-1])
+        for pack in self.packs:
+            if pack._basename == basename:
+                return pack
+
+
+class DulwichBackend(Backend):
+
+    def __init__(self, path):
+        self.repo = Repo(path)
+        self.repo.object_store = SpoolingObjectStore.from_config(
+            self.repo.object_store.path, self.repo.get_config())
+        # pushes update the refs under the write lock.
+        self.repo.refs = locked_refs(self.repo)
+
+    def open_repository(self, path):
+        return self.repo
@@ -0,0 +1,232 @@
+"""
+Changed-path Bloom filters for the history of a path.
+
+The history of a file (or directory) is found by comparing the entry at
+the path in the tree of every commit along the walk to that of its
+parents, which means reading the trees leading to the path for each of
+them.  As git does with its commit-graph, a Bloom filter of the paths
+changed by each commit (against its first parent) is kept, such that
+the commits that definitely did not change the path are skipped without
+reading their trees.  The directories leading to the changed files are
+included, so the history of a directory benefits as well.
+
+The filters are kept among the derived data of the repository in a
+single file, and are built for the commits that are new since the last
+update by the prewarming done after a push or sync.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import threading
+
+from pygit2 import GIT_FILEMODE_TREE
+from pygit2 import GIT_OBJ_COMMIT
+from pygit2 import GIT_SORT_TOPOLOGICAL
+
+KIND = 'bloom'
+
+# As for git: the bits per changed path, the hashes per path and the
+# most changed paths a filter is kept for, as larger ones would be of
+# little use.
+BITS_PER_ENTRY = 10
+NUM_HASHES = 7
+MAX_CHANGED_PATHS = 512
+
+MAGIC = 'PMR2BLM1'
+# the binary id of the commit and the length of its filter.
+RECORD = struct.Struct('<20sI')
+
+# The repositories the filters are kept in memory for.
+MAX_REPOSITORIES = 64
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _hashes(path):
+    h1, h2 = struct.unpack('<II', hashlib.sha1(path).digest()[:8])
+    # the second hash must be odd for the probes to span the filter.
+    return h1, h2 | 1
+
+
+def make_filter(paths):
+    """
+    Return the Bloom filter of the paths, which is empty if there are
+    too many of them to be worth it.
+    """
+
+    if len(paths) > MAX_CHANGED_PATHS:
+        return ''
+    size = max(1, (len(paths) * BITS_PER_ENTRY + 7) // 8)
+    bits = bytearray(size)
+    nbits = size * 8
+    for path in paths:
+        h1, h2 = _hashes(path)
+        for i in xrange(NUM_HASHES):
+            bit = (h1 + i * h2) % nbits
+            bits[bit >> 3] |= 1 << (bit & 7)
+    return str(bits)
+
+
+def maybe_contains(bloom, path, hashes=None):
+    """
+    Whether the path may be in the Bloom filter; always True for an
+    empty filter, for which there were too many paths.  The hashes of
+    the path may be passed in when probing many filters for it.
+    """
+
+    if not bloom:
+        return True
+    nbits = len(bloom) * 8
+    h1, h2 = hashes or _hashes(path)
+    for i in xrange(NUM_HASHES):
+        bit = (h1 + i * h2) % nbits
+        if not ord(bloom[bit >> 3]) & (1 << (bit & 7)):
+            return False
+    return True
+
+
+def _changed(repo, old, new, prefix, result):
+    # the trees are compared by the ids of their entries, so only the
+    # subtrees that differ are read.
+    old = old is not None and dict((e.name, e) for e in old) or {}
+    new = new is not None and dict((e.name, e) for e in new) or {}
+    for name in set(old) | set(new):
+        a = old.get(name)
+        b = new.get(name)
+        if a is not None and b is not None and (
+                a.id == b.id and a.filemode == b.filemode):
+            continue
+        path = prefix + name
+        result.add(path)
+        if len(result) > MAX_CHANGED_PATHS:
+            return
+        subtrees = [e is not None and e.filemode == GIT_FILEMODE_TREE
+            and repo[e.id] or None for e in (a, b)]
+        if subtrees != [None, None]:
+            _changed(repo, subtrees[0], subtrees[1], path + '/', result)
+
+
+def changed_paths(repo, commit):
+    """
+    Return the paths changed by the commit of the pygit2 repository
+    against its first parent, with the directories leading to them.
+    The paths beyond MAX_CHANGED_PATHS are not looked for.
+    """
+
+    parent = commit.parents and commit.parents[0].tree or None
+    result = set()
+    _changed(repo, parent, commit.tree, '', result)
+    return result
+
+
+def _parse(data):
+    filters = {}
+    if not data or not data.startswith(MAGIC):
+        return filters
+    pos = len(MAGIC)
+    while pos + RECORD.size <= len(data):
+        oid, length = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        filters[oid.encode('hex')] = data[pos:pos + length]
+        pos += length
+    return filters
+
+
+class ChangedPathIndex(object):
+    """
+    The changed-path Bloom filters of the commits of the repository
+    with the DerivedData.
+    """
+
+    def __init__(self, derived):
+        self.derived = derived
+        self.filters = self._load()
+
+    def _load(self):
+        path = self.derived._path(KIND, 'filters')
+        try:
+            st = os.stat(path)
+        except OSError:
+            return {}
+        key = (st.st_ino, st.st_size, st.st_mtime)
+        with _cache_lock:
+            cached = _cache.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        filters = _parse(self.derived.get(KIND, 'filters'))
+        with _cache_lock:
+            if path not in _cache and len(_cache) >= MAX_REPOSITORIES:
+                _cache.clear()
+            _cache[path] = (key, filters)
+        return filters
+
+    def maybe_changed(self, sha, path):
+        """
+        Whether the commit with the sha may have changed the path (i.e.
+        True unless its filter says it definitely did not).
+        """
+
+        return self.changed_filter(path)(sha)
+
+    def changed_filter(self, path):
+        """
+        Return maybe_changed for the path, for the commits along a walk.
+        """
+
+        hashes = _hashes(path)
+        filters = self.filters
+
+        def maybe_changed(sha):
+            bloom = filters.get(sha)
+            if bloom is None:
+                return True
+            return maybe_contains(bloom, path, hashes)
+
+        return maybe_changed
+
+    def update(self, repo):
+        """
+        Add the filters of the commits of the pygit2 repository that are
+        reachable from its branches but not yet indexed.  Returns the
+        number of filters added.
+        """
+
+        tips = set()
+        for name in repo.listall_references():
+            if not name.startswith('refs/heads/'):
+                continue
+            target = repo.lookup_reference(name).resolve().target
+            if repo[target].type == GIT_OBJ_COMMIT:
+                tips.add(target.hex)
+        if not tips:
+            return 0
+
+        walker = repo.walk(sorted(tips)[0], GIT_SORT_TOPOLOGICAL)
+        for tip in sorted(tips)[1:]:
+            walker.push(tip)
+        # what was reachable at the last update was indexed then.
+        known = self.derived.get(KIND, 'tips')
+        for tip in known and json.loads(known) or ():
+            if tip in self.filters:
+                walker.hide(tip)
+
+        added = {}
+        for commit in walker:
+            if commit.hex in self.filters or commit.hex in added:
+                continue
+            added[commit.hex] = make_filter(changed_paths(repo, commit))
+
+        if added:
+            self.filters = dict(self.filters)
+            self.filters.update(added)
+            self.derived.put_chunks(KIND, 'filters', self._chunks())
+        self.derived.put(KIND, 'tips', json.dumps(sorted(tips)))
+        return len(added)
+
+    def _chunks(self):
+        yield MAGIC
+        for sha, bloom in self.filters.iteritems():
+            yield RECORD.pack(sha.decode('hex'), len(bloom)) + bloom
@@ -1,21 +1,19 @@
-import gzip
-import re
 from cStringIO import StringIO
 from subprocess import Popen, PIPE
 
 from AccessControl import Unauthorized
 from zExceptions import Forbidden, BadRequest
 from Products.CMFCore.utils import getToolByName
+from Products.Five import BrowserView
 from zope.publisher.interfaces import NotFound
 from plone.protect.interfaces import IDisableCSRFProtection
 from zope.interface import alsoProvides
+from zope.interface import implementer
+from ZPublisher.Iterators import IStreamIterator
 from zope.event import notify
+from zope.security import checkPermission
 
-from dulwich.server import Backend, DEFAULT_HANDLERS
-from dulwich.repo import Repo
-from dulwich.web import get_text_file, get_info_refs, get_loose_object
-from dulwich.web import get_pack_file, get_idx_file, handle_service_request
-from dulwich.web import get_info_packs
+from dulwich.server import DEFAULT_HANDLERS
 from dulwich.web import HTTPGitRequest
 from dulwich.web import HTTP_OK, HTTP_NOT_FOUND, HTTP_FORBIDDEN, HTTP_ERROR
 
@@ -23,19 +21,15 @@ from pmr2.z3cform.page import TraversePage
 from pmr2.app.settings.interfaces import IPMR2GlobalSettings
 from pmr2.app.workspace.event import Push
 
-from pmr2.git.utility import GitStorage
-
-push_patt = re.compile('/git-receive-pack$')
-push_warning = """
-Please push a branch named either "master" or "main", otherwise the
-workspace may appear to be missing your files.
-
-To correct, please first checkout your desired branch to push and
-rename it to `main` before pushing it by running:
-
-    git branch -m main
-
-"""
+from pmr2.git.backend import DulwichBackend
+from pmr2.git.backend import ObjectFile, HTTP_NOT_MODIFIED
+from pmr2.git.backend import GzipInput, COMPRESSIBLE_TYPES
+from pmr2.git.backend import accepts_gzip, should_compress, gzip_body
+from pmr2.git.backend import services, push_patt, push_warning
+from pmr2.git.backend import match_service, fix_head, push_warning_pkt
+from pmr2.git.backend import is_push, URL_KEY, PUSH_CHECK_KEY
+from pmr2.git.server import check_secret, SECRET_HEADER
+from pmr2.git.utility import repository_path
 
 
 class ZopeHTTPGitRequest(HTTPGitRequest):
@@ -60,38 +54,73 @@ class ZopeHTTPGitRequest(HTTPGitRequest):
         return self.out.write
 
 
-class DulwichBackend(Backend):
+@implementer(IStreamIterator)
+class ObjectStreamIterator(object):
+    """
+    Let the publisher stream the object file from disk, rather than
+    reading it into memory.
+    """
+
+    def __init__(self, body):
+        self.body = body
+        self._iter = iter(body)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._iter)
 
-    def __init__(self, path):
-        self.repo = Repo(path)
+    __next__ = next
 
-    def open_repository(self, path):
-        return self.repo
+    def __len__(self):
+        return len(self.body)
+
+
+class GitAuthorize(BrowserView):
+    """
+    Authorization check for the standalone git server, which returns
+    the repository path for the workspace.  The permission check is done
+    by the permission assigned to this view.
+    """
+
+    def __call__(self):
+        if not check_secret(self.request.getHeader(SECRET_HEADER)):
+            # pretend this does not exist for everyone else.
+            raise NotFound(self.context, self.__name__)
+        self.request.response.setHeader('Content-Type', 'text/plain')
+        return repository_path(self.context)
+
+
+class GitAuthorizePush(GitAuthorize):
+    """
+    Authorization check for pushes through the standalone git server,
+    which also fires the Push event for the receive-pack request.
+    """
+
+    def __call__(self):
+        result = super(GitAuthorizePush, self).__call__()
+        pm = getToolByName(self.context, 'portal_membership')
+        if pm.isAnonymousUser():
+            raise Unauthorized()
+        if self.request.get('event') == 'push':
+            # as for the pushes through the protocol view, the handlers
+            # of the event may write.
+            alsoProvides(self.request, IDisableCSRFProtection)
+            notify(Push(self.context))
+        return result
 
 
 class GitProtocol(TraversePage):
 
-    services = {
-        ('GET', re.compile('/HEAD$')): get_text_file,
-        ('GET', re.compile('/info/refs$')): get_info_refs,
-        ('GET', re.compile('/objects/info/alternates$')): get_text_file,
-        ('GET', re.compile('/objects/info/http-alternates$')): get_text_file,
-        ('GET', re.compile('/objects/info/packs$')): get_info_packs,
-        ('GET', re.compile('/objects/([0-9a-f]{2})/([0-9a-f]{38})$')):
-            get_loose_object,
-        ('GET', re.compile('/objects/pack/pack-([0-9a-f]{40})\\.pack$')):
-            get_pack_file,
-        ('GET', re.compile('/objects/pack/pack-([0-9a-f]{40})\\.idx$')):
-            get_idx_file,
-
-        ('POST', re.compile('/git-upload-pack$')): handle_service_request,
-        ('POST', push_patt): handle_service_request,
-    }
+    services = services
 
     def update(self):
 
-        self.storage = GitStorage(self.context)
-        backend = DulwichBackend(self.storage.repo.path)
+        # Only the path is needed for dulwich; the pygit2 repository is
+        # only opened in render for the post-push checks.
+        self.repo_path = repository_path(self.context)
+        backend = DulwichBackend(self.repo_path)
 
         # The name of the view will be captured - combine that with the
         # subpath to get the original path.
@@ -109,33 +138,37 @@ class GitProtocol(TraversePage):
             if pm.isAnonymousUser():
                 raise Unauthorized()
 
+        if (self.request.method == 'PUT' and is_push(self.request.method,
+                self.pathinfo, self.request['QUERY_STRING'])):
+            # the upload of a large file, served by the info view.
+            if not checkPermission('pmr2.app.security.Push', self.context):
+                raise Unauthorized()
+
         self.request.stdin.seek(0)
         if self.request.get('HTTP_CONTENT_ENCODING') == 'gzip':
-            stdin = gzip.GzipFile(filename=None, fileobj=self.request.stdin,
-                mode='r')
+            stdin = GzipInput(self.request.stdin)
         else:
             stdin = self.request.stdin
 
         self.env = {
             #'GIT_HTTP_EXPORT_ALL': '1',
             'REQUEST_METHOD': self.request.method, 
-            #'GIT_PROJECT_ROOT': self.storage.repo.path,
+            #'GIT_PROJECT_ROOT': self.repo_path,
             'PATH_INFO': self.pathinfo,
             'CONTENT_TYPE': self.request['CONTENT_TYPE'],
             'QUERY_STRING': self.request['QUERY_STRING'],
+            'HTTP_GIT_PROTOCOL': self.request.get('HTTP_GIT_PROTOCOL', ''),
+            'HTTP_IF_NONE_MATCH': self.request.get('HTTP_IF_NONE_MATCH', ''),
             'wsgi.input': stdin,
+            URL_KEY: self.context.absolute_url(),
+            PUSH_CHECK_KEY: self._may_push,
         }
 
         req = ZopeHTTPGitRequest(self.env, None, dumb=False,
             handlers=dict(DEFAULT_HANDLERS))
 
-        for smethod, spath in self.services.iterkeys():
-            if smethod != self.request.method:
-                continue
-            match = spath.search(self.pathinfo)
-            if match:
-                handler = self.services[smethod, spath]
-                break
+        handler, spath, match = match_service(
+            self.request.method, self.pathinfo, self.services)
 
         if handler is None:
             raise NotFound(self.context, self.pathinfo)
@@ -150,9 +183,18 @@ class GitProtocol(TraversePage):
         self.handler = handler(req, backend, match)
         self.gitreq = req
 
+    def _may_push(self):
+        pm = getToolByName(self.context, 'portal_membership')
+        if pm.isAnonymousUser():
+            raise Unauthorized()
+        return checkPermission('pmr2.app.security.Push', self.context)
+
     def render(self):
-        # trigger the handler
-        frags = [f for f in self.handler]
+        # trigger the handler, unless it is a file to be streamed.
+        if isinstance(self.handler, ObjectFile):
+            frags = []
+        else:
+            frags = [f for f in self.handler]
 
         # check if error status is set for gitreq obj.
         if self.gitreq.status == HTTP_NOT_FOUND:
@@ -165,24 +207,40 @@ class GitProtocol(TraversePage):
         # acquire the response headers and body from the gitreq obj.
         for header in self.gitreq._headers:
             self.request.response.setHeader(*header)
-        result = self.gitreq.out.getvalue()
-
-        if self.is_push:
-            try:
-                self.storage.repo.revparse_single('HEAD')
-            except KeyError:
-                # attempt to set reference to main instead
-                try:
-                    self.storage.repo.revparse_single('main')
-                except KeyError:
-                    # trigger warning
-                    result = '%04X\x02%s%s' % (
-                        len(push_warning) + 5, push_warning, result)
-                else:
-                    self.storage.repo.head = 'refs/heads/main'
+
+        if self.gitreq.status == HTTP_NOT_MODIFIED:
+            self.request.response.setStatus(304)
+            return ''
+        elif self.gitreq.status not in (None, HTTP_OK):
+            # e.g. the errors of the Git LFS API.
+            self.request.response.setStatus(int(self.gitreq.status[:3]))
+
+        if isinstance(self.handler, ObjectFile):
+            return ObjectStreamIterator(self.handler)
+
+        result = self.gitreq.out.getvalue() + ''.join(frags)
+
+        if self.is_push and not fix_head(self.repo_path):
+            # trigger warning
+            result = push_warning_pkt() + result
+
+        content_type = self.request.response.getHeader('Content-Type')
+        if content_type in COMPRESSIBLE_TYPES:
+            self.request.response.setHeader('Vary', 'Accept-Encoding')
+            if (accepts_gzip(self.request.get('HTTP_ACCEPT_ENCODING')) and
+                    should_compress(content_type, result)):
+                self.request.response.setHeader('Content-Encoding', 'gzip')
+                result = gzip_body(result)
 
         return result
 
     def __call__(self):
         self.update()
         return self.render()
+
+    def PUT(self):
+        """
+        Uploads of large files through the Git LFS API.
+        """
+
+        return self()
@@ -0,0 +1,349 @@
+"""
+Data derived from the contents of workspace repositories.
+
+Rendering the first views of a commit is expensive: the sizes of the
+files of a listing and the content types detected from the file
+contents mean reading every blob, and the archives are built in full.
+These are stored within the repository (in `pmr2-derived`), keyed by
+the objects they were derived from so they never go stale, and are
+prewarmed for the new HEAD of a workspace in a background thread after
+it was pushed to or synced, so the first view after is as fast as the
+ones that follow.
+"""
+
+import errno
+import json
+import logging
+import mimetypes
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from os.path import join
+
+import zope.component
+
+from magic import Magic
+from pygit2 import Blob
+from pygit2 import Repository
+from pygit2 import Tree
+from dulwich.repo import Repo
+
+from pmr2.app.settings.interfaces import IPMR2GlobalSettings
+
+from .bloom import ChangedPathIndex
+from .ext import archive_tgz, archive_zip
+from .largefile import LargeFileIndex, large_file_store, read_pointer
+from .maintenance import MaintenanceQueue
+from .partial import get_promisor
+
+DERIVED_DIR = 'pmr2-derived'
+
+# Seconds a repository must be left alone before it is prewarmed, and
+# the most repositories waiting to be.
+DELAY = 5
+QUEUE_SIZE = 64
+
+# Seconds after which a temporary pack no longer written to is taken to
+# be left over from a failed push.
+STALE_PUSH = 600
+
+# Only this much of a file is read to detect its content type.
+MAGIC_BYTES = 1000
+
+ARCHIVES = (
+    ('zip', archive_zip),
+    ('tgz', archive_tgz),
+)
+
+logger = logging.getLogger('pmr2.git.derived')
+
+
+def archive_key(commit, name, fmt):
+    return '%s-%s.%s' % (commit, name, fmt)
+
+
+def push_in_progress(path, stale=STALE_PUSH):
+    """
+    Return whether the pack of a push is being received into the
+    repository at path, i.e. its HEAD is about to move.  Temporary packs
+    not written to for stale seconds are left over from failed pushes.
+    """
+
+    pack_dir = join(path, 'objects', 'pack')
+    try:
+        names = os.listdir(pack_dir)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    cutoff = time.time() - stale
+    for name in names:
+        if not name.startswith(('tmp_spool_', 'tmp_pack_')):
+            continue
+        try:
+            if os.stat(join(pack_dir, name)).st_mtime > cutoff:
+                return True
+        except OSError:
+            # the push has just finished with it.
+            continue
+    return False
+
+
+class DerivedData(object):
+    """
+    The derived data stored within the repository at path.
+    """
+
+    def __init__(self, path):
+        self.path = join(path, DERIVED_DIR)
+
+    def _path(self, kind, key):
+        return join(self.path, kind, key)
+
+    def get(self, kind, key):
+        try:
+            with open(self._path(kind, key), 'rb') as f:
+                return f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def open(self, kind, key):
+        """
+        Return the entry opened as a file, or None if there is none.
+        """
+
+        path = self._path(kind, key)
+        try:
+            f = open(path, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        # the entries last used are the ones trimmed last.
+        os.utime(path, None)
+        return f
+
+    def put(self, kind, key, data):
+        self.put_chunks(kind, key, [data])
+
+    def put_chunks(self, kind, key, chunks):
+        with self.writing(kind, key) as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+    @contextmanager
+    def writing(self, kind, key):
+        """
+        Yield the file the entry is written to, which is only put in
+        place once complete.
+        """
+
+        target = join(self.path, kind)
+        try:
+            os.makedirs(target)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # readers only ever see complete entries.
+        fd, tmp = tempfile.mkstemp(dir=target, prefix='tmp_')
+        try:
+            with os.fdopen(fd, 'w+b') as f:
+                yield f
+            os.rename(tmp, join(target, key))
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    def trim(self, kind, limit, keep=()):
+        """
+        Remove the least recently used entries of kind until they take
+        up no more than limit bytes, other than the keys to keep.
+        """
+
+        entries = []
+        for key in self.keys(kind):
+            try:
+                st = os.stat(self._path(kind, key))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            entries.append((st.st_mtime, st.st_size, key))
+        total = sum(size for mtime, size, key in entries)
+        for mtime, size, key in sorted(entries):
+            if total <= limit:
+                break
+            if key in keep:
+                continue
+            self.remove(kind, key)
+            total -= size
+
+    def keys(self, kind):
+        try:
+            names = os.listdir(join(self.path, kind))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        return sorted(name for name in names if not name.startswith('tmp_'))
+
+    def remove(self, kind, key):
+        try:
+            os.remove(self._path(kind, key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def tree_sizes(self, repo, tree):
+        """
+        Return the sizes of the blobs of the pygit2 tree as a dict keyed
+        by their names, less the blobs omitted by a partial sync.
+        """
+
+        # the sizes of the pointers are those of the files they point to
+        # in the large file mode.
+        largefiles = large_file_store() is not None
+        kind = largefiles and 'large-sizes' or 'sizes'
+        data = self.get(kind, tree.hex)
+        if data is not None:
+            # the names of the entries are utf-8 encoded str.
+            return dict((name.encode('utf-8'), size)
+                for name, size in json.loads(data).items())
+        sizes = {}
+        complete = True
+        for entry in tree:
+            if entry.type != 'blob':
+                continue
+            node = repo.get(entry.oid)
+            if node is None:
+                complete = False
+                continue
+            pointer = largefiles and read_pointer(node)
+            if pointer:
+                sizes[entry.name] = pointer[1]
+            else:
+                sizes[entry.name] = node.size
+        if complete:
+            try:
+                self.put(kind, tree.hex, json.dumps(sizes))
+            except UnicodeDecodeError:
+                # names that are not utf-8 are left uncached.
+                pass
+        return sizes
+
+    def mimetype(self, blob, magic):
+        """
+        Return the content type of the pygit2 blob as detected by the
+        magic instance from its contents.
+        """
+
+        data = self.get('mimetype', blob.hex)
+        if data is not None:
+            return data
+        result = magic.from_buffer(blob.read_raw()[:MAGIC_BYTES])
+        self.put('mimetype', blob.hex, result)
+        return result
+
+
+def _blobs(repo, tree, current_path=None):
+    for entry in tree:
+        if current_path:
+            name = '/'.join([current_path, entry.name])
+        else:
+            name = entry.name
+        if entry.type not in ('blob', 'tree'):
+            # submodules have no objects here.
+            continue
+        node = repo.get(entry.oid)
+        if isinstance(node, Tree):
+            for item in _blobs(repo, node, name):
+                yield item
+        elif isinstance(node, Blob):
+            yield name, node
+
+
+def prewarm(path, name):
+    """
+    Compute the derived data for the HEAD of the repository at path of
+    the workspace with name: the sizes of the root listing, the content
+    types of the files, the default archives, which replace the archives
+    of the earlier HEADs, the changed-path filters of the new commits and
+    (in the large file mode) the large files they reference.  Returns the
+    commit prewarmed for.
+    """
+
+    repo = Repository(path)
+    try:
+        commit = repo.revparse_single('HEAD')
+    except KeyError:
+        # an empty repository.
+        return None
+    derived = DerivedData(path)
+
+    derived.tree_sizes(repo, commit.tree)
+    ChangedPathIndex(derived).update(repo)
+
+    # libmagic must not be shared with the threads serving the views.
+    magic = Magic(mime=True)
+    largefiles = large_file_store()
+    if largefiles is not None:
+        LargeFileIndex(derived).update(repo)
+    for filename, blob in _blobs(repo, commit.tree):
+        if mimetypes.guess_type(filename)[0] is not None:
+            continue
+        if largefiles is not None and read_pointer(blob) is not None:
+            # not the contents the type is asked for.
+            continue
+        derived.mimetype(blob, magic)
+
+    # the archives of a partial sync would lack the omitted blobs.
+    if get_promisor(Repo(path)) is None:
+        existing = derived.keys('archive')
+        keep = set()
+        for fmt, build in ARCHIVES:
+            key = archive_key(commit.hex, name, fmt)
+            keep.add(key)
+            if key not in existing:
+                # written out as built, rather than held in memory.
+                with derived.writing('archive', key) as f:
+                    build(repo, commit, name, largefiles=largefiles,
+                        fileobj=f)
+        for key in existing:
+            if key not in keep:
+                derived.remove('archive', key)
+
+    logger.debug('prewarmed %s for %s', path, commit.hex)
+    return commit.hex
+
+
+def _prewarm(item):
+    path, name = item
+    if push_in_progress(path):
+        # the HEAD is yet to move, try again after the push.
+        queue.schedule(item)
+        return
+    prewarm(path, name)
+
+
+queue = MaintenanceQueue(delay=DELAY, maintain=_prewarm, maxsize=QUEUE_SIZE)
+
+
+def schedule(path, name):
+    """
+    Schedule the prewarming of the repository at path, of the workspace
+    with name.
+    """
+
+    return queue.schedule((path, name))
+
+
+def workspace_pushed(event):
+    """
+    Schedule the prewarming of the repository of the pushed workspace.
+    """
+
+    settings = zope.component.getUtility(IPMR2GlobalSettings)
+    schedule(join(settings.dirOf(event.object), '.git'), event.object.id)
@@ -0,0 +1,77 @@
+"""
+Changes between the trees of two revisions.
+
+The trees are compared by libgit2 through the oids of their entries, so
+the subtrees common to both revisions are skipped without being read.
+Blobs are only read for the detection of renames (if asked for), and
+for the line counts of a change, which are only computed on demand.
+"""
+
+from pygit2 import Patch
+from pygit2 import GIT_DELTA_ADDED
+from pygit2 import GIT_DELTA_DELETED
+from pygit2 import GIT_DELTA_MODIFIED
+from pygit2 import GIT_DELTA_RENAMED
+from pygit2 import GIT_DELTA_TYPECHANGE
+from pygit2 import GIT_DIFF_FIND_RENAMES
+from pygit2 import GIT_FILEMODE_COMMIT
+
+STATUSES = {
+    GIT_DELTA_ADDED: 'added',
+    GIT_DELTA_DELETED: 'removed',
+    GIT_DELTA_MODIFIED: 'modified',
+    GIT_DELTA_RENAMED: 'renamed',
+    # e.g. a file replaced by a symlink.
+    GIT_DELTA_TYPECHANGE: 'modified',
+}
+
+ZERO_OID = '0' * 40
+
+# The similarity (in percent) for a removed and an added file to be
+# taken as a rename, as for git.
+RENAME_THRESHOLD = 50
+
+
+def tree_diff(old, new):
+    """
+    Return the pygit2 Diff from the old tree to the new tree, either of
+    which may be None for the empty tree.
+    """
+
+    if old is None:
+        if new is None:
+            return None
+        return new.diff_to_tree(swap=True)
+    if new is None:
+        # to the empty tree, with the sides as they are.
+        return old.diff_to_tree()
+    return old.diff_to_tree(new)
+
+
+def find_renames(diff, threshold=RENAME_THRESHOLD):
+    """
+    Pair the removed and added files of the diff that are renames.
+    """
+
+    diff.find_similar(flags=GIT_DIFF_FIND_RENAMES,
+        rename_threshold=threshold)
+
+
+def blob_id(diff_file):
+    # the id of the blob on either side of a change, if there is one.
+    sha = diff_file.id.hex
+    if sha == ZERO_OID or diff_file.mode == GIT_FILEMODE_COMMIT:
+        return None
+    return sha
+
+
+def line_stats(repo, old, new):
+    """
+    Return the (additions, deletions) in lines between the blobs of the
+    pygit2 repository with the ids old and new, either of which may be
+    None for no blob.  Binary files have no lines.
+    """
+
+    patch = Patch.create_from(old and repo[old], new and repo[new])
+    context, additions, deletions = patch.line_stats
+    return additions, deletions
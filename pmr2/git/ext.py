@@ -49,9 +49,21 @@ def parse_gitmodules(raw):
 
     return result
 
-def archive_tgz(repo, commit, rootname='git'):
+def _large_file(largefiles, obj):
+    # the contents of a Git LFS pointer, if they are in the store.
+    if largefiles is None:
+        return None
+    result = largefiles.resolve(obj)
+    if result is None or not largefiles.has(result.sha):
+        return None
+    return result
+
+def archive_tgz(repo, commit, rootname='git', largefiles=None,
+        fileobj=None):
     """
-    Return an archive from a commit.
+    Return an archive from a commit, with the pointers to the files in
+    the LargeFileStore largefiles (if any) replaced by their contents.
+    The archive is written to fileobj instead, if given.
     """
 
     prefix = '%s-%s' % (rootname, commit.oid.hex[:12])
@@ -80,20 +92,31 @@ def archive_tgz(repo, commit, rootname='git'):
             # XXX todo: support symlinks.
             if isinstance(obj, Blob):
                 tnfo = make_tar_info(obj, name)
+                large = _large_file(largefiles, obj)
+                if large is not None:
+                    tnfo.size = large.size
+                    with largefiles.open(large.sha) as f:
+                        tf.addfile(tnfo, f)
+                    continue
                 tf.addfile(tnfo, StringIO(obj.data))
             if isinstance(obj, Tree):
                 _files(tf, obj, name)
 
-    stream = StringIO()
+    stream = fileobj or StringIO()
     tf = tarfile.TarFile.open(fileobj=stream, mode='w|gz')
     _files(tf, commit.tree)
     tf.close()
 
-    return stream.getvalue()
+    if fileobj is None:
+        return stream.getvalue()
 
-def archive_zip(repo, commit, rootname='git'):
+def archive_zip(repo, commit, rootname='git', largefiles=None,
+        fileobj=None):
     """
-    Return an archive from a commit.
+    Return an archive from a commit, with the pointers to the files in
+    the LargeFileStore largefiles (if any) replaced by their contents.
+    The archive is written to fileobj (which must be seekable) instead,
+    if given.
     """
 
     prefix = '%s-%s' % (rootname, commit.oid.hex[:12])
@@ -121,13 +144,22 @@ def archive_zip(repo, commit, rootname='git'):
             # Not sure if zip file provide symlinks?
             if isinstance(obj, Blob):
                 znfo = make_zip_info(obj, name)
+                large = _large_file(largefiles, obj)
+                if large is not None:
+                    # read from the store in chunks by zipfile, dated as
+                    # the file in the store is.
+                    zf.write(largefiles.path(large.sha), znfo.filename,
+                        znfo.compress_type)
+                    continue
                 zf.writestr(znfo, obj.data)
             if isinstance(obj, Tree):
                 _files(zf, obj, name)
 
-    stream = StringIO()
-    tf = zipfile.ZipFile(stream, mode='w')
+    stream = fileobj or StringIO()
+    # large files may be beyond the limits of the original format.
+    tf = zipfile.ZipFile(stream, mode='w', allowZip64=True)
     _files(tf, commit.tree)
     tf.close()
 
-    return stream.getvalue()
+    if fileobj is None:
+        return stream.getvalue()
@@ -0,0 +1,333 @@
+"""
+Large files kept out of the repositories of workspaces.
+
+Workspaces that commit large (e.g. numerical) outputs may store them as
+Git LFS pointer files, with their contents kept in a content addressed
+store on the local filesystem, shared by all workspaces, such that the
+packs (and so every clone, listing and archive) no longer carry them.
+The contents are uploaded to (and downloaded from) the store through
+the Git LFS API served alongside the git protocol.
+
+The large file mode is optional and is enabled by pointing the
+`PMR2_GIT_LARGE_FILE_ROOT` environment variable at the directory of the
+store, with `PMR2_GIT_LARGE_FILE_MAX` (in bytes) being the largest file
+that may be uploaded.  With it enabled, the pointers are read as the
+contents they point to by the storage, its archives and the Git LFS
+API.  As the store is shared, the API only serves a workspace the files
+its repository has pointers to (or that were uploaded to it), as kept
+by its `LargeFileIndex`.  As git clients look for the API at
+`<url>.git/info/lfs`, the workspaces should commit a `.lfsconfig` with
+the `lfs.url` set to the url of the workspace followed by `/info/lfs`.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import re
+import tempfile
+from os.path import join
+
+from dulwich.object_store import DiskObjectStore
+from pygit2 import Commit
+from pygit2 import GIT_FILEMODE_BLOB
+from pygit2 import GIT_FILEMODE_BLOB_EXECUTABLE
+from pygit2 import GIT_FILEMODE_TREE
+from pygit2 import GIT_SORT_NONE
+
+from .stream import CHUNK_SIZE, _file_chunks, object_size
+
+ROOT_ENV = 'PMR2_GIT_LARGE_FILE_ROOT'
+MAX_ENV = 'PMR2_GIT_LARGE_FILE_MAX'
+
+LARGE_FILE_MAX = 1 << 32
+
+INDEX_KIND = 'largefiles'
+
+# Pointers are small by definition, so larger blobs are never read.
+POINTER_MAX = 1024
+
+VERSION = 'https://git-lfs.github.com/spec/v1'
+
+OID = re.compile('^[0-9a-f]{64}$')
+
+
+def parse_pointer(data):
+    """
+    Return the (oid, size) of the Git LFS pointer, or None if the data
+    is not one.
+    """
+
+    if len(data) > POINTER_MAX or not data.startswith('version '):
+        return None
+    values = {}
+    for line in data.splitlines():
+        key, _, value = line.partition(' ')
+        values[key] = value
+    if values.get('version') != VERSION:
+        return None
+    oid = values.get('oid', '')
+    size = values.get('size', '')
+    if not oid.startswith('sha256:') or not size.isdigit():
+        return None
+    oid = oid[len('sha256:'):]
+    if not OID.match(oid):
+        return None
+    return oid, int(size)
+
+
+def make_pointer(oid, size):
+    return 'version %s\noid sha256:%s\nsize %d\n' % (VERSION, oid, size)
+
+
+def read_pointer(blob):
+    """
+    Return the (oid, size) of the pygit2 blob if it is a pointer.
+    """
+
+    if blob.size > POINTER_MAX:
+        return None
+    return parse_pointer(blob.read_raw())
+
+
+def large_file_store():
+    """
+    Return the LargeFileStore, or None if the large file mode is not
+    enabled.
+    """
+
+    root = os.environ.get(ROOT_ENV)
+    if not root:
+        return None
+    try:
+        maximum = int(os.environ.get(MAX_ENV) or LARGE_FILE_MAX)
+    except ValueError:
+        maximum = LARGE_FILE_MAX
+    return LargeFileStore(root, maximum)
+
+
+class LargeFile(object):
+    """
+    The contents of a file in the store, read like a BlobStream.  Raises
+    KeyError on reads if the contents are not in the store.
+    """
+
+    deltified = False
+
+    def __init__(self, store, oid, size):
+        self.store = store
+        self.sha = oid
+        self.size = size
+
+    def read_range(self, start=0, end=None):
+        if end is None or end > self.size:
+            end = self.size
+        f = self.store.open(self.sha)
+        if f is None:
+            raise KeyError(self.sha)
+        if start >= end:
+            f.close()
+            return iter([])
+        return _file_chunks(f, start, end)
+
+    # seeking is what the store does anyway.
+    read_at = read_range
+
+    def __iter__(self):
+        return self.read_range()
+
+    def read(self, start=0, end=None):
+        return ''.join(self.read_range(start, end))
+
+
+class LargeFileStore(object):
+    """
+    The content addressed store at root, keeping the files by the
+    sha256 of their contents as Git LFS does.
+    """
+
+    def __init__(self, root, maximum=LARGE_FILE_MAX):
+        self.root = root
+        self.maximum = maximum
+
+    def path(self, oid):
+        return join(self.root, oid[:2], oid[2:4], oid)
+
+    def has(self, oid):
+        return os.path.isfile(self.path(oid))
+
+    def open(self, oid):
+        """
+        Return the file of the contents, or None if not in the store.
+        """
+
+        try:
+            return open(self.path(oid), 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def _spool(self, chunks, maximum=None):
+        # the contents are hashed as they are written out, up to the
+        # maximum size if given.
+        target = join(self.root, 'tmp')
+        try:
+            os.makedirs(target)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp = tempfile.mkstemp(dir=target)
+        h = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    h.update(chunk)
+                    size += len(chunk)
+                    if maximum is not None and size > maximum:
+                        raise ValueError('contents larger than %d' % maximum)
+                    f.write(chunk)
+        except Exception:
+            os.remove(tmp)
+            raise
+        return tmp, h.hexdigest(), size
+
+    def _keep(self, tmp, oid):
+        path = self.path(oid)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # readers only ever see complete files.
+        os.rename(tmp, path)
+
+    def add(self, chunks, oid=None, size=None):
+        """
+        Add the contents read from the chunks to the store, returning
+        their (oid, size).  Raises ValueError if the contents do not
+        match the oid or size expected, or are larger than the maximum.
+        """
+
+        tmp, result, length = self._spool(chunks, self.maximum)
+        if oid not in (None, result) or size not in (None, length):
+            os.remove(tmp)
+            raise ValueError('contents do not match %s' % oid)
+        self._keep(tmp, result)
+        return result, length
+
+    def resolve(self, blob):
+        """
+        Return the LargeFile the pygit2 blob points to, or None if the
+        blob is not a pointer.
+        """
+
+        pointer = read_pointer(blob)
+        if pointer is None:
+            return None
+        return LargeFile(self, *pointer)
+
+
+def _new_blobs(repo, old, new, found):
+    # the blobs of the new tree that are not at their path in the old
+    # tree, with the subtrees that did not change skipped.
+    old = old is not None and dict((e.name, e) for e in old) or {}
+    for entry in new:
+        prev = old.get(entry.name)
+        if prev is not None and prev.id == entry.id:
+            continue
+        if entry.filemode == GIT_FILEMODE_TREE:
+            if prev is None or prev.filemode != GIT_FILEMODE_TREE:
+                prev = None
+            _new_blobs(repo, prev is not None and repo[prev.id] or None,
+                repo[entry.id], found)
+        elif entry.filemode in (GIT_FILEMODE_BLOB,
+                GIT_FILEMODE_BLOB_EXECUTABLE):
+            found.add(entry.hex)
+
+
+class LargeFileIndex(object):
+    """
+    The large files referenced by a repository, kept with its
+    DerivedData: the oids of the pointers in its commits, and of the
+    files uploaded to it.  The pointers are looked for in the commits
+    that are new since the last update.
+    """
+
+    def __init__(self, derived):
+        self.derived = derived
+        self._updated = False
+
+    def __contains__(self, oid):
+        return self.derived.get(INDEX_KIND, oid) is not None
+
+    def add(self, oid):
+        self.derived.put(INDEX_KIND, oid, '')
+
+    def referenced(self, oid, repo):
+        """
+        Whether the oid is referenced by the pygit2 repository, which is
+        looked through for new pointers (once) if it is not known to be.
+        """
+
+        if oid in self:
+            return True
+        if not self._updated:
+            self.update(repo)
+        return oid in self
+
+    def update(self, repo):
+        """
+        Add the oids of the pointers in the commits of the pygit2
+        repository that are new since the last update.  Returns the
+        number of oids added.
+        """
+
+        self._updated = True
+        tips = set()
+        for name in repo.listall_references():
+            try:
+                commit = repo[repo.lookup_reference(name).resolve().target]
+                tips.add(commit.peel(Commit).hex)
+            except (KeyError, ValueError):
+                continue
+        if not tips:
+            return 0
+
+        walker = repo.walk(sorted(tips)[0], GIT_SORT_NONE)
+        for tip in sorted(tips)[1:]:
+            walker.push(tip)
+        known = self.derived.get(INDEX_KIND, 'tips')
+        for tip in known and json.loads(known) or ():
+            try:
+                walker.hide(tip)
+            except KeyError:
+                # gone since.
+                continue
+
+        blobs = set()
+        for commit in walker:
+            # what a merge brings in is new to the other parents.
+            parent = commit.parents and commit.parents[0].tree or None
+            _new_blobs(repo, parent, commit.tree, blobs)
+
+        store = DiskObjectStore(join(repo.path, 'objects'))
+        added = 0
+        for sha in blobs:
+            try:
+                if object_size(store, sha) > POINTER_MAX:
+                    continue
+            except KeyError:
+                # e.g. omitted by a partial sync.
+                continue
+            pointer = parse_pointer(repo[sha].read_raw())
+            if pointer is not None and pointer[0] not in self:
+                self.add(pointer[0])
+                added += 1
+        self.derived.put(INDEX_KIND, 'tips', json.dumps(sorted(tips)))
+        return added
+
+
+def chunks_of(fileobj, chunk_size=CHUNK_SIZE):
+    return iter(lambda: fileobj.read(chunk_size), '')
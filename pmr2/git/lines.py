@@ -0,0 +1,140 @@
+"""
+Reading lines from large text files.
+
+Paging through a large text file (e.g. a CSV data file or CellML model)
+by lines would mean reading it up to the page asked for.  The offsets
+of every LINE_STRIDE-th line of a large blob are instead recorded in a
+line index among the derived data of the repository, built in a single
+streaming pass over the blob, so the lines asked for are read starting
+from at most LINE_STRIDE lines before them.
+"""
+
+import struct
+
+from . import stream
+
+LINE_STRIDE = 64
+
+INDEX_KIND = 'lines'
+
+# the number of lines and the stride, followed by the offsets.
+HEADER = struct.Struct('<QQ')
+OFFSET = struct.Struct('<Q')
+
+
+def _lines(chunks, skip, count):
+    """
+    Return count lines from the chunks, less the first skip lines.
+    """
+
+    result = []
+    if count <= 0:
+        return result
+    buf = ''
+    for chunk in chunks:
+        buf += chunk
+        pos = 0
+        while True:
+            i = buf.find('\n', pos)
+            if i < 0:
+                break
+            line = buf[pos:i + 1]
+            pos = i + 1
+            if skip:
+                skip -= 1
+                continue
+            result.append(line)
+            if len(result) == count:
+                return result
+        buf = buf[pos:]
+    if buf and not skip:
+        # the last line, without a line ending.
+        result.append(buf)
+    return result
+
+
+def build_index(blob, stride=LINE_STRIDE):
+    """
+    Return the line index of the BlobStream, as the chunks of its data.
+    """
+
+    offsets = [0]
+    newlines = 0
+    offset = 0
+    target = stride
+    last = '\n'
+    for chunk in blob:
+        if not chunk:
+            continue
+        last = chunk[-1]
+        count = chunk.count('\n')
+        if newlines + count >= target:
+            pos = 0
+            for n in xrange(newlines + 1, newlines + count + 1):
+                pos = chunk.index('\n', pos) + 1
+                if n == target:
+                    offsets.append(offset + pos)
+                    target += stride
+        newlines += count
+        offset += len(chunk)
+    lines = newlines
+    if last != '\n':
+        # the last line, without a line ending.
+        lines += 1
+    # an offset recorded at the very end does not start a line.
+    offsets = [o for o in offsets if o < blob.size] or [0]
+    yield HEADER.pack(lines, stride)
+    for i in xrange(0, len(offsets), 8192):
+        part = offsets[i:i + 8192]
+        yield struct.pack('<%dQ' % len(part), *part)
+
+
+class LineIndex(object):
+    """
+    The lines of the BlobStream, with the line index of large blobs
+    kept within the derived data.
+    """
+
+    def __init__(self, blob, derived=None):
+        self.blob = blob
+        self.derived = derived
+        if blob.size < stream.STREAM_THRESHOLD or derived is None:
+            self._data = blob.read()
+            self.count = self._data.count('\n')
+            if self._data and not self._data.endswith('\n'):
+                self.count += 1
+            return
+        self._data = None
+        f = self._open()
+        with f:
+            self.count, self.stride = HEADER.unpack(f.read(HEADER.size))
+
+    def _open(self):
+        f = self.derived.open(INDEX_KIND, self.blob.sha)
+        if f is None:
+            self.derived.put_chunks(INDEX_KIND, self.blob.sha,
+                build_index(self.blob))
+            f = self.derived.open(INDEX_KIND, self.blob.sha)
+        return f
+
+    def _offset(self, checkpoint):
+        with self._open() as f:
+            f.seek(HEADER.size + OFFSET.size * checkpoint)
+            return OFFSET.unpack(f.read(OFFSET.size))[0]
+
+    def lines(self, start=0, end=None):
+        """
+        Return the lines from start up to (not including) end, counted
+        from 0, with their line endings.
+        """
+
+        if end is None or end > self.count:
+            end = self.count
+        start = max(start, 0)
+        if start >= end:
+            return []
+        if self._data is not None:
+            return _lines([self._data], start, end - start)
+        checkpoint = start // self.stride
+        return _lines(self.blob.read_at(self._offset(checkpoint)),
+            start - checkpoint * self.stride, end - start)
@@ -0,0 +1,190 @@
+"""
+Readers-writer locking of workspace repositories.
+
+The views read the refs of a repository (e.g. to resolve HEAD) while
+pushes, syncs and maintenance update them.  Readers of a repository
+proceed in parallel, while its writers hold it exclusively for the short
+critical sections where the refs are updated.  The lock is held both
+within the process and, through a file lock within the repository,
+across the processes sharing it.  It is not reentrant, so no lock of the
+same repository must be taken while one is held.
+"""
+
+import errno
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+from os.path import isdir, join, realpath
+
+from dulwich.refs import DiskRefsContainer
+
+LOCK_NAME = 'pmr2-rw.lock'
+
+logger = logging.getLogger('pmr2.git.lock')
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+class ReadWriteLock(object):
+    """
+    A readers-writer lock for threads.  Writers waiting for the lock
+    hold back new readers, so a steady stream of readers cannot starve
+    them.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+def git_dir(path):
+    """
+    Return the canonical path to the git directory of the repository at
+    path, which may be the workspace directory or its git directory.
+    """
+
+    path = realpath(path)
+    if isdir(join(path, '.git')):
+        return join(path, '.git')
+    return path
+
+
+def rwlock(path):
+    """
+    Return the process-local readers-writer lock of the repository at
+    path.
+    """
+
+    key = git_dir(path)
+    with _locks_guard:
+        lock = _locks.get(key)
+        if lock is None:
+            lock = _locks[key] = ReadWriteLock()
+        return lock
+
+
+def _open_lock(path):
+    # the lock file is created if need be, but one that is already
+    # there is locked as well through a read-only repository, as flock
+    # does not need the file to be writable.
+    name = join(git_dir(path), LOCK_NAME)
+    for mode in ('a', 'r'):
+        try:
+            return open(name, mode)
+        except IOError as e:
+            if e.errno not in (errno.ENOENT, errno.EACCES, errno.EPERM,
+                    errno.EROFS):
+                raise
+    # not a repository (yet), or one this process cannot create the
+    # lock file in and so will not update; the process-local lock still
+    # holds.
+    logger.debug('unable to open the lock file of %s: %s', path, e)
+    return None
+
+
+@contextmanager
+def _file_lock(path, operation):
+    f = _open_lock(path)
+    if f is None:
+        yield
+        return
+    with f:
+        fcntl.flock(f, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def read_lock(path):
+    """
+    Hold the repository at path for reading.
+    """
+
+    lock = rwlock(path)
+    lock.acquire_read()
+    try:
+        with _file_lock(path, fcntl.LOCK_SH):
+            yield
+    finally:
+        lock.release_read()
+
+
+@contextmanager
+def write_lock(path):
+    """
+    Hold the repository at path exclusively, for updating its refs.
+    """
+
+    lock = rwlock(path)
+    lock.acquire_write()
+    try:
+        with _file_lock(path, fcntl.LOCK_EX):
+            yield
+    finally:
+        lock.release_write()
+
+
+class LockedRefsContainer(DiskRefsContainer):
+    """
+    The refs of a dulwich repo, updated while holding the write lock of
+    the repository.  As with DiskRefsContainer, each update is atomic
+    and only applied if the ref still has the expected value.
+    """
+
+    def set_symbolic_ref(self, *a, **kw):
+        with write_lock(self.path):
+            return DiskRefsContainer.set_symbolic_ref(self, *a, **kw)
+
+    def set_if_equals(self, *a, **kw):
+        with write_lock(self.path):
+            return DiskRefsContainer.set_if_equals(self, *a, **kw)
+
+    def add_if_new(self, *a, **kw):
+        with write_lock(self.path):
+            return DiskRefsContainer.add_if_new(self, *a, **kw)
+
+    def remove_if_equals(self, *a, **kw):
+        with write_lock(self.path):
+            return DiskRefsContainer.remove_if_equals(self, *a, **kw)
+
+
+def locked_refs(repo):
+    """
+    Return the refs of the dulwich repo as a LockedRefsContainer.
+    """
+
+    return LockedRefsContainer(repo.commondir(), repo.controldir(),
+        logger=repo._write_reflog)
@@ -0,0 +1,263 @@
+"""
+Background maintenance of workspace repositories.
+
+Every push and sync adds a pack (or loose objects) to the repository, so
+active workspaces accumulate many small packs and lookups slow down over
+time.  Maintenance is scheduled for a repository after these, and runs
+in a background thread once the repository has been left alone for a
+while (later schedules push the run back), consolidating the packs when
+the statistics of the repository call for it and refreshing the indexes
+derived from it.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+from os.path import getsize, join
+from subprocess import Popen, PIPE
+
+import zope.component
+
+from pmr2.app.settings.interfaces import IPMR2GlobalSettings
+
+from .lock import write_lock
+
+# Repack once there are this many packs or loose objects.
+PACK_LIMIT = 16
+LOOSE_LIMIT = 1024
+
+# Seconds a repository must be left alone before maintenance runs.
+DELAY = 60
+
+# Unreachable objects younger than this are kept, as a push may have
+# just started to reference them.
+PRUNE_EXPIRE = '2.weeks.ago'
+
+LOCK_NAME = 'pmr2-maintenance.lock'
+
+git_executable = find_executable('git')
+
+logger = logging.getLogger('pmr2.git.maintenance')
+
+# Callables refreshing the data derived from a repository, called with
+# the path to the repository on every maintenance run.
+derived_indexes = []
+
+
+class MaintenanceError(Exception):
+    """
+    A git operation for the maintenance of a repository failed.
+    """
+
+
+def git(path, *args):
+    p = Popen((git_executable,) + args, stdout=PIPE, stderr=PIPE,
+        env=dict(os.environ, GIT_DIR=path))
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise MaintenanceError('git %s failed in %s: %s' % (
+            args[0], path, err.strip()))
+    return out
+
+
+def repo_stats(path):
+    """
+    Return the statistics of the objects in the repository at path, as
+    a dict with the number of packs and loose objects and their sizes
+    in bytes.  Only the directory listings are read.
+    """
+
+    objects = join(path, 'objects')
+    stats = {
+        'packs': 0,
+        'pack_size': 0,
+        'loose': 0,
+        'loose_size': 0,
+    }
+    pack_dir = join(objects, 'pack')
+    try:
+        names = os.listdir(pack_dir)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        names = []
+    for name in names:
+        if name.startswith('pack-') and name.endswith(('.pack', '.idx')):
+            if name.endswith('.pack'):
+                stats['packs'] += 1
+            stats['pack_size'] += getsize(join(pack_dir, name))
+    for d in os.listdir(objects):
+        if len(d) != 2:
+            continue
+        for name in os.listdir(join(objects, d)):
+            if len(name) == 38:
+                stats['loose'] += 1
+                stats['loose_size'] += getsize(join(objects, d, name))
+    stats['size'] = stats['pack_size'] + stats['loose_size']
+    return stats
+
+
+def needs_repack(stats, pack_limit=PACK_LIMIT, loose_limit=LOOSE_LIMIT):
+    return stats['packs'] >= pack_limit or stats['loose'] >= loose_limit
+
+
+@contextmanager
+def maintenance_lock(path):
+    """
+    Hold the maintenance lock of the repository, which is shared with
+    other processes; yields False if it is already held.
+    """
+
+    with open(join(path, LOCK_NAME), 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def repack(path):
+    """
+    Consolidate the packs and loose objects of the repository at path
+    into a single pack.  Skipped (returning False) without git or if it
+    fails, as the alternatives would hold every object in memory.
+    """
+
+    if not git_executable:
+        logger.info('git not available, not repacking %s', path)
+        return False
+    try:
+        # unreachable objects are loosened rather than dropped, and
+        # only pruned once old enough.
+        git(path, 'repack', '-q', '-A', '-d', '-l')
+        git(path, 'prune', '--expire=%s' % PRUNE_EXPIRE)
+        with write_lock(path):
+            git(path, 'pack-refs', '--all')
+    except MaintenanceError as e:
+        # e.g. the blobs omitted by a partial sync are missing.
+        logger.warning('%s, not repacked', e)
+        return False
+    return True
+
+
+def maintain(path, force=False):
+    """
+    Run the maintenance of the repository at path, repacking it if its
+    statistics call for it (or if forced).  Returns the statistics of
+    the repository before, or None if it is being maintained elsewhere.
+    """
+
+    with maintenance_lock(path) as locked:
+        if not locked:
+            return None
+        stats = repo_stats(path)
+        if force or needs_repack(stats):
+            logger.info('repacking %s with %d packs and %d loose objects',
+                path, stats['packs'], stats['loose'])
+            repack(path)
+        for index in derived_indexes:
+            try:
+                index(path)
+            except Exception:
+                logger.exception('failed to refresh %r for %s', index, path)
+        return stats
+
+
+class MaintenanceQueue(object):
+    """
+    Runs the maintenance of the scheduled repositories in a background
+    thread, each once it has not been scheduled again for delay seconds.
+    At most maxsize repositories may be waiting (if given), with later
+    ones dropped until the queue drains.
+    """
+
+    def __init__(self, delay=DELAY, maintain=maintain, maxsize=None):
+        self.delay = delay
+        self.maintain = maintain
+        self.maxsize = maxsize
+        self._due = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def schedule(self, path, delay=None):
+        """
+        Schedule the path, returning False if the queue is full.
+        """
+
+        if delay is None:
+            delay = self.delay
+        with self._cond:
+            if (self.maxsize and path not in self._due and
+                    len(self._due) >= self.maxsize):
+                logger.warning('queue full, not scheduling %s', path)
+                return False
+            self._due[path] = time.time() + delay
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._work)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return True
+
+    def pending(self):
+        with self._cond:
+            return sorted(self._due)
+
+    def _next(self):
+        with self._cond:
+            while True:
+                if not self._due:
+                    self._cond.wait()
+                    continue
+                path, due = min(self._due.items(), key=lambda i: i[1])
+                wait = due - time.time()
+                if wait <= 0:
+                    del self._due[path]
+                    return path
+                self._cond.wait(wait)
+
+    def run(self, path):
+        # git (and dulwich) only remove the packs and loose objects they
+        # have consolidated, so this is safe alongside pushes and syncs.
+        try:
+            self.maintain(path)
+        except Exception:
+            logger.exception('maintenance of %s failed', path)
+
+    def _work(self):
+        while True:
+            self.run(self._next())
+
+    def flush(self):
+        """
+        Run the maintenance of every scheduled repository now.
+        """
+
+        with self._cond:
+            paths = sorted(self._due)
+            self._due.clear()
+        for path in paths:
+            self.run(path)
+
+
+queue = MaintenanceQueue()
+
+
+def workspace_pushed(event):
+    """
+    Schedule the maintenance of the repository of the pushed workspace.
+    """
+
+    settings = zope.component.getUtility(IPMR2GlobalSettings)
+    queue.schedule(join(settings.dirOf(event.object), '.git'))
@@ -0,0 +1,300 @@
+"""
+Partial syncing of workspaces from remote repositories.
+
+When enabled by setting `PMR2_GIT_SYNC_FILTER` to a blob filter (e.g.
+`blob:limit=1m` or `blob:none`), syncs over HTTP ask the remote to omit
+the blobs matched by the filter through the `fetch` command of git
+protocol version 2, so a workspace can be browsed as soon as its commits
+and trees are in.  The remote is then recorded as the promisor of the
+repository (`pmr2.promisor` in its config), from which the omitted blobs
+are fetched into the repository as they are first read.
+
+Remotes without support for filters in version 2 are synced in full.
+The remote is also recorded as a promisor remote for git, with the packs
+fetched from it marked as promisor packs as git does for partial clones,
+so git fetches the omitted blobs itself as needed (e.g. when serving a
+full clone, or repacking).  The repository format is left as is for
+libgit2, so only the versions of git with `remote.<name>.promisor` do
+so.  Dulwich does not know about the omitted blobs, so its operations
+that need every object of the history will fail until they are fetched.
+"""
+
+import logging
+import os
+from cStringIO import StringIO
+from tempfile import SpooledTemporaryFile
+
+from dulwich.errors import GitProtocolError
+from dulwich.protocol import agent_string
+from dulwich.protocol import pkt_line
+from dulwich.protocol import SIDE_BAND_CHANNEL_DATA
+from dulwich.protocol import SIDE_BAND_CHANNEL_FATAL
+from dulwich.repo import Repo
+
+from pmr2.git.uploadpack import FLUSH, DELIM
+from pmr2.git.uploadpack import ProtocolError, parse_filter
+
+FILTER_ENV = 'PMR2_GIT_SYNC_FILTER'
+
+PROMISOR_SECTION = ('pmr2',)
+PROMISOR_NAME = 'promisor'
+
+# The promisor as a remote for git.
+PROMISOR_REMOTE = ('remote', 'pmr2-promisor')
+
+# packs received up to this size are kept in memory before being added.
+SPOOL_MAX_SIZE = 1 << 22
+
+logger = logging.getLogger('pmr2.git.partial')
+
+
+def sync_filter():
+    """
+    Return the blob filter to sync with, or None if syncs are in full.
+    """
+
+    spec = os.environ.get(FILTER_ENV)
+    if not spec:
+        return None
+    try:
+        parse_filter(spec)
+    except ProtocolError:
+        logger.warning('ignoring unsupported %s: %s', FILTER_ENV, spec)
+        return None
+    return spec
+
+
+def get_promisor(repo):
+    """
+    Return the url of the remote the omitted blobs of the dulwich repo
+    may be fetched from, or None if it was synced in full.
+    """
+
+    try:
+        return repo.get_config().get(PROMISOR_SECTION, PROMISOR_NAME)
+    except KeyError:
+        return None
+
+
+def set_promisor(repo, url):
+    config = repo.get_config()
+    config.set(PROMISOR_SECTION, PROMISOR_NAME, url)
+    config.set(PROMISOR_REMOTE, 'url', url)
+    config.set(PROMISOR_REMOTE, 'promisor', True)
+    config.write_to_path()
+
+
+def mark_promisor(pack):
+    """
+    Mark the dulwich pack as fetched from the promisor, such that git
+    knows the objects it references may be missing.
+    """
+
+    open(pack._basename + '.promisor', 'a').close()
+
+
+def _read_pkt(read):
+    """
+    Read a packet, returning its payload as is, or FLUSH or DELIM for the
+    special packets.
+    """
+
+    size = read(4)
+    if len(size) < 4:
+        raise GitProtocolError('unexpected end of response')
+    if size in (FLUSH, DELIM):
+        return size
+    try:
+        length = int(size, 16)
+    except ValueError:
+        raise GitProtocolError('invalid pkt-line length')
+    data = read(length - 4)
+    if len(data) < length - 4:
+        raise GitProtocolError('unexpected end of response')
+    return data
+
+
+def _exact_reader(fileobj):
+    def read(size):
+        chunks = []
+        while size > 0:
+            chunk = fileobj.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+    return read
+
+
+class V2Client(object):
+    """
+    The parts of a git protocol version 2 client over HTTP (sharing the
+    urllib3 pool manager of the syncs) needed for partial syncs.
+    """
+
+    def __init__(self, url, pool_manager):
+        self.url = url.rstrip('/')
+        self.pool_manager = pool_manager
+
+    def _request(self, method, path, body=None, preload_content=True):
+        headers = self.pool_manager.headers.copy()
+        headers['Git-Protocol'] = 'version=2'
+        headers['Accept-Encoding'] = 'identity'
+        if body is not None:
+            headers['Content-Type'] = 'application/x-git-upload-pack-request'
+        url = self.url + path
+        resp = self.pool_manager.request(method, url, headers=headers,
+            body=body, preload_content=preload_content)
+        if resp.status != 200:
+            if not preload_content:
+                resp.read()
+                resp.release_conn()
+            raise GitProtocolError('unexpected http resp %d for %s' % (
+                resp.status, url))
+        return resp
+
+    def capabilities(self):
+        """
+        Return the version 2 capabilities of the remote as a dict, which
+        is empty for remotes that only speak the earlier versions.
+        """
+
+        resp = self._request('GET', '/info/refs?service=git-upload-pack')
+        read = StringIO(resp.data).read
+        line = _read_pkt(read)
+        if line.startswith('# service='):
+            # git http-backend only omits this for version 2 clients.
+            while line != FLUSH:
+                line = _read_pkt(read)
+            line = _read_pkt(read)
+        if line.rstrip('\n') != 'version 2':
+            return {}
+        caps = {}
+        while True:
+            line = _read_pkt(read)
+            if line in (FLUSH, DELIM):
+                break
+            name, _, value = line.rstrip('\n').partition('=')
+            caps[name] = value
+        return caps
+
+    def supports_filter(self):
+        return 'filter' in self.capabilities().get('fetch', '').split()
+
+    def _command(self, command, args):
+        body = [pkt_line('command=%s\n' % command),
+            pkt_line('agent=%s\n' % agent_string()), DELIM]
+        body.extend(pkt_line(arg + '\n') for arg in args)
+        body.append(FLUSH)
+        return ''.join(body)
+
+    def ls_refs(self, prefixes):
+        """
+        Return the refs of the remote starting with any of the prefixes
+        as a dict.
+        """
+
+        resp = self._request('POST', '/git-upload-pack', self._command(
+            'ls-refs', ['ref-prefix %s' % p for p in prefixes]))
+        read = StringIO(resp.data).read
+        refs = {}
+        while True:
+            line = _read_pkt(read)
+            if line == FLUSH:
+                return refs
+            line = line.rstrip('\n')
+            if line.startswith('ERR '):
+                raise GitProtocolError(line[4:])
+            sha, name = line.split(' ')[:2]
+            refs[name] = sha
+
+    def fetch(self, object_store, wants, haves=(), filter_spec=None):
+        """
+        Fetch the wanted objects (commits, or the blobs omitted by an
+        earlier fetch) and what they reference into the object store,
+        less what is reachable from the haves and what the filter omits.
+        """
+
+        args = ['want %s' % sha for sha in wants]
+        args.extend('have %s' % sha for sha in haves)
+        if filter_spec:
+            args.append('filter %s' % filter_spec)
+        args.extend(['no-progress', 'done'])
+        resp = self._request('POST', '/git-upload-pack',
+            self._command('fetch', args), preload_content=False)
+
+        spool = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        try:
+            try:
+                self._read_packfile(_exact_reader(resp), spool.write)
+            finally:
+                resp.read()
+                resp.release_conn()
+            if spool.tell():
+                spool.seek(0)
+                pack = object_store.add_thin_pack(spool.read, None)
+                if pack is not None:
+                    mark_promisor(pack)
+        finally:
+            spool.close()
+
+    def _read_packfile(self, read, write):
+        section = None
+        while True:
+            pkt = _read_pkt(read)
+            if pkt == FLUSH:
+                return
+            if pkt == DELIM:
+                section = None
+                continue
+            if section is None:
+                section = pkt.rstrip('\n')
+                if section.startswith('ERR '):
+                    raise GitProtocolError(section[4:])
+                continue
+            if section != 'packfile':
+                # e.g. shallow-info, which does not apply to this.
+                continue
+            band = ord(pkt[0])
+            if band == SIDE_BAND_CHANNEL_DATA:
+                write(pkt[1:])
+            elif band == SIDE_BAND_CHANNEL_FATAL:
+                raise GitProtocolError(pkt[1:].strip())
+
+
+def fetch_partial(client, repo, branch, determine_wants, filter_spec):
+    """
+    Fetch the branch (or HEAD) of the remote into the dulwich repo less
+    the blobs omitted by the filter, recording the remote as the
+    promisor.  Returns the refs of the remote.
+    """
+
+    refs = client.ls_refs([branch, 'HEAD'])
+    wants = determine_wants(refs)
+    if wants:
+        haves = set(repo.refs.as_dict().values())
+        client.fetch(repo.object_store, wants, haves, filter_spec)
+    if get_promisor(repo) != client.url:
+        set_promisor(repo, client.url)
+    return refs
+
+
+def fetch_missing(path, shas, pool_manager):
+    """
+    Fetch the objects omitted by a partial sync of the repository at path
+    from its promisor.  Returns False if the repository has no promisor
+    or the fetch failed.
+    """
+
+    repo = Repo(path)
+    url = get_promisor(repo)
+    if url is None:
+        return False
+    try:
+        V2Client(url, pool_manager).fetch(repo.object_store, shas)
+    except Exception as e:
+        logger.warning('unable to fetch missing objects for %s from %s: %s',
+            path, url, e)
+        return False
+    return True
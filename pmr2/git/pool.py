@@ -0,0 +1,325 @@
+"""
+Shared object pools for families of forked workspaces.
+
+A pool is a bare repository that holds the objects common to a set of
+member repositories (a workspace and its forks, and their forks), with
+every member borrowing from it through `objects/info/alternates`.  The
+refs of the members are mirrored into the pool under
+`refs/members/<id>/`, so that the objects reachable from any member are
+kept by the garbage collection of the pool.
+
+The pool keeps a list of its members, which serves as its reference
+count; members that no longer exist (or no longer borrow from the pool)
+are dropped on collection, and the pool is removed with its last member.
+
+Pooling is optional and is enabled by pointing the `PMR2_GIT_POOL_ROOT`
+environment variable at the directory to keep the pools in.  The git
+executable is required.
+"""
+
+import argparse
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+from hashlib import sha1
+from glob import glob
+from os.path import abspath, exists, isdir, join
+from subprocess import Popen, PIPE
+
+from .lock import read_lock, write_lock
+
+POOL_ROOT_ENV = 'PMR2_GIT_POOL_ROOT'
+
+# Unreachable objects younger than this are kept by the collection, as
+# a push to a member may have just started to reference them.
+PRUNE_EXPIRE = '2.weeks.ago'
+
+git_executable = find_executable('git')
+
+logger = logging.getLogger('pmr2.git.pool')
+
+
+class PoolError(Exception):
+    """
+    A git operation on a pool or its member failed.
+    """
+
+
+def pool_root():
+    """
+    Return the directory to keep the pools in, or None if pooling is
+    not enabled (or not possible without git).
+    """
+
+    root = os.environ.get(POOL_ROOT_ENV)
+    if not root or not git_executable:
+        return None
+    return root
+
+
+def git(path, *args, **kw):
+    p = Popen((git_executable,) + args, stdin=PIPE, stdout=PIPE,
+        stderr=PIPE, env=dict(os.environ, GIT_DIR=path))
+    out, err = p.communicate(kw.get('input'))
+    if p.returncode != 0:
+        raise PoolError('git %s failed in %s: %s' % (
+            args[0], path, err.strip()))
+    return out
+
+
+def alternates_path(repo_path):
+    return join(repo_path, 'objects', 'info', 'alternates')
+
+
+def read_alternates(repo_path):
+    try:
+        with open(alternates_path(repo_path)) as f:
+            return [line.strip() for line in f
+                if line.strip() and not line.startswith('#')]
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+
+
+def member_id(repo_path):
+    return sha1(abspath(repo_path)).hexdigest()
+
+
+class ObjectPool(object):
+    """
+    An object pool for the bare repository at path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.objects = join(path, 'objects')
+        self._members_file = join(path, 'pmr2-members')
+
+    @classmethod
+    def create(cls, root, repo_path):
+        """
+        Create a pool with the repository as its first member.
+        """
+
+        name = uuid.uuid4().hex
+        tmp = join(root, '%s.tmp' % name)
+        git(tmp, 'init', '-q', '--bare', tmp)
+        # The pool is never written to by users, and its objects must
+        # not be pruned on its own terms.
+        git(tmp, 'config', 'gc.auto', '0')
+        # the pool is only put in place while locked, so it is not
+        # collected for having no members before its first has joined.
+        with cls(tmp).lock():
+            os.rename(tmp, join(root, '%s.git' % name))
+            result = cls(join(root, '%s.git' % name))
+            result._join(repo_path)
+        return result
+
+    @classmethod
+    def of(cls, repo_path, root=None):
+        """
+        Return the pool the repository borrows from, if any.
+        """
+
+        root = root or pool_root()
+        if root is None:
+            return None
+        root = abspath(root)
+        for alternate in read_alternates(repo_path):
+            alternate = abspath(alternate)
+            if (alternate.startswith(root + os.sep) and
+                    alternate.endswith(os.sep + 'objects')):
+                path = alternate[:-len(os.sep + 'objects')]
+                if isdir(path):
+                    return cls(path)
+        return None
+
+    @contextmanager
+    def lock(self):
+        with open(join(self.path, 'pmr2-members.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def members(self):
+        try:
+            with open(self._members_file) as f:
+                return [line.strip() for line in f if line.strip()]
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+    def _write_members(self, members):
+        tmp = self._members_file + '.tmp'
+        with open(tmp, 'w') as f:
+            f.writelines('%s\n' % m for m in members)
+        os.rename(tmp, self._members_file)
+
+    def is_member(self, repo_path):
+        return abspath(self.objects) in [
+            abspath(a) for a in read_alternates(repo_path)]
+
+    def join(self, repo_path):
+        """
+        Make the repository borrow objects from this pool, with its own
+        objects migrated into the pool.
+        """
+
+        # held throughout, as the collection drops the members that do
+        # not yet borrow from the pool.
+        with self.lock():
+            self._join(repo_path)
+
+    def _join(self, repo_path):
+        repo_path = abspath(repo_path)
+        members = self.members()
+        if repo_path not in members:
+            self._write_members(members + [repo_path])
+        # the refs of the member are held still while they are mirrored
+        # and its objects are migrated.
+        with write_lock(repo_path):
+            # mirror the objects first, so nothing is missing from the
+            # repository while it is repacked against the pool.
+            self.refresh(repo_path)
+            alternates = read_alternates(repo_path)
+            if abspath(self.objects) not in [
+                    abspath(a) for a in alternates]:
+                with open(alternates_path(repo_path), 'w') as f:
+                    f.writelines('%s\n' % a for a in
+                        alternates + [abspath(self.objects)])
+            self.migrate(repo_path)
+
+    def refresh(self, repo_path):
+        """
+        Mirror the refs (and so the objects) of a member into the pool.
+        """
+
+        git(self.path, 'fetch', '-q', '--no-tags', '--prune', repo_path,
+            '+refs/*:refs/members/%s/*' % member_id(repo_path))
+
+    def migrate(self, repo_path):
+        """
+        Drop the objects of the member that are available in the pool.
+        """
+
+        # the local packs are rewritten without the pooled objects, with
+        # the unreachable ones loosened rather than dropped, as a push
+        # or sync may be about to reference them; the maintenance of the
+        # member prunes them once old enough.
+        git(repo_path, 'repack', '-q', '-A', '-d', '-l')
+
+        # but loose objects are only dropped if in a local pack.
+        objects = join(repo_path, 'objects')
+        loose = [d + n for d in os.listdir(objects) if len(d) == 2
+            for n in os.listdir(join(objects, d)) if len(n) == 38]
+        if not loose:
+            return
+        found = git(self.path, 'cat-file', '--batch-check',
+            input=''.join('%s\n' % sha for sha in loose))
+        for line in found.splitlines():
+            sha, kind = line.split()[:2]
+            if kind != 'missing':
+                os.remove(join(objects, sha[:2], sha[2:]))
+
+    def maintain(self):
+        """
+        Migrate the objects of all the members into the pool.
+        """
+
+        for repo_path in self.live_members():
+            with write_lock(repo_path):
+                self.refresh(repo_path)
+                self.migrate(repo_path)
+
+    def live_members(self):
+        return [m for m in self.members()
+            if isdir(m) and self.is_member(m)]
+
+    def gc(self):
+        """
+        Collect the garbage in the pool, dropping the members that are
+        gone.  Returns False if the pool itself was removed as it has no
+        members left.
+        """
+
+        with self.lock():
+            members = self.members()
+            live = self.live_members()
+            if live != members:
+                self._write_members(live)
+            if not live:
+                logger.info('removing pool %s with no members', self.path)
+                shutil.rmtree(self.path)
+                return False
+
+        for gone in set(members) - set(live):
+            refs = git(self.path, 'for-each-ref', '--format=%(refname)',
+                'refs/members/%s/' % member_id(gone)).split()
+            if refs:
+                git(self.path, 'update-ref', '--stdin',
+                    input=''.join('delete %s\n' % r for r in refs))
+
+        for repo_path in live:
+            with read_lock(repo_path):
+                self.refresh(repo_path)
+        # unreachable objects are loosened and only pruned once old
+        # enough, so the ones just referenced by a push are kept.
+        git(self.path, 'repack', '-q', '-A', '-d')
+        git(self.path, 'prune', '--expire=%s' % PRUNE_EXPIRE)
+        return True
+
+
+def join_family(repo_path, source_path, root=None):
+    """
+    Have the repository join the pool of the source repository, creating
+    the pool for the source if it does not have one.  Returns the pool,
+    or None if pooling is not enabled.
+    """
+
+    root = root or pool_root()
+    if root is None:
+        return None
+    if not exists(root):
+        os.makedirs(root)
+    pool = ObjectPool.of(source_path, root)
+    if pool is None:
+        pool = ObjectPool.create(root, source_path)
+    pool.join(repo_path)
+    return pool
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Maintain the shared object pools of PMR2 workspaces.')
+    parser.add_argument('--root', default=os.environ.get(POOL_ROOT_ENV),
+        help='directory of the pools (default: $%s)' % POOL_ROOT_ENV)
+    parser.add_argument('--no-gc', action='store_true',
+        help='only migrate the objects of the members into the pools')
+    args = parser.parse_args(argv)
+    if not args.root:
+        parser.error('the root directory of the pools is required')
+    if not git_executable:
+        parser.error('git is not available')
+
+    logging.basicConfig(level=logging.INFO)
+    for path in sorted(glob(join(args.root, '*.git'))):
+        object_pool = ObjectPool(path)
+        try:
+            object_pool.maintain()
+            if not args.no_gc:
+                object_pool.gc()
+        except PoolError as e:
+            logger.error('%s', e)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+"""
+Resumable fetches for syncs from remote repositories.
+
+The pack data of a fetch is spooled into `pmr2-fetch` within the
+repository as it is received.  Should the fetch fail, what was received
+is kept; the next fetch first adds the objects that were received in
+full into a quarantine object store (borrowing from the repository),
+and advertises the commits among them that are complete (i.e. with
+every object they reference present) as haves, so that the remote only
+sends the remainder.  The quarantined objects are only moved into the
+repository once the fetch has completed, so the repository never has
+commits without all that they reference.
+"""
+
+import errno
+import json
+import logging
+import os
+import shutil
+import struct
+import zlib
+from hashlib import sha1
+from os.path import exists, join
+from stat import S_ISDIR
+from tempfile import TemporaryFile
+
+from dulwich.client import HttpGitClient
+from dulwich.errors import GitProtocolError, NotGitRepository
+from dulwich.objects import S_ISGITLINK
+from dulwich.object_store import DiskObjectStore, ObjectStoreGraphWalker
+from dulwich.pack import PackStreamReader
+
+from .stream import object_type
+
+RESUME_DIR = 'pmr2-fetch'
+
+# log the progress of a fetch every this many bytes received.
+PROGRESS_INTERVAL = 1 << 23
+
+COMMIT_TYPE_NUM = 1
+
+logger = logging.getLogger('pmr2.git.resume')
+
+
+class StreamingHttpGitClient(HttpGitClient):
+    """
+    The HttpGitClient, but with the response to upload-pack requests read
+    as it arrives rather than buffered in full first, so the pack data
+    received before a failure is not lost.  The client must be closed
+    after use to release the connections.
+    """
+
+    def __init__(self, *a, **kw):
+        HttpGitClient.__init__(self, *a, **kw)
+        self._responses = []
+
+    def _http_request(self, url, headers=None, data=None,
+                      allow_compression=False):
+        if data is None:
+            return HttpGitClient._http_request(
+                self, url, headers, data, allow_compression)
+
+        req_headers = self.pool_manager.headers.copy()
+        if headers is not None:
+            req_headers.update(headers)
+        req_headers['Pragma'] = 'no-cache'
+        req_headers['Accept-Encoding'] = (
+            allow_compression and 'gzip' or 'identity')
+        resp = self.pool_manager.request('POST', url, headers=req_headers,
+            body=data, preload_content=False)
+        self._responses.append(resp)
+
+        if resp.status == 404:
+            raise NotGitRepository()
+        elif resp.status != 200:
+            raise GitProtocolError('unexpected http resp %d for %s' % (
+                resp.status, url))
+
+        resp.content_type = resp.getheader('Content-Type')
+        resp.redirect_location = ''
+        return resp, resp.read
+
+    def close(self):
+        for resp in self._responses:
+            # a response not read in full leaves its connection unusable.
+            if not resp.closed:
+                resp.close()
+            resp.release_conn()
+        self._responses = []
+
+
+def salvage_pack(path, object_store):
+    """
+    Add the objects received in full from the truncated pack at path to
+    the object store, as a new pack.  Returns the new pack, or None if
+    not even one object was received.
+    """
+
+    with open(path, 'rb') as f:
+        reader = PackStreamReader(f.read)
+        count = 0
+        end = 0
+        try:
+            for unpacked in reader.read_objects():
+                count += 1
+                end = reader.offset
+        except (zlib.error, struct.error, TypeError, AssertionError,
+                ValueError):
+            # the truncated object, or the end of the pack.
+            pass
+        except Exception as e:
+            # the trailer of a complete pack may not match.
+            logger.debug('truncated pack %s: %s', path, e)
+        if not count:
+            return None
+
+        with TemporaryFile() as out:
+            checksum = sha1()
+            def write(data):
+                checksum.update(data)
+                out.write(data)
+            write('PACK' + struct.pack('>LL', 2, count))
+            f.seek(12)
+            remaining = end - 12
+            while remaining > 0:
+                data = f.read(min(remaining, 65536))
+                if not data:
+                    break
+                write(data)
+                remaining -= len(data)
+            out.write(checksum.digest())
+            out.seek(0)
+            return object_store.add_thin_pack(out.read, None)
+
+
+def _tree_complete(object_store, sha, received, memo):
+    # the objects not received through a resumed fetch were complete.
+    if sha not in received:
+        return sha in object_store
+    if sha not in memo:
+        memo[sha] = sha in object_store and all(
+            S_ISGITLINK(entry.mode) or (
+                _tree_complete(object_store, entry.sha, received, memo)
+                if S_ISDIR(entry.mode) else entry.sha in object_store)
+            for entry in object_store[sha].items())
+    return memo[sha]
+
+
+def find_complete(object_store, received):
+    """
+    Return the (complete, incomplete) sets of the commits among the
+    received objects of the DiskObjectStore, with complete commits
+    having every object they reference (and their ancestors) present.
+    """
+
+    received = set(received)
+    commits = []
+    for sha in received:
+        # only the commits are read in full.
+        try:
+            if object_type(object_store, sha) == COMMIT_TYPE_NUM:
+                commits.append(sha)
+        except KeyError:
+            continue
+    complete = {}
+    memo = {}
+    for sha in commits:
+        stack = [sha]
+        while stack:
+            current = stack[-1]
+            if current in complete:
+                stack.pop()
+                continue
+            if current not in received:
+                complete[current] = current in object_store
+                stack.pop()
+                continue
+            commit = object_store[current]
+            pending = [p for p in commit.parents if p not in complete]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            complete[current] = (
+                all(complete[p] for p in commit.parents) and
+                _tree_complete(object_store, commit.tree, received, memo))
+    return (set(sha for sha in commits if complete[sha]),
+        set(sha for sha in commits if not complete[sha]))
+
+
+class ResumableFetch(object):
+    """
+    A fetch into the dulwich repo that resumes from what the previous
+    failed fetch into it had received.
+    """
+
+    def __init__(self, repo, progress=None):
+        self.repo = repo
+        self.progress = progress
+        self.path = join(repo.controldir(), RESUME_DIR)
+        self.pack_path = join(self.path, 'pack')
+        self.objects_path = join(self.path, 'objects')
+        self.received_path = join(self.path, 'received')
+        self.state_path = join(self.path, 'state.json')
+        self.haves = []
+        self.incomplete = set()
+
+    def read_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+
+    def _write_state(self, **kw):
+        state = self.read_state()
+        state.update(kw)
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, self.state_path)
+
+    def _received(self):
+        try:
+            with open(self.received_path) as f:
+                return [line.strip() for line in f if line.strip()]
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+    def quarantine(self):
+        """
+        Return the object store of the objects received, which borrows
+        the objects of the repository.
+        """
+
+        if not exists(self.objects_path):
+            if not exists(self.path):
+                os.mkdir(self.path)
+            DiskObjectStore.init(self.objects_path).add_alternate_path(
+                self.repo.object_store.path)
+        return DiskObjectStore(self.objects_path)
+
+    def _release(self, store):
+        # the quarantined objects are all packed, and each pack must be
+        # in place before its index is.
+        pack_dir = self.repo.object_store.pack_dir
+        names = os.listdir(store.pack_dir)
+        for name in sorted(names):
+            base, ext = os.path.splitext(name)
+            if ext != '.pack' or base + '.idx' not in names:
+                continue
+            for suffix in ('.pack', '.idx'):
+                os.rename(join(store.pack_dir, base + suffix),
+                    join(pack_dir, base + suffix))
+
+    def recover(self):
+        """
+        Add what the previous fetch received to the quarantine, and work
+        out the haves to resume with.
+        """
+
+        store = self.quarantine()
+        if exists(self.pack_path):
+            try:
+                pack = salvage_pack(self.pack_path, store)
+            except Exception as e:
+                logger.warning('unable to recover the objects received '
+                    'into %s: %s', self.repo.controldir(), e)
+                pack = None
+            if pack is not None:
+                with open(self.received_path, 'a') as f:
+                    f.writelines('%s\n' % sha for sha in pack)
+                logger.info('resuming the fetch into %s with %d objects '
+                    'received before', self.repo.controldir(), len(pack))
+            os.remove(self.pack_path)
+
+        received = self._received()
+        if not received:
+            return []
+        complete, self.incomplete = find_complete(store, received)
+        parents = set()
+        for sha in complete:
+            parents.update(store[sha].parents)
+        self.haves = sorted(complete - parents)
+        self._write_state(haves=self.haves)
+        return self.haves
+
+    def _writer(self, f):
+        received = [0]
+        def write(data):
+            f.write(data)
+            before = received[0]
+            received[0] += len(data)
+            if before // PROGRESS_INTERVAL != received[0] // PROGRESS_INTERVAL:
+                logger.info('fetching into %s: %d bytes received',
+                    self.repo.controldir(), received[0])
+        return write
+
+    def __call__(self, client, path, determine_wants):
+        """
+        Fetch from the path through the client, returning the refs of
+        the remote.  recover() should be called first.
+        """
+
+        store = self.quarantine()
+        heads = [sha for sha in self.repo.refs.as_dict('refs/heads').values()
+            if sha in store]
+        graph_walker = ObjectStoreGraphWalker(heads + self.haves,
+            lambda sha: store[sha].parents, shallow=self.repo.get_shallow())
+
+        def wants(refs, **kw):
+            result = determine_wants(refs, **kw)
+            if result:
+                self._write_state(wants=result)
+            return result
+
+        if not exists(self.path):
+            os.mkdir(self.path)
+        with open(self.pack_path, 'wb') as f:
+            result = client.fetch_pack(path, wants, graph_walker,
+                self._writer(f), progress=self.progress)
+
+        with open(self.pack_path, 'rb') as f:
+            if f.read(1):
+                f.seek(0)
+                store.add_thin_pack(f.read, None)
+        # complete with the rest of what the remote sent.
+        self._release(store)
+        shutil.rmtree(self.path)
+        return result.refs
@@ -0,0 +1,191 @@
+"""
+Caching the resolution of revisions.
+
+Every storage resolves HEAD (or the revision asked for) when it is
+created, and the same few revisions are resolved over and over.  The
+objects that revisions resolve to are cached per repository and shared
+by the storages of the process.  Full object ids always resolve to
+themselves so they are cached for good, while the other revisions (refs,
+abbreviated ids and expressions) are cached against the state of the
+refs they may resolve through, i.e. the files holding them and the
+directories their loose refs are created in, which every update of those
+refs replaces.  Only these are looked at, and only for the revisions
+that need them, so resolving HEAD does not read the whole of refs/.
+"""
+
+import errno
+import os
+import re
+import threading
+import time
+from os.path import join
+
+from .lock import git_dir
+
+FULL_ID = re.compile('^[0-9a-f]{40}$')
+# where the name of the ref ends within an expression, e.g. master~2.
+REF_END = re.compile(r'[~^:]|@\{')
+
+# The loose refs a name may be, in the order git looks for them.
+REF_RULES = ('%s', 'refs/%s', 'refs/tags/%s', 'refs/heads/%s',
+    'refs/remotes/%s', 'refs/remotes/%s/HEAD')
+
+# The revisions kept per repository, and the repositories kept.
+MAX_REVISIONS = 1024
+MAX_REPOSITORIES = 1024
+
+# Changes to the refs within this many seconds of their fingerprint may
+# not show in it, as the timestamps of the files are coarser than that.
+RACY_SECONDS = 1
+
+_caches = {}
+_caches_guard = threading.Lock()
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def _read_ref(path):
+    # the first line of the loose ref at path, or None if there is none.
+    try:
+        with open(path) as f:
+            return f.readline(1024)
+    except IOError:
+        return None
+
+
+def ref_paths(rev):
+    """
+    Return the paths (relative to the git directory) of the loose refs
+    the revision may resolve through.
+    """
+
+    name = REF_END.split(rev, 1)[0]
+    if name in ('', '@'):
+        name = 'HEAD'
+    return [rule % name for rule in REF_RULES]
+
+
+def refs_fingerprint(path, rev='HEAD'):
+    """
+    Return the fingerprint of the state of the refs of the repository at
+    path (its git directory) that rev may resolve through, and the time
+    it was last changed.
+    """
+
+    # a loose ref is replaced by renaming a file into its directory, and
+    # one that is new may also create the directories leading to it.
+    files = set(['packed-refs'])
+    dirs = set()
+    for ref in ref_paths(rev):
+        names = [ref]
+        line = _read_ref(join(path, ref))
+        if line is not None and line.startswith('ref: '):
+            names.append(line[5:].strip())
+        for name in names:
+            parts = name.split('/')
+            if parts[0] != 'refs':
+                files.add(name)
+            for i in range(1, len(parts)):
+                dirs.add('/'.join(parts[:i]))
+        if line is not None:
+            # the refs after the first one found are not looked at.
+            break
+
+    stats = [_stat(join(path, name)) for name in sorted(files)]
+    stats.extend(_stat(join(path, name)) for name in sorted(dirs))
+    changed = max([st[2] for st in stats if st is not None] or [0])
+    return tuple(stats), changed
+
+
+class RevisionCache(object):
+    """
+    The ids of the objects the revisions of a repository resolve to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._full = set()
+        self._revisions = {}
+        self._guard = threading.Lock()
+
+    def get(self, rev, fingerprint=None):
+        """
+        Return the id rev resolves to, or None if not known, with the
+        fingerprint of the refs for revisions other than full ids.
+        """
+
+        with self._guard:
+            if FULL_ID.match(rev):
+                return rev if rev in self._full else None
+            fingerprint, changed = fingerprint
+            entry = self._revisions.get(rev)
+            if entry is None or entry[0] != fingerprint:
+                return None
+            return entry[1]
+
+    def put(self, rev, oid, fingerprint=None):
+        """
+        Record the id the rev resolved to, with the fingerprint of the
+        refs (taken before it was resolved) for revisions other than
+        full ids.
+        """
+
+        with self._guard:
+            if FULL_ID.match(rev):
+                if len(self._full) >= MAX_REVISIONS:
+                    self._full.clear()
+                self._full.add(rev)
+                return
+            fingerprint, changed = fingerprint
+            if time.time() - changed < RACY_SECONDS:
+                # a later change may yet go unnoticed.
+                return
+            if len(self._revisions) >= MAX_REVISIONS:
+                self._revisions.clear()
+            self._revisions[rev] = (fingerprint, oid)
+
+
+def revision_cache(path):
+    """
+    Return the revision cache of the repository at path.
+    """
+
+    key = git_dir(path)
+    with _caches_guard:
+        cache = _caches.get(key)
+        if cache is None:
+            if len(_caches) >= MAX_REPOSITORIES:
+                _caches.clear()
+            cache = _caches[key] = RevisionCache(key)
+        return cache
+
+
+def resolve(repo, rev):
+    """
+    Return the object of the pygit2 repo that rev resolves to, raising
+    KeyError if it does not resolve.
+    """
+
+    cache = revision_cache(repo.path)
+    fingerprint = None
+    if not FULL_ID.match(rev):
+        # taken once, both to look up the revision and to record it.
+        fingerprint = refs_fingerprint(cache.path, rev)
+    oid = cache.get(rev, fingerprint)
+    if oid is not None:
+        try:
+            return repo[oid]
+        except KeyError:
+            # e.g. the repository was replaced.
+            pass
+    obj = repo.revparse_single(rev)
+    cache.put(rev, obj.hex, fingerprint)
+    return obj
@@ -0,0 +1,372 @@
+"""
+Standalone git smart HTTP server for PMR2 workspaces.
+
+This serves the same set of git services as the `GitProtocol` view as a
+plain WSGI application, so that git traffic (especially slow clones)
+does not tie up the Zope workers and their database connections.  The
+decision on whether a request is allowed, and where the repository is
+located, is delegated back to Zope through the lightweight
+`git-authorize` (or `git-authorize-push`) views on the workspace, with
+the results cached for a short duration.
+
+Zope and this server must share a secret, which is provided to Zope by
+the `PMR2_GIT_SERVER_SECRET` environment variable; the views are not
+available if that is unset.
+"""
+
+import argparse
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+import urllib2
+from cStringIO import StringIO
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from wsgiref.simple_server import make_server
+from wsgiref.util import application_uri
+
+from dulwich.server import DEFAULT_HANDLERS
+from dulwich.web import HTTPGitRequest
+from dulwich.web import HTTP_OK, HTTP_NOT_FOUND, HTTP_FORBIDDEN
+
+from pmr2.git.backend import DulwichBackend
+from pmr2.git.backend import services, push_patt, URL_KEY, PUSH_CHECK_KEY
+from pmr2.git.backend import match_service, is_push, fix_head
+from pmr2.git.backend import push_warning_pkt
+from pmr2.git.backend import GzipInput, GzipResponse
+from pmr2.git.backend import accepts_gzip, compressible_services
+
+SECRET_ENV = 'PMR2_GIT_SERVER_SECRET'
+SECRET_HEADER = 'X-PMR2-Git-Secret'
+
+HTTP_UNAUTHORIZED = '401 Unauthorized'
+
+# Set by the bundled request handler for chunked request bodies, which
+# it leaves for the application to decode.
+DECHUNK_KEY = 'pmr2.git.dechunk'
+
+logger = logging.getLogger('pmr2.git.server')
+
+
+def check_secret(value, secret=None):
+    """
+    Check the value provided against the shared secret; always False if
+    the secret is not configured.
+    """
+
+    if secret is None:
+        secret = os.environ.get(SECRET_ENV)
+    if not secret or not value:
+        return False
+    return hmac.compare_digest(str(value), str(secret))
+
+
+class AuthorizationError(Exception):
+
+    def __init__(self, status, headers=None):
+        super(AuthorizationError, self).__init__(status)
+        self.status = status
+        self.headers = headers or []
+
+
+class _NoRedirect(urllib2.HTTPRedirectHandler):
+    """
+    Do not follow redirects, as Plone redirects anonymous users to the
+    login form rather than responding with Unauthorized.
+    """
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class ZopeAuthorizer(object):
+    """
+    Ask the Zope instance whether the credentials of a request grant
+    access to the workspace at some path, and where its repository is.
+
+    Successful results are cached for `ttl` seconds per workspace,
+    access level and credentials, so a typical clone or fetch (which
+    spans multiple requests) only costs a single round trip.
+    """
+
+    def __init__(self, zope_url, secret, ttl=30, timeout=10):
+        self.zope_url = zope_url.rstrip('/')
+        self.secret = secret
+        self.ttl = ttl
+        self.timeout = timeout
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._opener = urllib2.build_opener(_NoRedirect)
+
+    def _cache_key(self, prefix, push, environ):
+        credentials = '\0'.join([
+            environ.get('HTTP_AUTHORIZATION', ''),
+            environ.get('HTTP_COOKIE', ''),
+        ])
+        return (prefix, push, hashlib.sha1(credentials).hexdigest())
+
+    def _query(self, prefix, push, environ, event=False):
+        view = push and 'git-authorize-push' or 'git-authorize'
+        url = '%s%s/@@%s' % (self.zope_url, prefix, view)
+        if event:
+            url += '?event=push'
+        request = urllib2.Request(url)
+        request.add_header(SECRET_HEADER, self.secret)
+        for key, header in (
+                ('HTTP_AUTHORIZATION', 'Authorization'),
+                ('HTTP_COOKIE', 'Cookie')):
+            if key in environ:
+                request.add_header(header, environ[key])
+        try:
+            response = self._opener.open(request, timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code in (302, 401):
+                raise AuthorizationError(HTTP_UNAUTHORIZED, [
+                    ('WWW-Authenticate', 'Basic realm="PMR2"')])
+            elif e.code == 403:
+                raise AuthorizationError(HTTP_FORBIDDEN)
+            raise AuthorizationError(HTTP_NOT_FOUND)
+        try:
+            path = response.read().strip()
+        finally:
+            response.close()
+        if not (os.path.isabs(path) and os.path.isdir(path)):
+            logger.warning('invalid repository path for %s', prefix)
+            raise AuthorizationError(HTTP_NOT_FOUND)
+        return path
+
+    def __call__(self, prefix, push, environ, event=False):
+        """
+        Return the repository path for the workspace at prefix, raising
+        AuthorizationError if access is not granted.
+
+        If event is set, the result is never cached as Zope is expected
+        to act on the request (i.e. fire the Push event).
+        """
+
+        if event:
+            return self._query(prefix, push, environ, event=True)
+
+        key = self._cache_key(prefix, push, environ)
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached and cached[0] > now:
+                return cached[1]
+
+        path = self._query(prefix, push, environ)
+
+        with self._lock:
+            # drop the expired entries while here.
+            for k, v in self._cache.items():
+                if v[0] <= now:
+                    del self._cache[k]
+            self._cache[key] = (now + self.ttl, path)
+        return path
+
+
+class GitServer(object):
+    """
+    The WSGI application serving the git services for workspaces, with
+    workspaces being addressed by their path relative to the Zope site.
+    """
+
+    services = services
+
+    def __init__(self, authorizer, handlers=None):
+        self.authorizer = authorizer
+        if handlers is None:
+            handlers = dict(DEFAULT_HANDLERS)
+        self.handlers = handlers
+
+    def _simple_response(self, start_response, status, headers=None):
+        start_response(status, [('Content-Type', 'text/plain')] +
+            (headers or []))
+        return [status]
+
+    def _input(self, environ):
+        stdin = environ['wsgi.input']
+        if environ.get(DECHUNK_KEY):
+            stdin = _ChunkedInput(stdin)
+        elif environ.get('HTTP_TRANSFER_ENCODING') != 'chunked':
+            # ensure EOF is seen at the end of the body.
+            stdin = _LengthLimited(stdin,
+                int(environ.get('CONTENT_LENGTH') or 0))
+        if environ.get('HTTP_CONTENT_ENCODING') == 'gzip':
+            stdin = GzipInput(stdin)
+        return stdin
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        pathinfo = environ.get('PATH_INFO', '')
+        handler, spath, match = match_service(
+            method, pathinfo, self.services)
+        if handler is None:
+            return self._simple_response(start_response, HTTP_NOT_FOUND)
+
+        prefix = pathinfo[:match.start()].rstrip('/')
+        push = is_push(method, pathinfo, environ.get('QUERY_STRING', ''))
+        receive = method == 'POST' and spath is push_patt
+        try:
+            path = self.authorizer(prefix, push, environ, event=receive)
+        except AuthorizationError as e:
+            return self._simple_response(start_response, e.status, e.headers)
+
+        env = dict(environ)
+        env['PATH_INFO'] = pathinfo[match.start():]
+        env['wsgi.input'] = self._input(environ)
+        env[URL_KEY] = application_uri(environ).rstrip('/') + prefix
+        # raises AuthorizationError unless the push is authorized.
+        env[PUSH_CHECK_KEY] = lambda: bool(
+            push or self.authorizer(prefix, True, environ))
+        backend = DulwichBackend(path)
+
+        if (handler in compressible_services and
+                accepts_gzip(environ.get('HTTP_ACCEPT_ENCODING'))):
+            response = GzipResponse(start_response)
+            req = HTTPGitRequest(env, response, dumb=False,
+                handlers=self.handlers)
+            for chunk in handler(req, backend, match):
+                response.write(chunk)
+            response.finish()
+            return []
+
+        if not receive:
+            req = HTTPGitRequest(env, start_response, dumb=False,
+                handlers=self.handlers)
+            try:
+                return handler(req, backend, match)
+            except AuthorizationError as e:
+                return self._simple_response(start_response, e.status,
+                    e.headers)
+
+        # The response for receive-pack is small, so buffer it such that
+        # the warning (if needed) is sent ahead of it.
+        buffered = _BufferedResponse()
+        req = HTTPGitRequest(env, buffered, dumb=False,
+            handlers=self.handlers)
+        frags = [f for f in handler(req, backend, match)]
+        result = buffered.out.getvalue() + ''.join(frags)
+        if buffered.status == HTTP_OK and not fix_head(path):
+            result = push_warning_pkt() + result
+        start_response(buffered.status, buffered.headers)
+        return [result]
+
+
+class _BufferedResponse(object):
+
+    status = None
+    headers = None
+
+    def __call__(self, status, headers):
+        self.status = status
+        self.headers = headers
+        self.out = StringIO()
+        return self.out.write
+
+
+class _LengthLimited(object):
+
+    def __init__(self, fileobj, length):
+        self.fileobj = fileobj
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return ''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+class _ChunkedInput(object):
+    """
+    Decode a request body sent with chunked transfer encoding, which
+    git uses for larger request bodies, as wsgiref does not.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.remaining = 0
+        self.eof = False
+
+    def _next_chunk(self):
+        line = self.fileobj.readline()
+        self.remaining = int(line.split(';', 1)[0].strip() or '0', 16)
+        if self.remaining == 0:
+            # consume the trailers.
+            while self.fileobj.readline().strip():
+                pass
+            self.eof = True
+
+    def read(self, size=-1):
+        result = []
+        while not self.eof and size != 0:
+            if self.remaining == 0:
+                self._next_chunk()
+                continue
+            want = self.remaining if size < 0 else min(size, self.remaining)
+            data = self.fileobj.read(want)
+            if not data:
+                self.eof = True
+                break
+            self.remaining -= len(data)
+            if self.remaining == 0:
+                # the CRLF terminating the chunk.
+                self.fileobj.readline()
+            result.append(data)
+            if size > 0:
+                size -= len(data)
+        return ''.join(result)
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class GitRequestHandler(WSGIRequestHandler):
+
+    def get_environ(self):
+        environ = WSGIRequestHandler.get_environ(self)
+        if environ.get('HTTP_TRANSFER_ENCODING') == 'chunked':
+            environ[DECHUNK_KEY] = True
+        return environ
+
+    def log_message(self, format, *args):
+        logger.info(format, *args)
+
+
+def make_app(zope_url, secret, ttl=30):
+    return GitServer(ZopeAuthorizer(zope_url, secret, ttl=ttl))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Standalone git smart HTTP server for PMR2.')
+    parser.add_argument('zope_url',
+        help='URL of the PMR2 site, e.g. http://localhost:8080/pmr2')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--ttl', type=int, default=30,
+        help='seconds to cache authorization results')
+    args = parser.parse_args(argv)
+
+    secret = os.environ.get(SECRET_ENV)
+    if not secret:
+        parser.error('%s must be set' % SECRET_ENV)
+
+    logging.basicConfig(level=logging.INFO)
+    server = make_server(args.host, args.port,
+        make_app(args.zope_url, secret, ttl=args.ttl),
+        server_class=ThreadingWSGIServer, handler_class=GitRequestHandler)
+    logger.info('serving on %s:%d', args.host, args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
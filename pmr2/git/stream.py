@@ -0,0 +1,365 @@
+"""
+Streaming and ranged reads of blobs.
+
+Reading a blob through pygit2 (or dulwich) inflates it into memory in
+full, which is not an option for the large files some workspaces carry.
+Loose objects and the objects stored whole within packs are instead
+inflated from their files as they are read.  Deltified objects have to
+be reconstructed in full, so large ones are inflated into a spill file
+among the derived data of the repository (through `git cat-file`, so
+not even this holds them in memory) and read from there, such that
+repeated range requests for them are served by seeking.
+"""
+
+import errno
+import logging
+import os
+import zlib
+from cStringIO import StringIO
+from os.path import join
+from subprocess import Popen, PIPE
+
+from dulwich.pack import PackFileDisappeared
+from dulwich.object_store import DiskObjectStore
+from dulwich.objects import object_class
+from pygit2 import Repository
+
+from . import maintenance
+
+CHUNK_SIZE = 1 << 16
+
+# Deltified blobs smaller than this are reconstructed in memory rather
+# than spilled, as that is cheaper.
+STREAM_THRESHOLD = 1 << 20
+
+# The most bytes of spill files kept for a repository; larger blobs are
+# read through from their start instead.
+SPILL_LIMIT = 1 << 30
+
+SPILL_KIND = 'blob'
+
+OFS_DELTA = 6
+REF_DELTA = 7
+
+logger = logging.getLogger('pmr2.git.stream')
+
+
+def _inflate(f, chunk_size=CHUNK_SIZE):
+    """
+    Yield the data inflated from the zlib stream read from the file.
+    """
+
+    d = zlib.decompressobj()
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        out = d.decompress(data, chunk_size)
+        while out:
+            yield out
+            if not d.unconsumed_tail:
+                break
+            out = d.decompress(d.unconsumed_tail, chunk_size)
+        if d.unused_data:
+            break
+    out = d.flush()
+    if out:
+        yield out
+
+
+def _varint(read):
+    # the little-endian base 128 sizes of deltas.
+    size = 0
+    shift = 0
+    while True:
+        c = ord(read(1))
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return size
+
+
+def _skip(chunks, count):
+    """
+    Return the chunks less their first count bytes.
+    """
+
+    for chunk in chunks:
+        if count >= len(chunk):
+            count -= len(chunk)
+            continue
+        yield chunk[count:]
+        count = 0
+
+
+def _head(chunks, count):
+    """
+    Return the first count bytes of the chunks.
+    """
+
+    for chunk in chunks:
+        if count <= 0:
+            return
+        yield chunk[:count]
+        count -= len(chunk)
+
+
+def _file_chunks(f, start, end, chunk_size=CHUNK_SIZE):
+    with f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = f.read(min(remaining, chunk_size))
+            if not data:
+                return
+            yield data
+            remaining -= len(data)
+
+
+def _loose_header(f):
+    # the (kind, size) of the loose object.
+    header = ''
+    for chunk in _inflate(f, 64):
+        header += chunk
+        if '\0' in header:
+            break
+    kind, size = header.split('\0', 1)[0].split(' ')
+    return kind, int(size)
+
+
+def _pack_entry(f):
+    # the (kind, size, base) of the entry at the position of the pack
+    # file, with base being the distance back to (or the sha of) the
+    # base of a delta.
+    c = ord(f.read(1))
+    kind = (c >> 4) & 7
+    size = c & 15
+    shift = 4
+    while c & 0x80:
+        c = ord(f.read(1))
+        size |= (c & 0x7f) << shift
+        shift += 7
+    base = None
+    if kind == OFS_DELTA:
+        c = ord(f.read(1))
+        base = c & 0x7f
+        while c & 0x80:
+            c = ord(f.read(1))
+            base = ((base + 1) << 7) | (c & 0x7f)
+    elif kind == REF_DELTA:
+        base = f.read(20).encode('hex')
+    return kind, size, base
+
+
+def _pack_header(f):
+    """
+    Return the (kind, size) of the object at the position of the pack
+    file, leaving it at the start of its data.  The size of a delta is
+    that of the object it results in.
+    """
+
+    kind, size, base = _pack_entry(f)
+    if kind in (OFS_DELTA, REF_DELTA):
+        offset = f.tell()
+        # the size of the object leads its delta, after that of the base.
+        read = StringIO(''.join(_head(_inflate(f, 64), 20))).read
+        _varint(read)
+        size = _varint(read)
+        f.seek(offset)
+    return kind, size
+
+
+def _stores(store):
+    yield store
+    # e.g. the object pool shared by a family of forks.
+    for alternate in store.alternates:
+        yield alternate
+
+
+def _locate(store, sha):
+    """
+    Return the (path, offset) of the object in the store, with offset
+    being None for loose objects.  Raises KeyError if it is missing.
+    """
+
+    for store in _stores(store):
+        path = join(store.path, sha[:2], sha[2:])
+        if os.path.isfile(path):
+            return path, None
+        for pack in store.packs:
+            try:
+                return pack._data_path, pack.index.object_index(sha)
+            except (KeyError, PackFileDisappeared):
+                # e.g. the pack just added, which dulwich reopens.
+                continue
+    raise KeyError(sha)
+
+
+def object_size(store, sha):
+    """
+    Return the size of the object of the dulwich DiskObjectStore as read
+    from the header of its loose or packed object, so it is not inflated
+    in full.  Raises KeyError if it is missing.
+    """
+
+    path, offset = _locate(store, sha)
+    with open(path, 'rb') as f:
+        if offset is None:
+            return _loose_header(f)[1]
+        f.seek(offset)
+        return _pack_header(f)[1]
+
+
+def object_type(store, sha):
+    """
+    Return the type number of the object of the dulwich DiskObjectStore
+    as read from the headers of its loose or packed object (following
+    the bases of deltas), so it is not inflated.  Raises KeyError if it
+    is missing.
+    """
+
+    path, offset = _locate(store, sha)
+    with open(path, 'rb') as f:
+        if offset is None:
+            return object_class(_loose_header(f)[0]).type_num
+        while True:
+            f.seek(offset)
+            kind, size, base = _pack_entry(f)
+            if kind == OFS_DELTA:
+                offset -= base
+            elif kind == REF_DELTA:
+                return object_type(store, base)
+            else:
+                return kind
+
+
+class BlobStream(object):
+    """
+    The contents of a blob of the repository at path (its git directory)
+    read in chunks, in full or by byte range, without holding it in
+    memory.  Raises KeyError if the blob is not in the repository.
+    """
+
+    def __init__(self, path, sha, derived=None):
+        self.path = path
+        self.sha = sha
+        self.derived = derived
+        self._locate()
+
+    def _locate(self):
+        self._source, offset = _locate(
+            DiskObjectStore(join(self.path, 'objects')), self.sha)
+        with open(self._source, 'rb') as f:
+            if offset is None:
+                kind, self.size = _loose_header(f)
+                if kind != 'blob':
+                    raise KeyError(self.sha)
+                self._offset = None
+                self.deltified = False
+                return
+            f.seek(offset)
+            kind, self.size = _pack_header(f)
+            if kind not in (3, OFS_DELTA, REF_DELTA):
+                raise KeyError(self.sha)
+            self._offset = f.tell()
+            self.deltified = kind in (OFS_DELTA, REF_DELTA)
+
+    def _git_chunks(self):
+        # the blob inflated by git, which does not hold it in memory.
+        p = Popen([maintenance.git_executable, 'cat-file', 'blob', self.sha],
+            stdout=PIPE, env=dict(os.environ, GIT_DIR=self.path))
+        try:
+            for chunk in iter(lambda: p.stdout.read(CHUNK_SIZE), ''):
+                yield chunk
+        finally:
+            p.stdout.close()
+            returncode = p.wait()
+        if returncode != 0:
+            raise KeyError(self.sha)
+
+    def _spill(self):
+        """
+        Return the spill file of the blob opened, inflating it first if
+        needed, or None if the blob is too large to be spilled.
+        """
+
+        f = self.derived.open(SPILL_KIND, self.sha)
+        if f is not None or self.size > SPILL_LIMIT:
+            return f
+        if maintenance.git_executable:
+            self.derived.put_chunks(SPILL_KIND, self.sha, self._git_chunks())
+        else:
+            self.derived.put(SPILL_KIND, self.sha,
+                Repository(self.path)[self.sha].read_raw())
+        # opened before the others are trimmed, which it is kept out of.
+        f = self.derived.open(SPILL_KIND, self.sha)
+        self.derived.trim(SPILL_KIND, SPILL_LIMIT, keep=[self.sha])
+        return f
+
+    def _streamed(self, start, end):
+        # read through from the start of the blob.
+        if not self.deltified:
+            chunks = self._chunks()
+        elif maintenance.git_executable:
+            chunks = self._git_chunks()
+        else:
+            data = Repository(self.path)[self.sha].read_raw()
+            return iter([data[start:end]])
+        return _head(_skip(chunks, start), end - start)
+
+    def _spilled(self, start, end):
+        f = self._spill()
+        if f is None:
+            # too large to spill, or trimmed away by another reader.
+            return self._streamed(start, end)
+        return _file_chunks(f, start, end)
+
+    def _chunks(self):
+        f = open(self._source, 'rb')
+        with f:
+            if self._offset is None:
+                # the header of a loose object is part of its data.
+                header = len('blob %d\0' % self.size)
+                for chunk in _skip(_inflate(f), header):
+                    yield chunk
+            else:
+                f.seek(self._offset)
+                for chunk in _inflate(f):
+                    yield chunk
+
+    def read_range(self, start=0, end=None):
+        """
+        Return an iterator of the chunks of the blob from the byte at
+        start up to (not including) end, or its end.
+        """
+
+        if end is None or end > self.size:
+            end = self.size
+        if start >= end:
+            return iter([])
+        if self.deltified:
+            if self.size < STREAM_THRESHOLD or self.derived is None:
+                data = Repository(self.path)[self.sha].read_raw()
+                return iter([data[start:end]])
+            return self._spilled(start, end)
+        return self._streamed(start, end)
+
+    def read_at(self, start=0, end=None):
+        """
+        As read_range, but with large blobs read from their spill file,
+        so reads from far into them take no longer than from the start.
+        """
+
+        if end is None or end > self.size:
+            end = self.size
+        if start >= end:
+            return iter([])
+        if self.size < STREAM_THRESHOLD or self.derived is None:
+            return self.read_range(start, end)
+        return self._spilled(start, end)
+
+    def __iter__(self):
+        return self.read_range()
+
+    def read(self, start=0, end=None):
+        return ''.join(self.read_range(start, end))
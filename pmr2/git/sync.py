@@ -0,0 +1,179 @@
+"""
+Running many workspace syncs concurrently.
+"""
+
+import logging
+import threading
+import time
+from urlparse import urlsplit
+
+from dulwich.client import default_urllib3_manager
+
+logger = logging.getLogger('pmr2.git.sync')
+
+# Local paths (other workspaces on this server) are grouped as one host.
+LOCAL_HOST = ''
+
+# The keep-alive connections kept open for each remote host, which also
+# bounds the concurrent requests to it (further ones wait for a free
+# connection).
+HTTP_MAXSIZE = 4
+HTTP_NUM_POOLS = 32
+
+_pool_manager = None
+_pool_manager_guard = threading.Lock()
+
+_repo_locks = {}
+_repo_locks_guard = threading.Lock()
+
+_last_seen = {}
+_last_seen_guard = threading.Lock()
+
+
+def repo_lock(path):
+    """
+    Return the lock that serializes the syncs of the repository at path
+    within this process.
+    """
+
+    with _repo_locks_guard:
+        lock = _repo_locks.get(path)
+        if lock is None:
+            lock = _repo_locks[path] = threading.Lock()
+        return lock
+
+
+def last_seen(path, identifier):
+    """
+    Return the (remote, local, message) recorded by the last successful
+    sync of the repository at path with identifier, or None.
+    """
+
+    with _last_seen_guard:
+        return _last_seen.get((path, identifier))
+
+
+def record_seen(path, identifier, remote, local, message):
+    """
+    Record the remote and local commits after a successful sync, along
+    with the message it returned.
+    """
+
+    with _last_seen_guard:
+        _last_seen[(path, identifier)] = (remote, local, message)
+
+
+def http_pool_manager():
+    """
+    Return the urllib3 pool manager shared by the syncs with remote
+    hosts, so the connections (and their TLS sessions) are reused
+    across syncs rather than set up for each.
+    """
+
+    global _pool_manager
+    with _pool_manager_guard:
+        if _pool_manager is None:
+            _pool_manager = default_urllib3_manager(None,
+                num_pools=HTTP_NUM_POOLS, maxsize=HTTP_MAXSIZE, block=True)
+        return _pool_manager
+
+
+def host_of(identifier):
+    """
+    Return the host the identifier of a remote refers to.
+    """
+
+    if identifier.startswith('/'):
+        return LOCAL_HOST
+    return urlsplit(identifier).netloc.lower()
+
+
+class SyncResult(object):
+    """
+    The outcome of syncing the repository at path with identifier.
+    """
+
+    def __init__(self, path, identifier):
+        self.path = path
+        self.identifier = identifier
+        self.success = False
+        self.message = None
+        self.error = None
+        self.duration = None
+
+    def __repr__(self):
+        return '<SyncResult %s %s: %s>' % (self.path,
+            self.success and 'ok' or 'failed', self.message or self.error)
+
+
+class BulkSync(object):
+    """
+    Run sync(path, identifier) for each job in a bounded pool of
+    threads, with no more than max_per_host jobs against the same host
+    at a time and no more than one job per repository in the batch.
+
+    sync must return the (success, message) tuple like syncIdentifier
+    does, or raise an exception which is recorded as the error of the
+    job.
+    """
+
+    def __init__(self, sync, max_workers=8, max_per_host=4):
+        self.sync = sync
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+
+    def __call__(self, jobs):
+        results = [SyncResult(path, identifier) for path, identifier in jobs]
+        self._pending = list(results)
+        self._hosts = {}
+        self._paths = set()
+        self._cond = threading.Condition()
+
+        workers = [threading.Thread(target=self._work)
+            for i in range(min(self.max_workers, len(results)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results
+
+    def _next(self):
+        # the first pending job with its host and repository free.
+        for i, result in enumerate(self._pending):
+            host = host_of(result.identifier)
+            if (self._hosts.get(host, 0) < self.max_per_host and
+                    result.path not in self._paths):
+                self._hosts[host] = self._hosts.get(host, 0) + 1
+                self._paths.add(result.path)
+                return self._pending.pop(i), host
+        return None, None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._pending:
+                        return
+                    result, host = self._next()
+                    if result is not None:
+                        break
+                    self._cond.wait()
+
+            self._run(result)
+
+            with self._cond:
+                self._hosts[host] -= 1
+                self._paths.discard(result.path)
+                self._cond.notify_all()
+
+    def _run(self, result):
+        start = time.time()
+        try:
+            result.success, result.message = self.sync(
+                result.path, result.identifier)
+        except Exception as e:
+            logger.info('failed to sync %s with %s: %s',
+                result.path, result.identifier, e)
+            result.error = '%s: %s' % (e.__class__.__name__, e)
+        result.duration = time.time() - start
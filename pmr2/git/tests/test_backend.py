@@ -0,0 +1,91 @@
+import unittest
+import tempfile
+import shutil
+import os
+from os.path import join
+from cStringIO import StringIO
+
+from dulwich.objects import Blob, Commit, Tree
+from dulwich.pack import write_pack_objects
+
+from pmr2.git.backend import DulwichBackend
+from pmr2.git.backend import SpoolingObjectStore
+
+from pmr2.git.tests import util
+
+
+class SpoolingObjectStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        util.extract_archive(self.testdir)
+        self.path = join(self.testdir, 'simple1', '.git')
+        self.head = 'bfdd13c821b614d2b5e7d5b10c3ff70147c5107a'
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def make_pack(self, store):
+        parent = store[self.head]
+        blob = Blob.from_string('new file\n' * 1000)
+        tree = Tree()
+        for entry in store[parent.tree].items():
+            tree.add(entry.path, entry.mode, entry.sha)
+        tree.add('new', 0o100644, blob.id)
+        commit = Commit()
+        commit.tree = tree.id
+        commit.parents = [parent.id]
+        commit.author = commit.committer = 'user <user@example.com>'
+        commit.author_time = commit.commit_time = parent.commit_time + 1
+        commit.author_timezone = commit.commit_timezone = 0
+        commit.message = 'new commit\n'
+        out = StringIO()
+        write_pack_objects(out, [(o, None) for o in (blob, tree, commit)])
+        return out.getvalue(), commit.id
+
+    def assertSpoolRemoved(self, store):
+        self.assertEqual([n for n in os.listdir(store.pack_dir)
+            if n.startswith('tmp_spool_')], [])
+
+    def test_0000_backend_store(self):
+        repo = DulwichBackend(self.path).open_repository('/')
+        self.assertTrue(isinstance(repo.object_store, SpoolingObjectStore))
+
+    def test_0100_add_thin_pack(self):
+        store = DulwichBackend(self.path).repo.object_store
+        if store.git_executable is None:
+            return
+        data, sha = self.make_pack(store)
+        stream = StringIO(data)
+        store.add_thin_pack(stream.read, None)
+        self.assertEqual(store[sha].message, 'new commit\n')
+        self.assertSpoolRemoved(store)
+
+    def test_0110_add_thin_pack_dulwich(self):
+        store = DulwichBackend(self.path).repo.object_store
+        store.git_executable = None
+        data, sha = self.make_pack(store)
+        stream = StringIO(data)
+        store.add_thin_pack(stream.read, None)
+        self.assertEqual(store[sha].message, 'new commit\n')
+        self.assertSpoolRemoved(store)
+
+    def test_0120_add_thin_pack_failure(self):
+        store = DulwichBackend(self.path).repo.object_store
+        if store.git_executable is None:
+            return
+        data, sha = self.make_pack(store)
+        stream = StringIO(data[:-30])
+        self.assertRaises(IOError, store.add_thin_pack, stream.read, None)
+        self.assertFalse(sha in store)
+        self.assertSpoolRemoved(store)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(SpoolingObjectStoreTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
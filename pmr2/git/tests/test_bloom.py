@@ -0,0 +1,143 @@
+import unittest
+import tempfile
+import shutil
+from os.path import join
+
+from pygit2 import Repository
+from pygit2 import Signature
+from pygit2 import GIT_FILEMODE_BLOB, GIT_FILEMODE_TREE
+
+from pmr2.git import bloom
+from pmr2.git.bloom import KIND, MAX_CHANGED_PATHS
+from pmr2.git.bloom import ChangedPathIndex
+from pmr2.git.bloom import changed_paths, make_filter, maybe_contains
+from pmr2.git.derived import DerivedData
+
+from pmr2.git.tests import util
+
+
+class BloomTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        util.extract_archive(self.testdir)
+        self.path = join(self.testdir, 'simple1', '.git')
+        self.repo = Repository(self.path)
+        self.derived = DerivedData(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def _commit(self, name, data, ref='refs/heads/master'):
+        # commit the file at name (in the directory dir) onto the ref.
+        head = self.repo.revparse_single(ref)
+        builder = self.repo.TreeBuilder(head.tree)
+        sub = self.repo.TreeBuilder()
+        sub.insert(name, self.repo.create_blob(data), GIT_FILEMODE_BLOB)
+        builder.insert('dir', sub.write(), GIT_FILEMODE_TREE)
+        sig = Signature('user', 'user@example.com', 1400000000, 0)
+        return self.repo.create_commit(ref, sig, sig, 'commit',
+            builder.write(), [head.oid]).hex
+
+    def test_0000_filter(self):
+        paths = ['file%d' % i for i in range(100)]
+        bloom = make_filter(paths)
+        self.assertEqual(len(bloom), 125)
+        for path in paths:
+            self.assertTrue(maybe_contains(bloom, path))
+        false = sum(maybe_contains(bloom, 'other%d' % i)
+            for i in range(1000))
+        self.assertTrue(false < 50)
+
+    def test_0001_filter_empty(self):
+        bloom = make_filter([])
+        self.assertEqual(bloom, '\x00')
+        self.assertFalse(maybe_contains(bloom, 'file'))
+        # too many changed paths for a filter, so everything may be.
+        bloom = make_filter(['file%d' % i
+            for i in range(MAX_CHANGED_PATHS + 1)])
+        self.assertEqual(bloom, '')
+        self.assertTrue(maybe_contains(bloom, 'file'))
+
+    def test_0010_changed_paths(self):
+        head = self._commit('file', 'data\n')
+        self.assertEqual(changed_paths(self.repo, self.repo[head]),
+            set(['dir', 'dir/file']))
+        root = list(self.repo.walk(head))[-1]
+        self.assertEqual(changed_paths(self.repo, root),
+            set(root.tree[i].name for i in range(len(root.tree))))
+
+    def test_0011_changed_paths_limit(self):
+        head = self.repo.revparse_single('HEAD')
+        builder = self.repo.TreeBuilder(head.tree)
+        sub = self.repo.TreeBuilder()
+        blob = self.repo.create_blob('data\n')
+        for i in range(MAX_CHANGED_PATHS * 2):
+            sub.insert('file%d' % i, blob, GIT_FILEMODE_BLOB)
+        builder.insert('dir', sub.write(), GIT_FILEMODE_TREE)
+        sig = Signature('user', 'user@example.com', 1400000000, 0)
+        commit = self.repo[self.repo.create_commit(None, sig, sig, 'commit',
+            builder.write(), [head.oid])]
+        # no more are looked for than could be in a filter.
+        paths = changed_paths(self.repo, commit)
+        self.assertEqual(len(paths), MAX_CHANGED_PATHS + 1)
+        self.assertEqual(make_filter(paths), '')
+
+    def test_0100_index(self):
+        index = ChangedPathIndex(self.derived)
+        self.assertEqual(index.filters, {})
+        head = self.repo.revparse_single('HEAD').hex
+        self.assertTrue(index.maybe_changed(head, 'missing'))
+        count = len(list(self.repo.walk(head)))
+        self.assertEqual(index.update(self.repo), count)
+        self.assertFalse(index.maybe_changed(head, 'missing'))
+
+        index = ChangedPathIndex(self.derived)
+        self.assertEqual(len(index.filters), count)
+        self.assertFalse(index.maybe_changed(head, 'missing'))
+        self.assertEqual(index.update(self.repo), 0)
+
+    def test_0110_index_incremental(self):
+        ChangedPathIndex(self.derived).update(self.repo)
+        master = self._commit('file', 'data\n')
+        self.repo.create_branch('other', self.repo[master])
+        other = self._commit('other', 'data\n', 'refs/heads/other')
+
+        index = ChangedPathIndex(self.derived)
+        self.assertEqual(index.update(self.repo), 2)
+        self.assertTrue(index.maybe_changed(master, 'dir/file'))
+        self.assertTrue(index.maybe_changed(master, 'dir'))
+        self.assertFalse(index.maybe_changed(master, 'README'))
+        self.assertTrue(index.maybe_changed(other, 'dir/other'))
+        self.assertEqual(len(ChangedPathIndex(self.derived).filters),
+            len(index.filters))
+        self.assertEqual(sorted(self.derived.keys(KIND)),
+            ['filters', 'tips'])
+
+    def test_0120_cache_bounded(self):
+        ChangedPathIndex(self.derived).update(self.repo)
+        bloom._cache.clear()
+        self.addCleanup(setattr, bloom, 'MAX_REPOSITORIES',
+            bloom.MAX_REPOSITORIES)
+        bloom.MAX_REPOSITORIES = 2
+        paths = []
+        for i in range(3):
+            path = join(self.testdir, 'copy%d' % i)
+            shutil.copytree(self.path, path)
+            paths.append(path)
+            ChangedPathIndex(DerivedData(path))
+            self.assertTrue(len(bloom._cache) <= 2)
+        # what was dropped is loaded again when needed.
+        index = ChangedPathIndex(DerivedData(paths[0]))
+        self.assertEqual(len(index.filters),
+            len(ChangedPathIndex(self.derived).filters))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(BloomTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,263 @@
+import unittest
+import tempfile
+import shutil
+import json
+import os
+import time
+import zipfile
+from cStringIO import StringIO
+from os.path import join
+
+import zope.interface
+from zope.component.hooks import getSiteManager
+from zope.component.tests import clearZCML
+
+from pygit2 import Repository
+from pygit2 import Signature
+from pygit2 import GIT_FILEMODE_BLOB
+
+from dulwich.repo import Repo
+
+from pmr2.app.settings.interfaces import IPMR2GlobalSettings
+from pmr2.app.workspace.event import Push
+
+from pmr2.git import derived
+from pmr2.git.bloom import ChangedPathIndex
+from pmr2.git.derived import DerivedData, archive_key
+from pmr2.git.derived import prewarm, push_in_progress
+from pmr2.git.largefile import ROOT_ENV, LargeFileIndex, LargeFileStore
+from pmr2.git.largefile import make_pointer
+from pmr2.git.maintenance import MaintenanceQueue
+from pmr2.git.partial import set_promisor
+
+from pmr2.git.tests import util
+
+
+class Settings(object):
+    zope.interface.implements(IPMR2GlobalSettings)
+
+    def dirOf(self, obj):
+        return obj.path
+
+
+class Workspace(object):
+
+    def __init__(self, path, id):
+        self.path = path
+        self.id = id
+
+
+class DerivedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        util.extract_archive(self.testdir)
+        self.path = join(self.testdir, 'simple1', '.git')
+        self.repo = Repository(self.path)
+        self.derived = DerivedData(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def _commit(self, name, data):
+        head = self.repo.revparse_single('HEAD')
+        builder = self.repo.TreeBuilder(head.tree)
+        builder.insert(name, self.repo.create_blob(data), GIT_FILEMODE_BLOB)
+        sig = Signature('user', 'user@example.com', 1400000000, 0)
+        return self.repo.create_commit('refs/heads/master', sig, sig,
+            'commit', builder.write(), [head.oid]).hex
+
+    def test_0000_get_put(self):
+        self.assertEqual(self.derived.get('kind', 'key'), None)
+        self.assertEqual(self.derived.keys('kind'), [])
+        self.derived.put('kind', 'key', 'value')
+        self.derived.put('kind', 'other', 'value2')
+        self.assertEqual(self.derived.get('kind', 'key'), 'value')
+        self.assertEqual(self.derived.keys('kind'), ['key', 'other'])
+        self.derived.remove('kind', 'key')
+        self.derived.remove('kind', 'key')
+        self.assertEqual(self.derived.keys('kind'), ['other'])
+
+    def test_0001_trim(self):
+        self.derived.put_chunks('kind', 'a', ['12', '34'])
+        self.derived.put('kind', 'b', '5678')
+        self.derived.put('kind', 'c', '9012')
+        self.assertEqual(self.derived.get('kind', 'a'), '1234')
+        past = time.time() - 10
+        os.utime(join(self.derived.path, 'kind', 'a'), (past, past))
+        os.utime(join(self.derived.path, 'kind', 'b'), (past + 1, past + 1))
+        # opening an entry marks it as used.
+        self.derived.open('kind', 'a').close()
+        self.derived.trim('kind', 8)
+        self.assertEqual(self.derived.keys('kind'), ['a', 'c'])
+        self.assertEqual(self.derived.open('kind', 'b'), None)
+        # the keys to keep are kept regardless.
+        self.derived.trim('kind', 0, keep=['a'])
+        self.assertEqual(self.derived.keys('kind'), ['a'])
+
+    def test_0002_writing(self):
+        with self.derived.writing('kind', 'a') as f:
+            f.write('12')
+            self.assertEqual(self.derived.get('kind', 'a'), None)
+        self.assertEqual(self.derived.get('kind', 'a'), '12')
+        try:
+            with self.derived.writing('kind', 'b') as f:
+                f.write('34')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(os.listdir(join(self.derived.path, 'kind')), ['a'])
+
+    def test_0010_tree_sizes(self):
+        tree = self.repo.revparse_single('HEAD').tree
+        sizes = self.derived.tree_sizes(self.repo, tree)
+        self.assertEqual(sorted(sizes), ['README', 'test1', 'test2', 'test3'])
+        self.assertEqual(sizes['README'], self.repo[tree['README'].oid].size)
+        self.assertEqual(json.loads(self.derived.get('sizes', tree.hex)),
+            sizes)
+        # the stored sizes are used from then on.
+        self.derived.put('sizes', tree.hex, json.dumps({'README': 1}))
+        self.assertEqual(self.derived.tree_sizes(self.repo, tree),
+            {'README': 1})
+
+    def test_0020_mimetype(self):
+        blob = self.repo[self.repo.revparse_single('HEAD').tree['README'].oid]
+        result = self.derived.mimetype(blob, derived.Magic(mime=True))
+        self.assertTrue(result.startswith('text/plain'))
+        self.assertEqual(self.derived.get('mimetype', blob.hex), result)
+
+    def test_0030_push_in_progress(self):
+        self.assertFalse(push_in_progress(self.path))
+        pack_dir = join(self.path, 'objects', 'pack')
+        if not os.path.isdir(pack_dir):
+            os.makedirs(pack_dir)
+        open(join(pack_dir, 'tmp_spool_abc'), 'w').close()
+        self.assertTrue(push_in_progress(self.path))
+        self.assertFalse(push_in_progress(join(self.testdir, 'missing')))
+        # left over from a failed push.
+        past = time.time() - derived.STALE_PUSH - 1
+        os.utime(join(pack_dir, 'tmp_spool_abc'), (past, past))
+        self.assertFalse(push_in_progress(self.path))
+
+    def test_0100_prewarm(self):
+        head = self.repo.revparse_single('HEAD')
+        self.assertEqual(prewarm(self.path, 'simple1'), head.hex)
+        self.assertEqual(sorted(json.loads(
+            self.derived.get('sizes', head.tree.hex))),
+            ['README', 'test1', 'test2', 'test3'])
+        self.assertEqual(len(self.derived.keys('mimetype')), 4)
+        self.assertEqual(self.derived.keys('archive'), [
+            archive_key(head.hex, 'simple1', 'tgz'),
+            archive_key(head.hex, 'simple1', 'zip'),
+        ])
+        archive = zipfile.ZipFile(StringIO(self.derived.get('archive',
+            archive_key(head.hex, 'simple1', 'zip'))))
+        self.assertEqual(sorted(archive.namelist()), [
+            'simple1-%s/%s' % (head.hex[:12], name)
+            for name in ['README', 'test1', 'test2', 'test3']])
+
+    def test_0110_prewarm_replaces_archives(self):
+        prewarm(self.path, 'simple1')
+        head = self._commit('test4.txt', 'test4\n')
+        self.assertEqual(prewarm(self.path, 'simple1'), head)
+        self.assertEqual(self.derived.keys('archive'), [
+            archive_key(head, 'simple1', 'tgz'),
+            archive_key(head, 'simple1', 'zip'),
+        ])
+        # the content type is known from the name of the new file.
+        self.assertEqual(len(self.derived.keys('mimetype')), 4)
+
+    def test_0120_prewarm_submodule(self):
+        path = join(self.testdir, 'import1', '.git')
+        prewarm(path, 'import1')
+        self.assertEqual(len(DerivedData(path).keys('archive')), 2)
+
+    def test_0130_prewarm_partial(self):
+        set_promisor(Repo(self.path), 'http://example.com/simple1')
+        prewarm(self.path, 'simple1')
+        self.assertEqual(self.derived.keys('archive'), [])
+        self.assertEqual(len(self.derived.keys('mimetype')), 4)
+
+    def test_0150_prewarm_large_files(self):
+        store = LargeFileStore(join(self.testdir, 'lfs'))
+        oid, size = store.add(iter(['large contents\n' * 100]))
+        head = self._commit('large', make_pointer(oid, size))
+        tree = self.repo[head].tree
+        # the sizes of the pointers are the sizes of the files, in the
+        # large file mode only.
+        self.assertEqual(self.derived.tree_sizes(self.repo, tree)['large'],
+            len(make_pointer(oid, size)))
+        os.environ[ROOT_ENV] = store.root
+        self.addCleanup(os.environ.pop, ROOT_ENV)
+        self.assertEqual(self.derived.tree_sizes(self.repo, tree)['large'],
+            size)
+
+        prewarm(self.path, 'simple1')
+        self.assertTrue(oid in LargeFileIndex(self.derived))
+        # the type of the pointer is not that of the file.
+        self.assertEqual(len(self.derived.keys('mimetype')), 4)
+        archive = zipfile.ZipFile(StringIO(self.derived.get('archive',
+            archive_key(head, 'simple1', 'zip'))))
+        self.assertEqual(archive.read('simple1-%s/large' % head[:12]),
+            'large contents\n' * 100)
+
+    def test_0160_prewarm_changed_paths(self):
+        prewarm(self.path, 'simple1')
+        index = ChangedPathIndex(self.derived)
+        commits = [c.hex for c in self.repo.walk(
+            self.repo.revparse_single('HEAD').hex)]
+        self.assertEqual(sorted(index.filters), sorted(commits))
+        # only the new commit is added after another push.
+        head = self._commit('test4.txt', 'test4\n')
+        prewarm(self.path, 'simple1')
+        self.assertEqual(sorted(ChangedPathIndex(self.derived).filters),
+            sorted(commits + [head]))
+
+    def test_0140_prewarm_empty(self):
+        path = join(self.testdir, 'empty.git')
+        Repo.init_bare(path, mkdir=True)
+        self.assertEqual(prewarm(path, 'empty'), None)
+
+
+class PrewarmQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = derived.queue
+        self.prewarmed = []
+        self.testdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        derived.queue = self.queue
+        shutil.rmtree(self.testdir)
+
+    def schedule(self, item, delay=None):
+        self.prewarmed.append(item)
+
+    def test_0000_push_in_progress(self):
+        derived.queue = self
+        pack_dir = join(self.testdir, 'objects', 'pack')
+        os.makedirs(pack_dir)
+        open(join(pack_dir, 'tmp_pack_abc'), 'w').close()
+        derived._prewarm((self.testdir, 'w'))
+        # to be tried again after the push.
+        self.assertEqual(self.prewarmed, [(self.testdir, 'w')])
+
+    def test_0010_workspace_pushed(self):
+        clearZCML()
+        getSiteManager().registerUtility(Settings(), IPMR2GlobalSettings)
+        self.addCleanup(clearZCML)
+        derived.queue = MaintenanceQueue(delay=60,
+            maintain=self.prewarmed.append)
+        derived.workspace_pushed(Push(Workspace('/w/a', 'a')))
+        self.assertEqual(derived.queue.pending(), [('/w/a/.git', 'a')])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(DerivedTestCase))
+    suite.addTest(makeSuite(PrewarmQueueTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
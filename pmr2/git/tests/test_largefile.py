@@ -0,0 +1,158 @@
+import unittest
+import tempfile
+import shutil
+import os
+import hashlib
+from os.path import join
+
+from pygit2 import init_repository
+from pygit2 import Signature
+from pygit2 import GIT_FILEMODE_BLOB
+
+from pmr2.git.derived import DerivedData
+from pmr2.git.largefile import MAX_ENV, ROOT_ENV
+from pmr2.git.largefile import LargeFileIndex, LargeFileStore
+from pmr2.git.largefile import large_file_store
+from pmr2.git.largefile import parse_pointer, make_pointer, read_pointer
+
+
+class LargeFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.repo = init_repository(join(self.testdir, 'repo'), bare=True)
+        self.store = LargeFileStore(join(self.testdir, 'lfs'))
+        self.environ = dict(os.environ)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.testdir)
+
+    def test_0000_pointer(self):
+        oid = hashlib.sha256('data').hexdigest()
+        pointer = make_pointer(oid, 4)
+        self.assertEqual(pointer,
+            'version https://git-lfs.github.com/spec/v1\n'
+            'oid sha256:%s\n'
+            'size 4\n' % oid)
+        self.assertEqual(parse_pointer(pointer), (oid, 4))
+        self.assertEqual(parse_pointer(pointer + 'x-extension 1\n'),
+            (oid, 4))
+        self.assertEqual(read_pointer(self.repo[
+            self.repo.create_blob(pointer)]), (oid, 4))
+
+    def test_0001_not_pointer(self):
+        oid = hashlib.sha256('data').hexdigest()
+        self.assertEqual(parse_pointer(''), None)
+        self.assertEqual(parse_pointer('data'), None)
+        self.assertEqual(parse_pointer(make_pointer(oid[1:], 4)), None)
+        self.assertEqual(parse_pointer(make_pointer(oid.upper(), 4)), None)
+        self.assertEqual(parse_pointer(
+            make_pointer(oid, 4).replace('size 4', 'size -4')), None)
+        self.assertEqual(parse_pointer(
+            make_pointer(oid, 4).replace('spec/v1', 'spec/v2')), None)
+        self.assertEqual(parse_pointer(make_pointer(oid, 4) + ' ' * 1024),
+            None)
+
+    def test_0010_store(self):
+        oid, size = self.store.add(iter(['da', 'ta']))
+        self.assertEqual(oid, hashlib.sha256('data').hexdigest())
+        self.assertEqual(size, 4)
+        self.assertTrue(self.store.has(oid))
+        with self.store.open(oid) as f:
+            self.assertEqual(f.read(), 'data')
+        self.assertEqual(self.store.path(oid),
+            join(self.testdir, 'lfs', oid[:2], oid[2:4], oid))
+        self.assertEqual(self.store.open('0' * 64), None)
+        self.assertFalse(self.store.has('0' * 64))
+        self.assertEqual(os.listdir(join(self.testdir, 'lfs', 'tmp')), [])
+
+    def test_0011_store_mismatch(self):
+        self.assertRaises(ValueError, self.store.add, iter(['data']),
+            oid='0' * 64)
+        oid = hashlib.sha256('data').hexdigest()
+        self.assertRaises(ValueError, self.store.add, iter(['data']),
+            oid=oid, size=5)
+        self.assertFalse(self.store.has(oid))
+        self.assertEqual(os.listdir(join(self.testdir, 'lfs', 'tmp')), [])
+
+    def test_0012_store_maximum(self):
+        store = LargeFileStore(join(self.testdir, 'lfs'), maximum=4)
+        self.assertEqual(store.add(iter(['da', 'ta']))[1], 4)
+        self.assertRaises(ValueError, store.add, iter(['dat', 'ax']))
+        self.assertFalse(store.has(hashlib.sha256('datax').hexdigest()))
+        self.assertEqual(os.listdir(join(self.testdir, 'lfs', 'tmp')), [])
+
+    def test_0020_resolve(self):
+        small = self.repo[self.repo.create_blob('small')]
+        self.assertEqual(self.store.resolve(small), None)
+
+        data = ''.join(chr(i % 256) for i in range(1000))
+        oid, size = self.store.add(iter([data]))
+        blob = self.repo[self.repo.create_blob(make_pointer(oid, size))]
+        large = self.store.resolve(blob)
+        self.assertEqual(large.sha, oid)
+        self.assertEqual(large.size, 1000)
+        self.assertEqual(large.read(), data)
+        self.assertEqual(''.join(large), data)
+        self.assertEqual(large.read(10, 20), data[10:20])
+        self.assertEqual(''.join(large.read_at(990)), data[990:])
+        self.assertEqual(large.read(1000), '')
+
+    def test_0021_resolve_missing(self):
+        blob = self.repo[self.repo.create_blob(make_pointer('0' * 64, 4))]
+        large = self.store.resolve(blob)
+        self.assertEqual(large.size, 4)
+        self.assertRaises(KeyError, large.read)
+
+    def test_0030_large_file_store(self):
+        os.environ.pop(ROOT_ENV, None)
+        self.assertEqual(large_file_store(), None)
+        os.environ[ROOT_ENV] = join(self.testdir, 'lfs')
+        self.assertEqual(large_file_store().root, join(self.testdir, 'lfs'))
+        self.assertEqual(large_file_store().maximum, 1 << 32)
+        os.environ[MAX_ENV] = '2000'
+        self.assertEqual(large_file_store().maximum, 2000)
+
+    def _commit(self, name, data, parents=()):
+        builder = self.repo.TreeBuilder()
+        builder.insert(name, self.repo.create_blob(data), GIT_FILEMODE_BLOB)
+        sig = Signature('user', 'user@example.com', 1400000000, 0)
+        return self.repo.create_commit('refs/heads/master', sig, sig,
+            'commit', builder.write(), list(parents))
+
+    def test_0100_index(self):
+        index = LargeFileIndex(DerivedData(self.testdir))
+        oid = hashlib.sha256('data').hexdigest()
+        self.assertFalse(oid in index)
+        self.assertEqual(index.update(self.repo), 0)
+        head = self._commit('large', make_pointer(oid, 4))
+        other = hashlib.sha256('other').hexdigest()
+        self._commit('other', make_pointer(other, 5), [head])
+        self.assertEqual(index.update(self.repo), 2)
+        self.assertTrue(oid in index)
+        self.assertTrue(other in index)
+        self.assertEqual(index.update(self.repo), 0)
+
+        index.add('0' * 64)
+        self.assertTrue('0' * 64 in LargeFileIndex(DerivedData(self.testdir)))
+
+    def test_0110_index_referenced(self):
+        index = LargeFileIndex(DerivedData(self.testdir))
+        oid = hashlib.sha256('data').hexdigest()
+        head = self._commit('large', make_pointer(oid, 4))
+        self._commit('small', 'data', [head])
+        # looked for in the new commits when not known.
+        self.assertTrue(index.referenced(oid, self.repo))
+        self.assertFalse(index.referenced('0' * 64, self.repo))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(LargeFileTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+import tempfile
+import shutil
+from os.path import join
+
+from pygit2 import Repository
+
+from pmr2.git import stream
+from pmr2.git.derived import DerivedData
+from pmr2.git.lines import INDEX_KIND, LineIndex
+from pmr2.git.stream import BlobStream
+
+from pmr2.git.tests import util
+
+
+class LineIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        util.extract_archive(self.testdir)
+        self.path = join(self.testdir, 'simple1', '.git')
+        self.repo = Repository(self.path)
+        self.derived = DerivedData(self.path)
+        self.threshold = stream.STREAM_THRESHOLD
+
+    def tearDown(self):
+        stream.STREAM_THRESHOLD = self.threshold
+        shutil.rmtree(self.testdir)
+
+    def _index(self, data, derived=True):
+        sha = self.repo.create_blob(data).hex
+        return LineIndex(BlobStream(self.path, sha, self.derived),
+            derived and self.derived or None)
+
+    def assertLines(self, index, lines):
+        self.assertEqual(index.count, len(lines))
+        self.assertEqual(index.lines(), lines)
+        for start, end in [(0, 1), (3, 70), (63, 65), (64, 128), (127, 300),
+                (len(lines) - 1, None), (len(lines), None), (5, 2),
+                (-5, 2)]:
+            self.assertEqual(index.lines(start, end),
+                lines[max(start, 0):end])
+
+    def _data(self, count, last='\n'):
+        lines = ['line %d,%s\n' % (i, 'x' * (i % 7)) for i in range(count)]
+        lines[-1] = lines[-1][:-1] + last
+        return lines
+
+    def test_0000_small(self):
+        lines = self._data(300)
+        index = self._index(''.join(lines))
+        self.assertLines(index, lines)
+        self.assertEqual(self.derived.keys(INDEX_KIND), [])
+
+    def test_0100_large(self):
+        stream.STREAM_THRESHOLD = 0
+        lines = self._data(300)
+        index = self._index(''.join(lines))
+        self.assertEqual(self.derived.keys(INDEX_KIND), [index.blob.sha])
+        self.assertLines(index, lines)
+        # the index is kept for later reads.
+        self.assertLines(self._index(''.join(lines)), lines)
+
+    def test_0110_large_no_line_ending(self):
+        stream.STREAM_THRESHOLD = 0
+        lines = self._data(129, last='')
+        self.assertLines(self._index(''.join(lines)), lines)
+        lines = self._data(128)
+        self.assertLines(self._index(''.join(lines)), lines)
+
+    def test_0120_empty(self):
+        stream.STREAM_THRESHOLD = 0
+        self.assertLines(self._index(''), [])
+        self.assertLines(self._index('', derived=False), [])
+        self.assertLines(self._index('\n'), ['\n'])
+        self.assertLines(self._index('\n\n'), ['\n', '\n'])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(LineIndexTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
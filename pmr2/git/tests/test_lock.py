@@ -0,0 +1,171 @@
+import unittest
+import tempfile
+import shutil
+import errno
+import fcntl
+import threading
+import time
+from os.path import exists, join
+
+from dulwich.repo import Repo
+
+from pmr2.git import lock
+from pmr2.git.lock import LOCK_NAME
+from pmr2.git.lock import LockedRefsContainer, ReadWriteLock
+from pmr2.git.lock import git_dir, locked_refs, read_lock, rwlock, write_lock
+
+from pmr2.git.tests import util
+
+
+class ReadWriteLockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = ReadWriteLock()
+        self.events = []
+
+    def _thread(self, acquire, release, name, hold=0.1):
+        def run():
+            acquire()
+            self.events.append(('start', name))
+            time.sleep(hold)
+            self.events.append(('end', name))
+            release()
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def _read(self, name, hold=0.1):
+        return self._thread(self.lock.acquire_read, self.lock.release_read,
+            name, hold)
+
+    def _write(self, name, hold=0.1):
+        return self._thread(self.lock.acquire_write, self.lock.release_write,
+            name, hold)
+
+    def test_0000_readers_in_parallel(self):
+        threads = [self._read('r1'), self._read('r2')]
+        for thread in threads:
+            thread.join()
+        self.assertEqual([e for e, name in self.events[:2]],
+            ['start', 'start'])
+
+    def test_0010_writer_exclusive(self):
+        threads = [self._read('r1')]
+        time.sleep(0.02)
+        threads.append(self._write('w1'))
+        time.sleep(0.02)
+        # held back by the waiting writer.
+        threads.append(self._read('r2'))
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.events, [
+            ('start', 'r1'), ('end', 'r1'),
+            ('start', 'w1'), ('end', 'w1'),
+            ('start', 'r2'), ('end', 'r2'),
+        ])
+
+
+class LockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        util.extract_archive(self.testdir)
+        self.workspace = join(self.testdir, 'simple1')
+        self.path = join(self.workspace, '.git')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def _file_locked(self, operation):
+        with open(join(self.path, LOCK_NAME), 'a') as f:
+            try:
+                fcntl.flock(f, operation | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return True
+            fcntl.flock(f, fcntl.LOCK_UN)
+            return False
+
+    def test_0000_git_dir(self):
+        self.assertEqual(git_dir(self.workspace), self.path)
+        self.assertEqual(git_dir(self.path + '/'), self.path)
+        self.assertTrue(rwlock(self.workspace) is rwlock(self.path))
+
+    def test_0010_file_lock(self):
+        with read_lock(self.workspace):
+            self.assertFalse(self._file_locked(fcntl.LOCK_SH))
+            self.assertTrue(self._file_locked(fcntl.LOCK_EX))
+        with write_lock(self.path):
+            self.assertTrue(self._file_locked(fcntl.LOCK_SH))
+        self.assertFalse(self._file_locked(fcntl.LOCK_EX))
+
+    def test_0020_missing(self):
+        missing = join(self.testdir, 'missing')
+        with read_lock(missing):
+            pass
+        with write_lock(missing):
+            pass
+
+    def _read_only(self):
+        # as a read-only file system would, whatever the user running
+        # the tests may write to.
+        def read_only(name, mode='r'):
+            if mode != 'r':
+                raise IOError(errno.EROFS, 'Read-only file system', name)
+            return open(name, mode)
+        lock.open = read_only
+        self.addCleanup(delattr, lock, 'open')
+
+    def test_0030_read_only(self):
+        self._read_only()
+        with read_lock(self.workspace):
+            pass
+        with write_lock(self.workspace):
+            pass
+        self.assertFalse(exists(join(self.path, LOCK_NAME)))
+
+    def test_0031_read_only_lock_file(self):
+        # an existing lock file is still locked through.
+        open(join(self.path, LOCK_NAME), 'a').close()
+        self._read_only()
+        with read_lock(self.workspace):
+            self.assertTrue(self._file_locked(fcntl.LOCK_EX))
+
+    def test_0100_locked_refs(self):
+        repo = Repo(self.workspace)
+        refs = locked_refs(repo)
+        self.assertTrue(isinstance(refs, LockedRefsContainer))
+        head = refs['refs/heads/master']
+        other = repo[head].parents[0]
+        self.assertFalse(refs.set_if_equals('refs/heads/master', other, head))
+        self.assertTrue(refs.set_if_equals('refs/heads/master', head, other))
+        self.assertEqual(Repo(self.workspace).refs['refs/heads/master'],
+            other)
+        self.assertFalse(refs.add_if_new('refs/heads/master', head))
+
+    def test_0110_locked_refs_wait_for_readers(self):
+        refs = locked_refs(Repo(self.workspace))
+        head = refs['refs/heads/master']
+        done = []
+        def update():
+            refs.add_if_new('refs/heads/other', head)
+            done.append(True)
+        with read_lock(self.workspace):
+            thread = threading.Thread(target=update)
+            thread.start()
+            time.sleep(0.05)
+            self.assertEqual(done, [])
+        thread.join()
+        self.assertEqual(done, [True])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(ReadWriteLockTestCase))
+    suite.addTest(makeSuite(LockTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import unittest
+import tempfile
+import shutil
+import threading
+import time
+from os.path import join
+
+import zope.component
+import zope.interface
+from zope.component.hooks import getSiteManager
+from zope.component.tests import clearZCML
+
+from pmr2.app.settings.interfaces import IPMR2GlobalSettings
+from pmr2.app.workspace.event import Push
+
+from pmr2.git import maintenance
+from pmr2.git.maintenance import MaintenanceQueue
+from pmr2.git.maintenance import maintain, maintenance_lock
+from pmr2.git.maintenance import needs_repack, repo_stats
+
+from pmr2.git.tests import util
+
+
+class Settings(object):
+    zope.interface.implements(IPMR2GlobalSettings)
+
+    def dirOf(self, obj):
+        return obj.path
+
+
+class Workspace(object):
+
+    def __init__(self, path):
+        self.path = path
+
+
+class MaintenanceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        util.extract_archive(self.testdir)
+        self.path = join(self.testdir, 'simple1', '.git')
+        self.git_executable = maintenance.git_executable
+
+    def tearDown(self):
+        maintenance.git_executable = self.git_executable
+        shutil.rmtree(self.testdir)
+
+    def test_0000_repo_stats(self):
+        stats = repo_stats(self.path)
+        self.assertEqual(stats['packs'], 0)
+        self.assertEqual(stats['loose'], 12)
+        self.assertEqual(stats['size'], stats['loose_size'])
+        self.assertTrue(stats['loose_size'] > 0)
+
+    def test_0010_needs_repack(self):
+        stats = {'packs': 15, 'loose': 1023}
+        self.assertFalse(needs_repack(stats))
+        self.assertTrue(needs_repack(dict(stats, packs=16)))
+        self.assertTrue(needs_repack(dict(stats, loose=1024)))
+        self.assertTrue(needs_repack(stats, loose_limit=10))
+
+    def test_0100_maintain(self):
+        before = repo_stats(self.path)
+        self.assertEqual(maintain(self.path), before)
+        # below the thresholds.
+        self.assertEqual(repo_stats(self.path), before)
+
+    def test_0110_maintain_repack(self):
+        if maintenance.git_executable is None:
+            return
+        maintain(self.path, force=True)
+        stats = repo_stats(self.path)
+        self.assertEqual(stats['packs'], 1)
+        self.assertEqual(stats['loose'], 0)
+
+    def test_0111_maintain_repack_no_git(self):
+        maintenance.git_executable = None
+        before = repo_stats(self.path)
+        # skipped rather than done in memory.
+        self.assertEqual(maintain(self.path, force=True), before)
+        self.assertEqual(repo_stats(self.path), before)
+
+    def test_0120_maintain_derived_indexes(self):
+        refreshed = []
+        maintenance.derived_indexes.append(refreshed.append)
+        try:
+            maintain(self.path)
+        finally:
+            maintenance.derived_indexes.remove(refreshed.append)
+        self.assertEqual(refreshed, [self.path])
+
+    def test_0130_maintain_locked(self):
+        with maintenance_lock(self.path) as locked:
+            self.assertTrue(locked)
+            self.assertEqual(maintain(self.path, force=True), None)
+        self.assertEqual(repo_stats(self.path)['packs'], 0)
+
+
+class MaintenanceQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.done = []
+        self.event = threading.Event()
+
+    def maintain(self, path):
+        self.done.append((path, time.time()))
+        self.event.set()
+
+    def test_0000_debounce(self):
+        queue = MaintenanceQueue(delay=0.2, maintain=self.maintain)
+        start = time.time()
+        queue.schedule('/repo/a')
+        time.sleep(0.1)
+        queue.schedule('/repo/a')
+        self.assertTrue(self.event.wait(2))
+        self.assertEqual([p for p, t in self.done], ['/repo/a'])
+        self.assertTrue(self.done[0][1] - start >= 0.3)
+        self.assertEqual(queue.pending(), [])
+
+    def test_0010_flush(self):
+        queue = MaintenanceQueue(delay=60, maintain=self.maintain)
+        queue.schedule('/repo/b')
+        queue.schedule('/repo/a')
+        self.assertEqual(queue.pending(), ['/repo/a', '/repo/b'])
+        queue.flush()
+        self.assertEqual([p for p, t in self.done], ['/repo/a', '/repo/b'])
+        self.assertEqual(queue.pending(), [])
+
+    def test_0020_failure(self):
+        def maintain(path):
+            raise OSError('gone')
+        queue = MaintenanceQueue(delay=60, maintain=maintain)
+        queue.schedule('/repo/a')
+        queue.flush()
+        self.assertEqual(queue.pending(), [])
+
+    def test_0030_maxsize(self):
+        queue = MaintenanceQueue(delay=60, maintain=self.maintain, maxsize=2)
+        self.assertTrue(queue.schedule('/repo/a'))
+        self.assertTrue(queue.schedule('/repo/b'))
+        self.assertFalse(queue.schedule('/repo/c'))
+        # already waiting, so only pushed back.
+        self.assertTrue(queue.schedule('/repo/a'))
+        self.assertEqual(queue.pending(), ['/repo/a', '/repo/b'])
+        queue.flush()
+        self.assertTrue(queue.schedule('/repo/c'))
+
+    def test_0100_workspace_pushed(self):
+        clearZCML()
+        getSiteManager().registerUtility(Settings(), IPMR2GlobalSettings)
+        self.addCleanup(clearZCML)
+        queue = maintenance.queue
+        maintenance.queue = MaintenanceQueue(delay=60, maintain=self.maintain)
+        try:
+            maintenance.workspace_pushed(Push(Workspace('/w/a')))
+            self.assertEqual(maintenance.queue.pending(), ['/w/a/.git'])
+        finally:
+            maintenance.queue = queue
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(MaintenanceTestCase))
+    suite.addTest(makeSuite(MaintenanceQueueTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
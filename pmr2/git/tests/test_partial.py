@@ -0,0 +1,139 @@
+import unittest
+import tempfile
+import shutil
+import os
+from distutils.spawn import find_executable
+from os.path import join
+from subprocess import Popen, PIPE
+
+from dulwich.repo import Repo
+from dulwich.server import DictBackend
+from dulwich.web import make_wsgi_chain
+
+from pmr2.git.partial import FILTER_ENV
+from pmr2.git.partial import V2Client
+from pmr2.git.partial import sync_filter, get_promisor, set_promisor
+from pmr2.git.partial import fetch_missing
+from pmr2.git.sync import http_pool_manager
+
+from pmr2.git.tests import util
+
+
+class PartialTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        util.extract_archive(self.testdir)
+        self.head = 'bfdd13c821b614d2b5e7d5b10c3ff70147c5107a'
+        self.server = util.GitHTTPServer(self.testdir)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        os.environ.pop(FILTER_ENV, None)
+        shutil.rmtree(self.testdir)
+
+    def client(self, server=None):
+        server = server or self.server
+        return V2Client(server.url + '/simple1', http_pool_manager())
+
+    def test_0000_sync_filter(self):
+        self.assertEqual(sync_filter(), None)
+        os.environ[FILTER_ENV] = 'blob:limit=1m'
+        self.assertEqual(sync_filter(), 'blob:limit=1m')
+        os.environ[FILTER_ENV] = 'tree:0'
+        self.assertEqual(sync_filter(), None)
+
+    def test_0010_promisor(self):
+        repo = Repo(join(self.testdir, 'simple1'))
+        self.assertEqual(get_promisor(repo), None)
+        set_promisor(repo, 'http://example.com/w/simple1')
+        repo = Repo(join(self.testdir, 'simple1'))
+        self.assertEqual(get_promisor(repo), 'http://example.com/w/simple1')
+
+    def test_0100_capabilities(self):
+        client = self.client()
+        self.assertTrue('filter' in client.capabilities()['fetch'].split())
+        self.assertTrue(client.supports_filter())
+
+    def test_0101_capabilities_version_0(self):
+        server = util.GitHTTPServer(self.testdir, make_wsgi_chain(DictBackend(
+            {'/simple1': Repo(join(self.testdir, 'simple1'))})))
+        server.start()
+        self.addCleanup(server.stop)
+        client = self.client(server)
+        self.assertEqual(client.capabilities(), {})
+        self.assertFalse(client.supports_filter())
+
+    def test_0200_ls_refs(self):
+        refs = self.client().ls_refs(['refs/heads/master', 'HEAD'])
+        self.assertEqual(refs, {
+            'refs/heads/master': self.head,
+            'HEAD': self.head,
+        })
+
+    def test_0300_fetch_filter(self):
+        target = Repo.init_bare(join(self.testdir, 'target'), mkdir=True)
+        self.client().fetch(target.object_store, [self.head],
+            filter_spec='blob:none')
+        commit = target[self.head]
+        entries = target[commit.tree].items()
+        self.assertTrue(entries)
+        for entry in entries:
+            self.assertFalse(entry.sha in target.object_store)
+
+        self.client().fetch(target.object_store, [entries[0].sha])
+        self.assertTrue(entries[0].sha in target.object_store)
+
+    def test_0310_fetch_missing(self):
+        target = Repo.init_bare(join(self.testdir, 'target'), mkdir=True)
+        client = self.client()
+        client.fetch(target.object_store, [self.head], filter_spec='blob:none')
+        sha = target[target[self.head].tree].items()[0].sha
+        self.assertFalse(fetch_missing(target.path, [sha],
+            http_pool_manager()))
+
+        set_promisor(target, client.url)
+        self.assertTrue(fetch_missing(target.path, [sha],
+            http_pool_manager()))
+        self.assertTrue(sha in Repo(target.path).object_store)
+
+    def test_0320_promisor_pack(self):
+        if find_executable('git') is None:
+            return
+        target = Repo.init_bare(join(self.testdir, 'target'), mkdir=True)
+        client = self.client()
+        client.fetch(target.object_store, [self.head], filter_spec='blob:none')
+        packs = [n for n in os.listdir(join(target.path, 'objects', 'pack'))
+            if n.endswith('.promisor')]
+        self.assertEqual(len(packs), 1)
+        set_promisor(target, client.url)
+        target.refs['refs/heads/master'] = self.head
+
+        # git fetches the missing blobs from the promisor by itself.
+        sha = target[target[self.head].tree].items()[0].sha
+        env = dict(os.environ, GIT_DIR=target.path)
+        p = Popen(['git', 'cat-file', '-p', sha], stdout=PIPE, stderr=PIPE,
+            env=env)
+        out, err = p.communicate()
+        self.assertEqual(p.returncode, 0, err)
+        p = Popen(['git', 'repack', '-q', '-a', '-d'], stdout=PIPE,
+            stderr=PIPE, env=env)
+        out, err = p.communicate()
+        self.assertEqual(p.returncode, 0, err)
+
+    def test_0311_fetch_missing_failure(self):
+        target = Repo.init_bare(join(self.testdir, 'target'), mkdir=True)
+        set_promisor(target, self.server.url + '/missing')
+        self.assertFalse(fetch_missing(target.path, ['0' * 40],
+            http_pool_manager()))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(PartialTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+import tempfile
+import shutil
+import os
+from os.path import exists, join
+
+from pygit2 import Repository
+from pygit2 import init_repository
+
+from pmr2.git import pool
+from pmr2.git.pool import ObjectPool
+from pmr2.git.pool import join_family
+
+from pmr2.git.tests import util
+
+
+def object_files(repo_path):
+    # the loose and packed object files held by the repository itself.
+    root = join(repo_path, 'objects')
+    result = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirpath != join(root, 'info'):
+            result.extend(filenames)
+    return result
+
+
+class PoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        util.extract_archive(self.testdir)
+        self.root = join(self.testdir, 'pools')
+        self.source = join(self.testdir, 'simple1', '.git')
+        self.head = 'bfdd13c821b614d2b5e7d5b10c3ff70147c5107a'
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def fork(self, name):
+        path = join(self.testdir, name, '.git')
+        init_repository(path, bare=True)
+        return path
+
+    def test_0000_disabled(self):
+        self.assertEqual(join_family(self.fork('fork1'), self.source,
+            root=None), None)
+
+    def test_0100_join_family(self):
+        if pool.git_executable is None:
+            return
+        fork = self.fork('fork1')
+        object_pool = join_family(fork, self.source, root=self.root)
+        self.assertEqual(object_pool.members(), [self.source, fork])
+        self.assertEqual(ObjectPool.of(fork, self.root).path,
+            object_pool.path)
+        self.assertEqual(ObjectPool.of(self.source, self.root).path,
+            object_pool.path)
+        # objects of the source are now only kept by the pool.
+        self.assertEqual(object_files(self.source), [])
+        self.assertTrue(self.head in Repository(self.source))
+        self.assertTrue(self.head in Repository(fork))
+
+        # forks of the fork join the same pool.
+        fork2 = self.fork('fork2')
+        self.assertEqual(join_family(fork2, fork, root=self.root).path,
+            object_pool.path)
+        self.assertEqual(len(object_pool.members()), 3)
+
+    def test_0110_create(self):
+        if pool.git_executable is None:
+            return
+        os.makedirs(self.root)
+        object_pool = ObjectPool.create(self.root, self.source)
+        self.assertEqual(os.listdir(self.root),
+            [os.path.basename(object_pool.path)])
+        self.assertTrue(object_pool.path.endswith('.git'))
+        self.assertEqual(object_pool.members(), [self.source])
+        self.assertTrue(object_pool.is_member(self.source))
+        # kept by the collection, as its member borrows from it.
+        self.assertTrue(object_pool.gc())
+
+    def test_0120_migrate_unreachable(self):
+        if pool.git_executable is None:
+            return
+        # as pushed, but with the ref not yet updated.
+        blob = Repository(self.source).create_blob('unreachable\n').hex
+        pool.git(self.source, 'pack-objects', '-q',
+            join(self.source, 'objects', 'pack', 'pack'), input=blob + '\n')
+        os.remove(join(self.source, 'objects', blob[:2], blob[2:]))
+        object_pool = join_family(self.fork('fork1'), self.source,
+            root=self.root)
+        self.assertTrue(blob in Repository(self.source))
+        object_pool.maintain()
+        self.assertTrue(blob in Repository(self.source))
+
+    def test_0200_gc(self):
+        if pool.git_executable is None:
+            return
+        fork = self.fork('fork1')
+        object_pool = join_family(fork, self.source, root=self.root)
+        shutil.rmtree(self.source)
+        self.assertTrue(object_pool.gc())
+        self.assertEqual(object_pool.members(), [fork])
+        shutil.rmtree(fork)
+        self.assertFalse(object_pool.gc())
+        self.assertFalse(exists(object_pool.path))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(PoolTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
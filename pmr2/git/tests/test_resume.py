@@ -0,0 +1,132 @@
+import unittest
+import tempfile
+import shutil
+import os
+from os.path import exists, join
+from cStringIO import StringIO
+
+from dulwich.client import FetchPackResult
+from dulwich.objects import Blob, Commit, Tree
+from dulwich.pack import write_pack_objects
+from dulwich.repo import Repo
+
+from pmr2.git.resume import RESUME_DIR
+from pmr2.git.resume import ResumableFetch
+from pmr2.git.resume import find_complete, salvage_pack
+
+
+class FakeClient(object):
+
+    def __init__(self, refs, objects):
+        self.refs = refs
+        self.objects = objects
+
+    def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
+            progress=None):
+        self.heads = graph_walker.heads
+        self.wants = determine_wants(self.refs)
+        out = StringIO()
+        write_pack_objects(out, [(o, None) for o in self.objects])
+        pack_data(out.getvalue())
+        return FetchPackResult(self.refs, {}, None)
+
+
+class ResumeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.repo = Repo.init_bare(join(self.testdir, 'repo'), mkdir=True)
+        os.mkdir(join(self.repo.controldir(), RESUME_DIR))
+        self.pack_path = join(self.repo.controldir(), RESUME_DIR, 'pack')
+
+        self.blob1 = Blob.from_string('first\n')
+        self.tree1 = Tree()
+        self.tree1.add('file1', 0o100644, self.blob1.id)
+        self.commit1 = self.make_commit(self.tree1, [])
+        self.blob2 = Blob.from_string(os.urandom(4096))
+        self.tree2 = Tree()
+        self.tree2.add('file1', 0o100644, self.blob1.id)
+        self.tree2.add('file2', 0o100644, self.blob2.id)
+        self.commit2 = self.make_commit(self.tree2, [self.commit1.id])
+        self.objects = [self.commit1, self.tree1, self.blob1,
+            self.commit2, self.tree2, self.blob2]
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def make_commit(self, tree, parents):
+        commit = Commit()
+        commit.tree = tree.id
+        commit.parents = parents
+        commit.author = commit.committer = 'user <user@example.com>'
+        commit.author_time = commit.commit_time = 1000000000 + len(parents)
+        commit.author_timezone = commit.commit_timezone = 0
+        commit.message = 'commit\n'
+        return commit
+
+    def write_pack(self, cut):
+        out = StringIO()
+        write_pack_objects(out, [(o, None) for o in self.objects])
+        with open(self.pack_path, 'wb') as f:
+            f.write(out.getvalue()[:-cut])
+
+    def test_0000_salvage_pack(self):
+        self.write_pack(100)
+        pack = salvage_pack(self.pack_path, self.repo.object_store)
+        self.assertEqual(sorted(pack), sorted(o.id for o in self.objects[:5]))
+        self.assertFalse(self.blob2.id in self.repo.object_store)
+
+    def test_0001_salvage_pack_empty(self):
+        open(self.pack_path, 'wb').close()
+        self.assertEqual(
+            salvage_pack(self.pack_path, self.repo.object_store), None)
+
+    def test_0100_find_complete(self):
+        self.write_pack(100)
+        pack = salvage_pack(self.pack_path, self.repo.object_store)
+        complete, incomplete = find_complete(self.repo.object_store,
+            list(pack) + ['0' * 40])
+        self.assertEqual(complete, set([self.commit1.id]))
+        self.assertEqual(incomplete, set([self.commit2.id]))
+
+    def test_0200_recover(self):
+        self.write_pack(100)
+        fetch = ResumableFetch(self.repo)
+        self.assertEqual(fetch.recover(), [self.commit1.id])
+        self.assertEqual(fetch.incomplete, set([self.commit2.id]))
+        self.assertFalse(exists(self.pack_path))
+        self.assertEqual(fetch.read_state(), {'haves': [self.commit1.id]})
+        # kept out of the repository until the fetch completes.
+        self.assertFalse(self.commit1.id in self.repo.object_store)
+        self.assertTrue(self.commit1.id in fetch.quarantine())
+
+        # received objects are remembered through further attempts.
+        fetch = ResumableFetch(self.repo)
+        self.assertEqual(fetch.recover(), [self.commit1.id])
+
+    def test_0300_resume(self):
+        from pmr2.git.utility import BranchWants
+        self.write_pack(100)
+        fetch = ResumableFetch(self.repo)
+        fetch.recover()
+
+        refs = {'refs/heads/master': self.commit2.id}
+        client = FakeClient(refs, [self.blob2])
+        result = fetch(client, 'repo', BranchWants(
+            'refs/heads/master', self.repo.object_store))
+        self.assertEqual(result, refs)
+        self.assertEqual(client.heads, set([self.commit1.id]))
+        self.assertEqual(client.wants, [self.commit2.id])
+        for obj in self.objects:
+            self.assertTrue(obj.id in self.repo.object_store)
+        self.assertFalse(exists(join(self.repo.controldir(), RESUME_DIR)))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(ResumeTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
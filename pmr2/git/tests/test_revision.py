@@ -0,0 +1,137 @@
+import unittest
+import tempfile
+import shutil
+import os
+import time
+from os.path import join
+
+from pygit2 import Repository
+
+from dulwich.repo import Repo
+
+from pmr2.git.revision import ref_paths, refs_fingerprint
+from pmr2.git.revision import resolve, revision_cache
+
+from pmr2.git.tests import util
+
+
+class CountingRepository(object):
+    """
+    A pygit2 repository counting the revisions it resolved.
+    """
+
+    def __init__(self, path):
+        self.repo = Repository(path)
+        self.path = self.repo.path
+        self.resolved = []
+
+    def revparse_single(self, rev):
+        self.resolved.append(rev)
+        return self.repo.revparse_single(rev)
+
+    def __getitem__(self, oid):
+        return self.repo[oid]
+
+
+class RevisionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        util.extract_archive(self.testdir)
+        self.workspace = join(self.testdir, 'simple1')
+        self.path = join(self.workspace, '.git')
+        self.repo = CountingRepository(self.path)
+        self.head = self.repo.repo.revparse_single('HEAD').hex
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def _age_refs(self):
+        # as if the refs were last changed a while ago.
+        past = time.time() - 10
+        paths = [join(self.path, 'HEAD')]
+        for root, dirs, files in os.walk(join(self.path, 'refs')):
+            paths.append(root)
+        for path in paths:
+            os.utime(path, (past, past))
+
+    def _tags(self):
+        # created along with the first tag otherwise, which changes the
+        # directory of all the refs.
+        if not os.path.isdir(join(self.path, 'refs', 'tags')):
+            os.mkdir(join(self.path, 'refs', 'tags'))
+
+    def test_0000_full_id(self):
+        self.assertEqual(resolve(self.repo, self.head).hex, self.head)
+        self.assertEqual(resolve(self.repo, self.head).hex, self.head)
+        self.assertEqual(self.repo.resolved, [self.head])
+
+    def test_0010_symbolic(self):
+        self._age_refs()
+        self.assertEqual(resolve(self.repo, 'HEAD').hex, self.head)
+        self.assertEqual(resolve(self.repo, 'HEAD').hex, self.head)
+        self.assertEqual(resolve(self.repo, 'master').hex, self.head)
+        self.assertEqual(self.repo.resolved, ['HEAD', 'master'])
+
+        # moving the branch invalidates what was resolved before.
+        parent = self.repo[self.head].parents[0].hex
+        Repo(self.workspace).refs['refs/heads/master'] = parent
+        self.assertEqual(resolve(self.repo, 'HEAD').hex, parent)
+        self.assertEqual(self.repo.resolved, ['HEAD', 'master', 'HEAD'])
+
+    def test_0020_racy(self):
+        # refs changed just now may change again unnoticed.
+        self.assertEqual(resolve(self.repo, 'HEAD').hex, self.head)
+        self.assertEqual(resolve(self.repo, 'HEAD').hex, self.head)
+        self.assertEqual(self.repo.resolved, ['HEAD', 'HEAD'])
+
+    def test_0030_missing(self):
+        self._age_refs()
+        self.assertRaises(KeyError, resolve, self.repo, 'missing')
+        self.assertRaises(KeyError, resolve, self.repo, '0' * 40)
+        self.assertEqual(self.repo.resolved, ['missing', '0' * 40])
+
+    def test_0040_shared(self):
+        self.assertTrue(revision_cache(self.workspace) is
+            revision_cache(self.repo.path))
+
+    def test_0050_fingerprint(self):
+        before, changed = refs_fingerprint(self.path)
+        self.assertEqual(refs_fingerprint(self.path)[0], before)
+        os.mkdir(join(self.path, 'refs', 'heads', 'topic'))
+        self.assertNotEqual(refs_fingerprint(self.path)[0], before)
+
+    def test_0051_fingerprint_scope(self):
+        # only the refs the revision may resolve through are looked at.
+        self._tags()
+        head = refs_fingerprint(self.path)[0]
+        tag = refs_fingerprint(self.path, 'v1~1')[0]
+        Repo(self.workspace).refs['refs/tags/v1'] = self.head
+        self.assertEqual(refs_fingerprint(self.path)[0], head)
+        self.assertNotEqual(refs_fingerprint(self.path, 'v1~1')[0], tag)
+        # as are the directories of refs that are not there yet.
+        other = refs_fingerprint(self.path, 'topic/other')[0]
+        Repo(self.workspace).refs['refs/heads/topic/other'] = self.head
+        self.assertNotEqual(
+            refs_fingerprint(self.path, 'topic/other')[0], other)
+        self.assertEqual(ref_paths('@{1}')[:2], ['HEAD', 'refs/HEAD'])
+
+    def test_0060_scoped(self):
+        self._tags()
+        self._age_refs()
+        self.assertEqual(resolve(self.repo, 'HEAD').hex, self.head)
+        # a new tag does not change what HEAD resolves to.
+        Repo(self.workspace).refs['refs/tags/v1'] = self.head
+        self.assertEqual(resolve(self.repo, 'HEAD').hex, self.head)
+        self.assertEqual(resolve(self.repo, 'v1').hex, self.head)
+        self.assertEqual(self.repo.resolved, ['HEAD', 'v1'])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(RevisionTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
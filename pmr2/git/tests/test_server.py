@@ -0,0 +1,393 @@
+import unittest
+import tempfile
+import shutil
+import gzip
+import hashlib
+import json
+import os
+import zlib
+from os.path import join
+from cStringIO import StringIO
+
+from pygit2 import Repository
+from pygit2 import Signature
+from pygit2 import GIT_FILEMODE_BLOB
+
+from dulwich.repo import Repo
+
+from pmr2.git.backend import GzipInput
+from pmr2.git.backend import GzipResponse
+from pmr2.git.backend import accepts_gzip
+from pmr2.git.largefile import MAX_ENV, ROOT_ENV, LargeFileStore
+from pmr2.git.largefile import make_pointer
+from pmr2.git.server import check_secret
+from pmr2.git.server import AuthorizationError
+from pmr2.git.server import GitServer
+from pmr2.git.server import HTTP_UNAUTHORIZED
+from pmr2.git.server import _ChunkedInput
+
+from pmr2.git.tests import util
+
+
+class DummyAuthorizer(object):
+
+    allow_push = False
+
+    def __init__(self, root):
+        self.root = root
+        self.calls = []
+
+    def __call__(self, prefix, push, environ, event=False):
+        self.calls.append((prefix, push, event))
+        if push and not self.allow_push:
+            raise AuthorizationError(HTTP_UNAUTHORIZED)
+        return join(self.root, prefix.strip('/'), '.git')
+
+
+class ServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        util.extract_archive(self.testdir)
+        self.authorizer = DummyAuthorizer(self.testdir)
+        self.app = GitServer(self.authorizer)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def request(self, method, path, query='', body='', environ=None):
+        status = []
+        out = StringIO()
+        environ = dict(environ or {})
+        environ.update({
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO(body),
+            'wsgi.url_scheme': 'http',
+            'HTTP_HOST': 'localhost',
+        })
+        def start_response(s, headers):
+            status.append((s, dict(headers)))
+            return out.write
+        result = ''.join(self.app(environ, start_response))
+        return status[0][0], status[0][1], out.getvalue() + result
+
+    def test_0000_check_secret(self):
+        self.assertTrue(check_secret('secret', 'secret'))
+        self.assertFalse(check_secret('wrong', 'secret'))
+        self.assertFalse(check_secret('', ''))
+        self.assertFalse(check_secret(None, 'secret'))
+
+    def test_0010_gzip_input(self):
+        stream = StringIO()
+        gz = gzip.GzipFile(fileobj=stream, mode='w')
+        gz.write('0032want ' + 'a' * 40 + '\n' * 100)
+        gz.close()
+        stdin = GzipInput(StringIO(stream.getvalue()))
+        self.assertEqual(stdin.read(4), '0032')
+        self.assertEqual(stdin.read(), 'want ' + 'a' * 40 + '\n' * 100)
+        self.assertEqual(stdin.read(), '')
+
+    def test_0020_chunked_input(self):
+        stdin = _ChunkedInput(StringIO('4\r\nwant\r\n5\r\n some\r\n0\r\n\r\n'))
+        self.assertEqual(stdin.read(2), 'wa')
+        self.assertEqual(stdin.read(), 'nt some')
+        self.assertEqual(stdin.read(), '')
+
+    def test_0030_accepts_gzip(self):
+        self.assertTrue(accepts_gzip('gzip'))
+        self.assertTrue(accepts_gzip('deflate, gzip, br'))
+        self.assertTrue(accepts_gzip('gzip;q=0.5'))
+        self.assertFalse(accepts_gzip('gzip;q=0'))
+        self.assertFalse(accepts_gzip('deflate'))
+        self.assertFalse(accepts_gzip(None))
+
+    def run_gzip_response(self, content_type, chunks, **kw):
+        status = []
+        out = StringIO()
+        def start_response(s, headers):
+            status.append(dict(headers))
+            return out.write
+        response = GzipResponse(start_response, **kw)
+        write = response('200 OK', [('Content-Type', content_type)])
+        for chunk in chunks:
+            write(chunk)
+        response.finish()
+        return status[0], out.getvalue()
+
+    def test_0040_gzip_response(self):
+        chunks = ['0032ACK %s common\n' % ('a' * 40)] * 100
+        headers, body = self.run_gzip_response(
+            'application/x-git-upload-pack-result', chunks)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS),
+            ''.join(chunks))
+
+    def test_0041_gzip_response_small(self):
+        headers, body = self.run_gzip_response(
+            'application/x-git-upload-pack-result', ['0008NAK\n'])
+        self.assertFalse('Content-Encoding' in headers)
+        self.assertEqual(body, '0008NAK\n')
+
+    def test_0042_gzip_response_pack(self):
+        # the pack signature split across the writes.
+        chunks = ['0008NAK\n' * 200, '0009\x01', 'PACK', 'x' * 2000]
+        headers, body = self.run_gzip_response(
+            'application/x-git-upload-pack-result', chunks)
+        self.assertFalse('Content-Encoding' in headers)
+        self.assertEqual(body, ''.join(chunks))
+
+    def test_0043_gzip_response_buffer_limit(self):
+        chunks = ['0008NAK\n'] * 200 + ['0009\x01PACK']
+        headers, body = self.run_gzip_response(
+            'application/x-git-upload-pack-result', chunks, min_size=100,
+            max_buffer=800)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS),
+            ''.join(chunks))
+
+    def test_0044_gzip_response_other_type(self):
+        headers, body = self.run_gzip_response(
+            'application/x-git-packed-objects', ['x' * 2000])
+        self.assertFalse('Content-Encoding' in headers)
+        self.assertFalse('Vary' in headers)
+
+    def test_0100_info_refs(self):
+        status, headers, result = self.request(
+            'GET', '/simple1/info/refs', 'service=git-upload-pack')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Type'],
+            'application/x-git-upload-pack-advertisement')
+        self.assertTrue(result.startswith('001e# service=git-upload-pack\n'))
+        self.assertTrue('refs/heads/master' in result)
+        self.assertEqual(self.authorizer.calls, [('/simple1', False, False)])
+
+    def test_0101_info_refs_gzip(self):
+        repo = Repo(join(self.testdir, 'simple1', '.git'))
+        for i in range(50):
+            repo.refs['refs/tags/v%d' % i] = repo.head()
+        status, headers, plain = self.request(
+            'GET', '/simple1/info/refs', 'service=git-upload-pack')
+        self.assertFalse('Content-Encoding' in headers)
+        status, headers, result = self.request(
+            'GET', '/simple1/info/refs', 'service=git-upload-pack',
+            environ={'HTTP_ACCEPT_ENCODING': 'gzip'})
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            zlib.decompress(result, 16 + zlib.MAX_WBITS), plain)
+
+    def test_0110_info_refs_push_unauthorized(self):
+        status, headers, result = self.request(
+            'GET', '/simple1/info/refs', 'service=git-receive-pack')
+        self.assertEqual(status, HTTP_UNAUTHORIZED)
+
+    def test_0120_not_found(self):
+        status, headers, result = self.request('GET', '/simple1/nothing')
+        self.assertEqual(status, '404 Not Found')
+        self.assertEqual(self.authorizer.calls, [])
+
+    def test_0200_loose_object(self):
+        sha = 'd7778ed0c6fbbfa00e08eff6b6f83545e45e1010'
+        path = '/objects/%s/%s' % (sha[:2], sha[2:])
+        status, headers, result = self.request('GET', '/simple1' + path)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['ETag'], '"%s"' % sha)
+        self.assertEqual(headers['Cache-Control'],
+            'public, max-age=31536000, immutable')
+        with open(join(self.testdir, 'simple1', '.git') + path, 'rb') as f:
+            raw = f.read()
+        self.assertEqual(headers['Content-Length'], str(len(raw)))
+        self.assertEqual(result, raw)
+
+    def test_0210_loose_object_not_modified(self):
+        sha = 'd7778ed0c6fbbfa00e08eff6b6f83545e45e1010'
+        status, headers, result = self.request('GET',
+            '/simple1/objects/%s/%s' % (sha[:2], sha[2:]),
+            environ={'HTTP_IF_NONE_MATCH': '"other", "%s"' % sha})
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(headers['ETag'], '"%s"' % sha)
+        self.assertEqual(result, '')
+
+    def test_0220_pack_not_found(self):
+        status, headers, result = self.request('GET',
+            '/simple1/objects/pack/pack-%s.pack' % ('0' * 40))
+        self.assertEqual(status, '404 Not Found')
+        self.assertFalse('ETag' in headers)
+
+    def _large_files(self):
+        os.environ[ROOT_ENV] = join(self.testdir, 'lfs')
+        self.addCleanup(os.environ.pop, ROOT_ENV)
+        return LargeFileStore(join(self.testdir, 'lfs'))
+
+    def _commit_pointer(self, oid, size, name='simple1'):
+        repo = Repository(join(self.testdir, name, '.git'))
+        head = repo.revparse_single('HEAD')
+        builder = repo.TreeBuilder(head.tree)
+        builder.insert('large', repo.create_blob(make_pointer(oid, size)),
+            GIT_FILEMODE_BLOB)
+        sig = Signature('user', 'user@example.com', 1400000000, 0)
+        repo.create_commit('refs/heads/master', sig, sig, 'large',
+            builder.write(), [head.oid])
+
+    def _batch(self, operation, objects, name='simple1'):
+        status, headers, result = self.request('POST',
+            '/%s/info/lfs/objects/batch' % name, body=json.dumps({
+                'operation': operation,
+                'transfers': ['basic'],
+                'objects': objects,
+            }))
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Type'],
+            'application/vnd.git-lfs+json')
+        return json.loads(result)
+
+    def test_0300_lfs_batch_download(self):
+        store = self._large_files()
+        oid, size = store.add(iter(['data']))
+        self._commit_pointer(oid, size)
+        missing = '0' * 64
+        result = self._batch('download', [
+            {'oid': oid, 'size': size},
+            {'oid': missing, 'size': 1},
+            {'oid': 'bad', 'size': 1},
+        ])
+        self.assertEqual(result['transfer'], 'basic')
+        self.assertEqual(result['objects'], [
+            {'oid': oid, 'size': size, 'actions': {'download': {'href':
+                'http://localhost/simple1/info/lfs/objects/' + oid}}},
+            {'oid': missing, 'size': 1, 'error': {
+                'code': 404, 'message': 'Object does not exist'}},
+            {'oid': 'bad', 'size': 1, 'error': {
+                'code': 422, 'message': 'Invalid object'}},
+        ])
+
+    def test_0301_lfs_batch_upload(self):
+        store = self._large_files()
+        oid, size = store.add(iter(['data']))
+        self._commit_pointer(oid, size)
+        other, other_size = store.add(iter(['other']))
+        missing = '0' * 64
+        # uploads are for those who may push.
+        status, headers, result = self.request('POST',
+            '/simple1/info/lfs/objects/batch', body=json.dumps({
+                'operation': 'upload', 'objects': []}))
+        self.assertEqual(status, HTTP_UNAUTHORIZED)
+        self.assertEqual(self.authorizer.calls[-1], ('/simple1', True, False))
+
+        self.authorizer.allow_push = True
+        result = self._batch('upload', [
+            {'oid': oid, 'size': size},
+            {'oid': other, 'size': other_size},
+            {'oid': missing, 'size': 1},
+            {'oid': missing, 'size': store.maximum + 1},
+        ])
+        # the objects stored for other repositories are to be uploaded.
+        self.assertEqual(result['objects'], [
+            {'oid': oid, 'size': size},
+            {'oid': other, 'size': other_size, 'actions': {'upload': {
+                'href': 'http://localhost/simple1/info/lfs/objects/' +
+                    other}}},
+            {'oid': missing, 'size': 1, 'actions': {'upload': {'href':
+                'http://localhost/simple1/info/lfs/objects/' + missing}}},
+            {'oid': missing, 'size': store.maximum + 1, 'error': {
+                'code': 422, 'message': 'Object too large'}},
+        ])
+
+    def test_0302_lfs_batch_invalid(self):
+        self._large_files()
+        status, headers, result = self.request('POST',
+            '/simple1/info/lfs/objects/batch', body='{')
+        self.assertEqual(status, '400 Bad Request')
+        status, headers, result = self.request('POST',
+            '/simple1/info/lfs/objects/batch', body=json.dumps({
+                'operation': 'delete', 'objects': []}))
+        self.assertEqual(status, '422 Unprocessable Entity')
+
+    def test_0303_lfs_batch_other_repository(self):
+        store = self._large_files()
+        oid, size = store.add(iter(['data']))
+        self._commit_pointer(oid, size, 'simple2')
+        # only the workspace that references the object has it.
+        result = self._batch('download', [{'oid': oid, 'size': size}])
+        self.assertEqual(result['objects'], [
+            {'oid': oid, 'size': size, 'error': {
+                'code': 404, 'message': 'Object does not exist'}},
+        ])
+        result = self._batch('download', [{'oid': oid, 'size': size}],
+            name='simple2')
+        self.assertTrue('actions' in result['objects'][0])
+
+    def test_0310_lfs_download(self):
+        store = self._large_files()
+        oid, size = store.add(iter(['data']))
+        path = '/simple1/info/lfs/objects/' + oid
+        status, headers, result = self.request('GET', path)
+        self.assertEqual(status, '404 Not Found')
+
+        self._commit_pointer(oid, size)
+        status, headers, result = self.request('GET', path)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['ETag'], '"%s"' % oid)
+        self.assertEqual(result, 'data')
+        status, headers, result = self.request('GET',
+            '/simple1/info/lfs/objects/' + '0' * 64)
+        self.assertEqual(status, '404 Not Found')
+        self.assertEqual(self.authorizer.calls[-1], ('/simple1', False, False))
+
+    def test_0320_lfs_upload(self):
+        store = self._large_files()
+        oid = hashlib.sha256('data').hexdigest()
+        path = '/simple1/info/lfs/objects/' + oid
+        status, headers, result = self.request('PUT', path, body='data')
+        self.assertEqual(status, HTTP_UNAUTHORIZED)
+        self.assertEqual(self.authorizer.calls[-1], ('/simple1', True, False))
+        self.assertFalse(store.has(oid))
+
+        self.authorizer.allow_push = True
+        status, headers, result = self.request('PUT', path, body='other')
+        self.assertEqual(status, '422 Unprocessable Entity')
+        self.assertFalse(store.has(oid))
+        status, headers, result = self.request('PUT', path, body='data')
+        self.assertEqual(status, '200 OK')
+        with store.open(oid) as f:
+            self.assertEqual(f.read(), 'data')
+        # the uploaded object is available to this workspace only.
+        status, headers, result = self.request('GET', path)
+        self.assertEqual(status, '200 OK')
+        status, headers, result = self.request('GET',
+            '/simple2/info/lfs/objects/' + oid)
+        self.assertEqual(status, '404 Not Found')
+
+    def test_0321_lfs_upload_too_large(self):
+        store = self._large_files()
+        os.environ[MAX_ENV] = '4'
+        self.addCleanup(os.environ.pop, MAX_ENV)
+        self.authorizer.allow_push = True
+        oid = hashlib.sha256('large').hexdigest()
+        path = '/simple1/info/lfs/objects/' + oid
+        status, headers, result = self.request('PUT', path, body='large')
+        self.assertEqual(status, '413 Request Entity Too Large')
+        self.assertFalse(store.has(oid))
+
+    def test_0330_lfs_not_enabled(self):
+        status, headers, result = self.request('POST',
+            '/simple1/info/lfs/objects/batch', body=json.dumps({
+                'operation': 'download', 'objects': []}))
+        self.assertEqual(status, '404 Not Found')
+        status, headers, result = self.request('GET',
+            '/simple1/info/lfs/objects/' + '0' * 64)
+        self.assertEqual(status, '404 Not Found')
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(ServerTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
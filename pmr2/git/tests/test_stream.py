@@ -0,0 +1,180 @@
+import unittest
+import tempfile
+import shutil
+import os
+from os.path import join
+
+from pygit2 import Repository
+from pygit2 import Signature
+from pygit2 import GIT_FILEMODE_BLOB
+
+from dulwich.object_store import DiskObjectStore
+
+from pmr2.git import maintenance
+from pmr2.git import stream
+from pmr2.git.derived import DerivedData
+from pmr2.git.stream import BlobStream, SPILL_KIND, object_size
+
+from pmr2.git.tests import util
+
+
+class StreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        util.extract_archive(self.testdir)
+        self.path = join(self.testdir, 'simple1', '.git')
+        self.repo = Repository(self.path)
+        self.derived = DerivedData(self.path)
+        self.git_executable = maintenance.git_executable
+        self.threshold = stream.STREAM_THRESHOLD
+        self.spill_limit = stream.SPILL_LIMIT
+
+    def tearDown(self):
+        maintenance.git_executable = self.git_executable
+        stream.STREAM_THRESHOLD = self.threshold
+        stream.SPILL_LIMIT = self.spill_limit
+        shutil.rmtree(self.testdir)
+
+    def _large(self):
+        # two large blobs, one to be stored as a delta of the other.
+        data = os.urandom(3 << 19)
+        other = data[:1000] + 'changed' + data[1007:]
+        shas = [self.repo.create_blob(data).hex,
+            self.repo.create_blob(other).hex]
+        builder = self.repo.TreeBuilder()
+        builder.insert('data', shas[0], GIT_FILEMODE_BLOB)
+        builder.insert('other', shas[1], GIT_FILEMODE_BLOB)
+        sig = Signature('user', 'user@example.com', 1400000000, 0)
+        self.repo.create_commit('refs/heads/large', sig, sig, 'large',
+            builder.write(), [])
+        maintenance.git(self.path, 'repack', '-q', '-a', '-d', '-f')
+        streams = [BlobStream(self.path, sha, self.derived) for sha in shas]
+        self.assertEqual(sorted(s.deltified for s in streams),
+            [False, True])
+        return dict((s.deltified, (s, d))
+            for s, d in zip(streams, [data, other]))
+
+    def assertRanges(self, blob, data):
+        self.assertEqual(blob.size, len(data))
+        self.assertEqual(''.join(blob), data)
+        self.assertEqual(blob.read(), data)
+        for start, end in [(0, 1), (5, 70000), (len(data) - 10, None),
+                (len(data) - 10, len(data) + 10)]:
+            self.assertEqual(blob.read(start, end), data[start:end])
+        self.assertEqual(blob.read(len(data)), '')
+        self.assertEqual(blob.read(10, 5), '')
+
+    def test_0000_loose(self):
+        entry = self.repo.revparse_single('HEAD').tree['README']
+        blob = BlobStream(self.path, entry.hex)
+        self.assertFalse(blob.deltified)
+        self.assertRanges(blob, self.repo[entry.oid].read_raw())
+
+    def test_0010_missing(self):
+        self.assertRaises(KeyError, BlobStream, self.path, '0' * 40)
+        tree = self.repo.revparse_single('HEAD').tree
+        self.assertRaises(KeyError, BlobStream, self.path, tree.hex)
+
+    def test_0020_object_size(self):
+        store = DiskObjectStore(join(self.path, 'objects'))
+        tree = self.repo.revparse_single('HEAD').tree
+        self.assertEqual(object_size(store, tree['README'].hex),
+            self.repo[tree['README'].oid].size)
+        self.assertRaises(KeyError, object_size, store, '0' * 40)
+        if maintenance.git_executable is None:
+            return
+        for deltified, (blob, data) in self._large().items():
+            self.assertEqual(object_size(
+                DiskObjectStore(join(self.path, 'objects')), blob.sha),
+                len(data))
+
+    def test_0021_object_type(self):
+        store = DiskObjectStore(join(self.path, 'objects'))
+        self.assertRaises(KeyError, stream.object_type, store, '0' * 40)
+        if maintenance.git_executable is None:
+            return
+        self._large()
+        store = DiskObjectStore(join(self.path, 'objects'))
+        for sha in store:
+            self.assertEqual(stream.object_type(store, sha),
+                store[sha].type_num)
+        # as for the loose objects.
+        sha = self.repo.create_blob('loose').hex
+        self.assertEqual(stream.object_type(store, sha), 3)
+
+    def test_0100_packed(self):
+        if maintenance.git_executable is None:
+            return
+        blob, data = self._large()[False]
+        self.assertRanges(blob, data)
+        self.assertEqual(self.derived.keys(SPILL_KIND), [])
+
+    def test_0110_packed_deltified(self):
+        if maintenance.git_executable is None:
+            return
+        blob, data = self._large()[True]
+        self.assertRanges(blob, data)
+        self.assertEqual(self.derived.keys(SPILL_KIND), [blob.sha])
+        # served from the spill file from then on.
+        self.derived.put(SPILL_KIND, blob.sha, 'x' * blob.size)
+        self.assertEqual(blob.read(0, 3), 'xxx')
+
+    def test_0101_packed_read_at(self):
+        if maintenance.git_executable is None:
+            return
+        blob, data = self._large()[False]
+        self.assertEqual(''.join(blob.read_at(10, 20)), data[10:20])
+        # spilled, to be read by seeking.
+        self.assertEqual(self.derived.keys(SPILL_KIND), [blob.sha])
+        self.assertEqual(''.join(blob.read_at(len(data) - 5)), data[-5:])
+
+    def test_0111_packed_deltified_dulwich(self):
+        if maintenance.git_executable is None:
+            return
+        blob, data = self._large()[True]
+        maintenance.git_executable = None
+        self.assertRanges(blob, data)
+        self.assertEqual(self.derived.keys(SPILL_KIND), [blob.sha])
+
+    def test_0113_packed_unspilled(self):
+        if maintenance.git_executable is None:
+            return
+        large = self._large()
+        stream.SPILL_LIMIT = large[True][0].size - 1
+        for deltified, (blob, data) in large.items():
+            self.assertRanges(blob, data)
+            self.assertEqual(''.join(blob.read_at(len(data) - 5)),
+                data[-5:])
+        # too large to be spilled, so read through instead.
+        self.assertEqual(self.derived.keys(SPILL_KIND), [])
+
+    def test_0114_packed_spill_trimmed(self):
+        if maintenance.git_executable is None:
+            return
+        large = self._large()
+        blob, data = large[True]
+        stream.SPILL_LIMIT = blob.size
+        self.assertEqual(blob.read(10, 20), data[10:20])
+        other, data = large[False]
+        self.assertEqual(''.join(other.read_at(10, 20)), data[10:20])
+        # the earlier spill is trimmed for the one just made.
+        self.assertEqual(self.derived.keys(SPILL_KIND), [other.sha])
+
+    def test_0112_packed_deltified_small(self):
+        if maintenance.git_executable is None:
+            return
+        blob, data = self._large()[True]
+        stream.STREAM_THRESHOLD = blob.size + 1
+        self.assertRanges(blob, data)
+        self.assertEqual(self.derived.keys(SPILL_KIND), [])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(StreamTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
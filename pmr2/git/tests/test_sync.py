@@ -0,0 +1,67 @@
+import unittest
+import threading
+import time
+
+from pmr2.git.sync import BulkSync
+from pmr2.git.sync import host_of
+
+
+class BulkSyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.active = {}
+        self.peak = {}
+
+    def sync(self, path, identifier):
+        host = host_of(identifier)
+        with self.lock:
+            self.active[host] = self.active.get(host, 0) + 1
+            self.peak[host] = max(self.peak.get(host, 0), self.active[host])
+        time.sleep(0.02)
+        with self.lock:
+            self.active[host] -= 1
+        if identifier.endswith('bad'):
+            raise ValueError('remote not supported: %s' % identifier)
+        return True, 'synced %s' % path
+
+    def test_0000_host_of(self):
+        self.assertEqual(host_of('http://Example.com/w/a'), 'example.com')
+        self.assertEqual(host_of('https://example.com:8080/w/a'),
+            'example.com:8080')
+        self.assertEqual(host_of('/var/pmr2/w/a'), '')
+
+    def test_0100_bulk_sync(self):
+        jobs = [('/repo/%d' % i, 'http://host%d.example.com/w/%d' % (
+            i % 2, i)) for i in range(12)]
+        jobs.append(('/repo/bad', 'ftp://example.com/bad'))
+        results = BulkSync(self.sync, max_workers=6, max_per_host=2)(jobs)
+        self.assertEqual([r.path for r in results], [j[0] for j in jobs])
+        self.assertTrue(all(r.success for r in results[:-1]))
+        self.assertEqual(results[0].message, 'synced /repo/0')
+        self.assertFalse(results[-1].success)
+        self.assertEqual(results[-1].error,
+            'ValueError: remote not supported: ftp://example.com/bad')
+        self.assertTrue(results[-1].duration >= 0)
+        self.assertEqual(self.peak['host0.example.com'], 2)
+        self.assertEqual(self.peak['host1.example.com'], 2)
+
+    def test_0110_bulk_sync_same_repo(self):
+        jobs = [('/repo/1', 'http://host%d.example.com/w/1' % i)
+            for i in range(4)]
+        results = BulkSync(self.sync, max_workers=4)(jobs)
+        self.assertTrue(all(r.success for r in results))
+        self.assertEqual(max(self.peak.values()), 1)
+
+    def test_0120_bulk_sync_empty(self):
+        self.assertEqual(BulkSync(self.sync)([]), [])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(BulkSyncTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
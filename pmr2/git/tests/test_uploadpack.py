@@ -0,0 +1,331 @@
+import unittest
+import tempfile
+import shutil
+import os
+from distutils.spawn import find_executable
+from os.path import join
+from cStringIO import StringIO
+from subprocess import Popen, PIPE
+
+from dulwich.pack import PackData
+from dulwich.protocol import pkt_line
+from dulwich.repo import Repo
+
+from pmr2.git import uploadpack
+from pmr2.git.uploadpack import FLUSH, DELIM
+
+from pmr2.git.tests import util
+
+
+def make_request(command, args, caps=('agent=git/2.x',)):
+    lines = [pkt_line('command=%s\n' % command)]
+    lines.extend(pkt_line('%s\n' % c) for c in caps)
+    lines.append(DELIM)
+    lines.extend(pkt_line('%s\n' % a) for a in args)
+    lines.append(FLUSH)
+    return ''.join(lines)
+
+
+def read_response(raw):
+    return list(uploadpack.read_pkt_lines(StringIO(raw).read))
+
+
+def read_pack(raw):
+    """
+    Return the pack data sent through the data side-band.
+    """
+
+    stream = StringIO(raw)
+    data = []
+    while True:
+        size = stream.read(4)
+        if not size:
+            break
+        if size in (FLUSH, DELIM):
+            continue
+        payload = stream.read(int(size, 16) - 4)
+        if payload.startswith('\x01'):
+            data.append(payload[1:])
+    return ''.join(data)
+
+
+class UploadPackV2TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        util.extract_archive(self.testdir)
+        self.repo = Repo(join(self.testdir, 'simple1', '.git'))
+        self.head = 'bfdd13c821b614d2b5e7d5b10c3ff70147c5107a'
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def run_command(self, command, args):
+        out = StringIO()
+        request = make_request(command, args)
+        command, caps, args = uploadpack.parse_request(StringIO(request).read)
+        uploadpack.commands[command](self.repo, args, out.write)
+        return out.getvalue()
+
+    def test_0000_protocol_version(self):
+        self.assertEqual(uploadpack.protocol_version({}), 0)
+        self.assertEqual(uploadpack.protocol_version(
+            {'HTTP_GIT_PROTOCOL': 'version=2'}), 2)
+        self.assertEqual(uploadpack.protocol_version(
+            {'HTTP_GIT_PROTOCOL': 'foo=bar:version=2'}), 2)
+        self.assertEqual(uploadpack.protocol_version(
+            {'HTTP_GIT_PROTOCOL': 'version=1'}), 0)
+
+    def test_0010_parse_request(self):
+        request = make_request('ls-refs', ['peel', 'ref-prefix HEAD'])
+        command, caps, args = uploadpack.parse_request(StringIO(request).read)
+        self.assertEqual(command, 'ls-refs')
+        self.assertEqual(caps, ['agent=git/2.x'])
+        self.assertEqual(args, ['peel', 'ref-prefix HEAD'])
+
+    def test_0011_parse_request_truncated(self):
+        request = make_request('ls-refs', ['peel'])[:-6]
+        self.assertRaises(uploadpack.ProtocolError,
+            uploadpack.parse_request, StringIO(request).read)
+
+    def test_0100_ls_refs(self):
+        result = read_response(self.run_command('ls-refs', ['symrefs']))
+        self.assertEqual(result, [
+            '%s HEAD symref-target:refs/heads/master' % self.head,
+            '%s refs/heads/master' % self.head,
+            FLUSH,
+        ])
+
+    def test_0110_ls_refs_prefix(self):
+        self.repo.refs['refs/heads/other'] = self.head
+        self.repo.refs['refs/tags/v1'] = self.head
+        result = read_response(self.run_command('ls-refs', [
+            'ref-prefix refs/heads/ma', 'ref-prefix refs/tags/']))
+        self.assertEqual(result, [
+            '%s refs/heads/master' % self.head,
+            '%s refs/tags/v1' % self.head,
+            FLUSH,
+        ])
+
+    def test_0200_fetch_done(self):
+        result = self.run_command('fetch', [
+            'want %s' % self.head, 'no-progress', 'done'])
+        self.assertTrue(result.startswith(pkt_line('packfile\n')))
+        pack = read_pack(result)
+        self.assertTrue(pack.startswith('PACK'))
+        data = PackData.from_file(StringIO(pack), len(pack))
+        objects = self.repo.object_store.find_missing_objects([], [self.head])
+        self.assertEqual(len(data), len(list(objects)))
+
+    def test_0210_fetch_negotiate(self):
+        base = '859d37af12a86709773931ea4decc2fa12971ff7'
+        result = self.run_command('fetch', [
+            'want %s' % self.head, 'have %s' % base, 'have ' + 'a' * 40])
+        self.assertTrue(result.startswith(''.join([
+            pkt_line('acknowledgments\n'),
+            pkt_line('ACK %s\n' % base),
+            pkt_line('ready\n'),
+            DELIM,
+            pkt_line('packfile\n'),
+        ])))
+        self.assertTrue(result.endswith(FLUSH))
+
+    def test_0211_fetch_negotiate_nak(self):
+        result = self.run_command('fetch', [
+            'want %s' % self.head, 'have ' + 'a' * 40])
+        self.assertEqual(result, ''.join([
+            pkt_line('acknowledgments\n'),
+            pkt_line('NAK\n'),
+            FLUSH,
+        ]))
+
+    def test_0220_fetch_not_our_ref(self):
+        self.assertRaises(uploadpack.ProtocolError, self.run_command,
+            'fetch', ['want ' + 'a' * 40, 'done'])
+
+    def test_0300_parse_filter(self):
+        self.assertEqual(uploadpack.parse_filter('blob:none'), 0)
+        self.assertEqual(uploadpack.parse_filter('blob:limit=10'), 10)
+        self.assertEqual(uploadpack.parse_filter('blob:limit=2k'), 2048)
+        self.assertRaises(uploadpack.ProtocolError,
+            uploadpack.parse_filter, 'tree:0')
+        self.assertRaises(uploadpack.ProtocolError,
+            uploadpack.parse_filter, 'blob:limit=x')
+
+    def test_0310_fetch_deepen(self):
+        result = self.run_command('fetch', [
+            'want %s' % self.head, 'deepen 1', 'no-progress', 'done'])
+        self.assertTrue(result.startswith(''.join([
+            pkt_line('shallow-info\n'),
+            pkt_line('shallow %s\n' % self.head),
+            DELIM,
+            pkt_line('packfile\n'),
+        ])))
+        pack = read_pack(result)
+        data = PackData.from_file(StringIO(pack), len(pack))
+        # the commit, its tree and the entries of the tree.
+        commit = self.repo[self.head]
+        tree = self.repo[commit.tree]
+        self.assertEqual(len(data), 2 + len(tree))
+
+    def test_0311_fetch_unshallow(self):
+        result = self.run_command('fetch', [
+            'want %s' % self.head, 'shallow %s' % self.head,
+            'deepen 2147483647', 'no-progress', 'done'])
+        self.assertTrue(result.startswith(''.join([
+            pkt_line('shallow-info\n'),
+            pkt_line('unshallow %s\n' % self.head),
+            DELIM,
+        ])))
+
+    def test_0312_fetch_deepen_haves(self):
+        parent = 'c90c2791cbb1eb5b06e76f9a8ebafaf7aeeb6f98'
+        result = self.run_command('fetch', [
+            'want %s' % self.head, 'have %s' % self.head,
+            'shallow %s' % self.head, 'deepen 2', 'no-progress', 'done'])
+        self.assertTrue(result.startswith(''.join([
+            pkt_line('shallow-info\n'),
+            pkt_line('shallow %s\n' % parent),
+            pkt_line('unshallow %s\n' % self.head),
+            DELIM,
+        ])))
+        pack = read_pack(result)
+        data = PackData.from_file(StringIO(pack), len(pack))
+        # only the parent and its tree, as the client has the blobs.
+        types = sorted(type_num for offset, type_num, chunks, crc32
+            in data.iterobjects())
+        self.assertEqual(types, [1, 2])
+
+    def test_0313_fetch_deepen_not(self):
+        root = '859d37af12a86709773931ea4decc2fa12971ff7'
+        parent = 'c90c2791cbb1eb5b06e76f9a8ebafaf7aeeb6f98'
+        self.repo.refs['refs/tags/v1'] = root
+        # the name is looked up as git does.
+        result = self.run_command('fetch', [
+            'want %s' % self.head, 'deepen-not v1', 'no-progress', 'done'])
+        self.assertTrue(result.startswith(''.join([
+            pkt_line('shallow-info\n'),
+            pkt_line('shallow %s\n' % parent),
+            DELIM,
+        ])))
+        self.assertRaises(uploadpack.ProtocolError, self.run_command,
+            'fetch', ['want %s' % self.head, 'deepen-not missing', 'done'])
+
+    def test_0314_fetch_deepen_and_deepen_not(self):
+        self.assertRaises(uploadpack.ProtocolError, self.run_command,
+            'fetch', ['want %s' % self.head, 'deepen 1',
+                'deepen-not refs/heads/master', 'done'])
+
+    def test_0320_fetch_filter_blob_none(self):
+        result = self.run_command('fetch', [
+            'want %s' % self.head, 'filter blob:none', 'no-progress',
+            'done'])
+        pack = read_pack(result)
+        data = PackData.from_file(StringIO(pack), len(pack))
+        types = set(type_num for offset, type_num, chunks, crc32
+            in data.iterobjects())
+        # only commits (1) and trees (2).
+        self.assertEqual(types, set([1, 2]))
+
+    def test_0322_fetch_filter_blob_limit(self):
+        result = self.run_command('fetch', [
+            'want %s' % self.head, 'filter blob:limit=13', 'no-progress',
+            'done'])
+        pack = read_pack(result)
+        data = PackData.from_file(StringIO(pack), len(pack))
+        sizes = sorted(sum(len(c) for c in chunks)
+            for offset, type_num, chunks, crc32 in data.iterobjects()
+            if type_num == 3)
+        # all but test3, which is 18 bytes.
+        self.assertEqual(sizes, [6, 6, 6, 12, 12])
+
+    def test_0321_fetch_filter_wanted_blob(self):
+        blob = [e.sha for e in self.repo[self.repo[self.head].tree].items()
+            if e.mode & 0o100000][0]
+        result = self.run_command('fetch', [
+            'want %s' % blob, 'filter blob:none', 'no-progress', 'done'])
+        pack = read_pack(result)
+        data = PackData.from_file(StringIO(pack), len(pack))
+        self.assertEqual(len(data), 1)
+
+
+class GitClientTestCase(unittest.TestCase):
+    """
+    Clones by git itself through protocol version 2.
+    """
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        util.extract_archive(self.testdir)
+        self.server = util.GitHTTPServer(self.testdir)
+        self.server.start()
+        self.target = join(self.testdir, 'target')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.testdir)
+
+    def git(self, *args):
+        p = Popen(('git', '-c', 'protocol.version=2') + args, stdout=PIPE,
+            stderr=PIPE, env=dict(os.environ, GIT_TERMINAL_PROMPT='0'))
+        out, err = p.communicate()
+        self.assertEqual(p.returncode, 0, err)
+        return out
+
+    def clone(self, *args):
+        self.git('clone', '-q', '--no-checkout', *(args + (
+            self.server.url + '/simple1', self.target)))
+
+    def commits(self):
+        return self.git('-C', self.target, 'rev-list', 'HEAD').split()
+
+    def missing(self):
+        # the objects git knows of but the clone does not have.
+        return [line[1:] for line in self.git('-C', self.target,
+            'rev-list', '--objects', '--missing=print', 'HEAD').split('\n')
+            if line.startswith('?')]
+
+    def test_0000_clone_depth(self):
+        if find_executable('git') is None:
+            return
+        self.clone('--depth', '1')
+        self.assertEqual(len(self.commits()), 1)
+        self.assertEqual(self.missing(), [])
+        self.git('-C', self.target, 'fsck', '--no-progress')
+
+    def test_0010_clone_shallow_exclude(self):
+        if find_executable('git') is None:
+            return
+        Repo(join(self.testdir, 'simple1')).refs['refs/tags/v1'] = (
+            '859d37af12a86709773931ea4decc2fa12971ff7')
+        self.clone('--shallow-exclude=v1')
+        self.assertEqual(len(self.commits()), 2)
+
+    def test_0100_clone_filter_blob_none(self):
+        if find_executable('git') is None:
+            return
+        self.clone('--filter=blob:none')
+        self.assertEqual(len(self.commits()), 3)
+        missing = self.missing()
+        self.assertTrue(missing)
+        # which git then fetches when needed.
+        self.assertEqual(self.git('-C', self.target, 'cat-file', '-t',
+            missing[0]), 'blob\n')
+
+    def test_0110_clone_filter_blob_limit(self):
+        if find_executable('git') is None:
+            return
+        self.clone('--filter=blob:limit=13')
+        # only test3, of 18 bytes.
+        self.assertEqual(len(self.missing()), 1)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(UploadPackV2TestCase))
+    suite.addTest(makeSuite(GitClientTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
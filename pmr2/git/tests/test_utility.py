@@ -1,6 +1,7 @@
 import unittest
 import tempfile
 import shutil
+import errno
 import os
 from time import time
 import tarfile
@@ -25,8 +26,22 @@ from pygit2 import Repository
 from pygit2 import init_repository
 from pygit2 import Signature
 from pygit2 import GIT_FILEMODE_BLOB, GIT_FILEMODE_TREE
+from pygit2 import GIT_DELTA_ADDED, GIT_DELTA_DELETED
+
+from dulwich.repo import Repo as DulwichRepo
+from dulwich.server import DictBackend
+from dulwich.web import make_wsgi_chain
 
 import pmr2.git
+import pmr2.git.bloom
+import pmr2.git.derived
+import pmr2.git.diff
+import pmr2.git.largefile
+import pmr2.git.lock
+import pmr2.git.maintenance
+import pmr2.git.partial
+import pmr2.git.pool
+import pmr2.git.utility
 from pmr2.git import *
 from pmr2.git.interfaces import *
 from pmr2.git.utility import *
@@ -160,7 +175,13 @@ class TestCase(unittest.TestCase):
         self.simple2 = DummyWorkspace(join(self.testdir, 'simple2'))
         self.simple3 = DummyWorkspace(join(self.testdir, 'simple3'))
 
+        # no prewarming in the background while the tests run.
+        self.prewarm_queue = pmr2.git.derived.queue
+        pmr2.git.derived.queue = pmr2.git.maintenance.MaintenanceQueue(
+            delay=3600, maintain=pmr2.git.derived._prewarm)
+
     def tearDown(self):
+        pmr2.git.derived.queue = self.prewarm_queue
         shutil.rmtree(self.testdir)
 
     def assertEqualAnswerTable(self, answer_table, results):
@@ -231,6 +252,39 @@ class StorageTestCase(TestCase):
         self.assertRaises(RevisionNotFoundError, storage.log, 'xxxxxxxxxx', 10)
         self.assertRaises(RevisionNotFoundError, storage.log, 'abcdef1234', 10)
 
+    def assertLog(self, storage, path, answer):
+        # the commits of the fixture may share their times.
+        self.assertEqual(
+            sorted(c['node'] for c in storage.log(None, 10, path=path)),
+            sorted(self.revs[i] for i in answer))
+
+    def test_260_storage_log_path(self):
+        storage = GitStorage(self.workspace)
+        self.assertLog(storage, 'file1', [1, 0])
+        self.assertLog(storage, 'file2', [2, 0])
+        self.assertLog(storage, 'file3', [2])
+        self.assertLog(storage, self.nested_name, [3])
+        self.assertLog(storage, 'nested/deep', [3])
+        self.assertLog(storage, '/nested/', [3])
+        self.assertLog(storage, 'missing', [])
+        self.assertEqual(len(list(storage.log(None, 1, path='file1'))), 1)
+
+    def test_261_storage_log_path_filtered(self):
+        storage = GitStorage(self.workspace)
+        index = pmr2.git.bloom.ChangedPathIndex(storage.derived)
+        self.assertEqual(index.update(storage.repo), 4)
+        self.assertLog(storage, 'file1', [1, 0])
+        self.assertLog(storage, 'file2', [2, 0])
+        self.assertLog(storage, 'nested/deep', [3])
+        self.assertLog(storage, 'missing', [])
+
+        # the commits the filters rule out are never looked at.
+        index.filters = dict((sha, pmr2.git.bloom.make_filter([]))
+            for sha in index.filters)
+        storage.derived.put_chunks(pmr2.git.bloom.KIND, 'filters',
+            index._chunks())
+        self.assertLog(storage, 'file1', [])
+
     def test_300_storage_file(self):
         storage = GitStorage(self.workspace)
         file = storage.file('file3')
@@ -325,6 +379,17 @@ class StorageTestCase(TestCase):
         result = list(pathinfo['contents']())
         self.assertEqualAnswerTable(answer_table, result)
 
+    def test_504_listdir_sizes_derived(self):
+        storage = GitStorage(self.workspace)
+        tree = storage.repo.revparse_single(self.revs[3]).tree
+        list(storage.listdir(''))
+        self.assertTrue(storage.derived.get('sizes', tree.hex))
+        # the sizes derived before are used.
+        storage.derived.put('sizes', tree.hex, '{"file1": 1}')
+        result = list(storage.listdir(''))
+        self.assertEqual([r['size'] for r in result],
+            ['', '1', '', '', ''])
+
     def test_501_listdir_root(self):
         storage = GitStorage(self.workspace)
         storage.checkout(self.revs[3])
@@ -419,6 +484,36 @@ class StorageTestCase(TestCase):
         # guess_type does not return anything for that.
         self.assertTrue(result['mimetype']().startswith('text/plain'))
 
+    def test_604_blobstream(self):
+        storage = GitStorage(self.workspace)
+        blob = storage.blobstream('file3')
+        self.assertEqual(blob.size, len(self.files[0]))
+        self.assertEqual(''.join(blob), self.files[0])
+        self.assertEqual(blob.read(2, 6), self.files[0][2:6])
+        blob = storage.blobstream('/nested/deep/dir/file')
+        self.assertEqual(blob.read(), self.nested_file)
+        self.assertRaises(PathNotFoundError, storage.blobstream, 'nested')
+        self.assertRaises(PathNotFoundError, storage.blobstream, 'missing')
+        storage.checkout(self.revs[0])
+        self.assertRaises(PathNotFoundError, storage.blobstream, 'file3')
+
+    def test_605_lines(self):
+        storage = GitStorage(self.workspace)
+        lines = self.nested_file.splitlines(True)
+        self.assertEqual(storage.linecount(self.nested_name), 3)
+        self.assertEqual(storage.lines(self.nested_name), lines)
+        self.assertEqual(storage.lines(self.nested_name, 1, 2), lines[1:2])
+        self.assertEqual(storage.lines(self.nested_name, 2), lines[2:])
+        self.assertRaises(PathNotFoundError, storage.lines, 'missing')
+
+    def test_603_pathinfo_magic_derived(self):
+        storage = GitStorage(self.workspace)
+        blob = storage.repo.revparse_single(self.revs[0]).tree['file1']
+        storage.derived.put('mimetype', blob.hex, 'text/x-derived')
+        storage.checkout(self.revs[0])
+        result = storage.pathinfo('file1')
+        self.assertEqual(result['mimetype'](), 'text/x-derived')
+
     def test_601_pathinfo_magic(self):
         self.maxDiff = 1022
         storage = GitStorage(self.workspace)
@@ -738,6 +833,273 @@ class StorageTestCase(TestCase):
             self.assert_(a in result)
             self.assertEqual(tfile.extractfile(a).read(), c)
 
+    def test_740_archive_prewarmed(self):
+        storage = GitStorage(self.workspace)
+        pmr2.git.derived.prewarm(join(self.repodir, '.git'),
+            self.workspace.id)
+        key = pmr2.git.derived.archive_key(
+            self.revs[3], self.workspace.id, 'zip')
+        storage.derived.put('archive', key, 'prewarmed')
+        self.assertEqual(storage.archive('zip'), 'prewarmed')
+        # other commits have theirs built on request.
+        storage.checkout(self.revs[0])
+        zfile = zipfile.ZipFile(StringIO(storage.archive('zip')))
+        self.assertEqual(len(zfile.infolist()), 2)
+
+    def assertBatch(self, batch, paths, single):
+        for path in paths:
+            try:
+                answer = single(path)
+            except PathInvalidError as e:
+                self.assertEqual(type(batch[path]), type(e))
+                self.assertEqual(str(batch[path]), str(e))
+                continue
+            result = batch[path]
+            if not isinstance(answer, dict):
+                # the contents of a file, read as called.
+                self.assertEqual(result(), answer)
+                continue
+            self.assertEqual(sorted(result), sorted(answer))
+            for key, value in answer.items():
+                if not callable(value):
+                    self.assertEqual(result[key], value)
+            if not callable(answer['contents']):
+                continue
+            contents = answer['contents']()
+            if isinstance(contents, str):
+                self.assertEqual(result['contents'](), contents)
+            else:
+                # the listing of a directory.
+                self.assertEqual([i['file'] for i in result['contents']()],
+                    [i['file'] for i in contents])
+
+    def test_800_file_batch(self):
+        storage = GitStorage(self.workspace)
+        paths = ['file1', 'file3', 'nested/deep/dir/file', '/file2',
+            'nested/deep', 'nested/deep/missing', 'file1/file', 'missing',
+            '']
+        result = storage.file_batch(paths)
+        self.assertEqual(sorted(result), sorted(paths))
+        self.assertEqual(result['nested/deep/dir/file'](), self.nested_file)
+        self.assertTrue(isinstance(result['missing'], PathNotFoundError))
+        self.assertBatch(result, paths, storage.file)
+
+    def test_801_file_batch_walks_once(self):
+        storage = GitStorage(self.workspace)
+        resolved = []
+        resolve = storage._object
+        storage._object = lambda entry: resolved.append(entry.name) or \
+            resolve(entry)
+        result = storage.file_batch(['nested/deep/dir/file',
+            'nested/deep/dir/missing', 'nested/file', 'file1'])
+        # the files are only read as called.
+        self.assertEqual(sorted(resolved), ['deep', 'dir', 'nested'])
+        self.assertEqual(result['file1'](), self.files[1])
+        self.assertEqual(sorted(resolved), ['deep', 'dir', 'file1', 'nested'])
+
+    def test_810_pathinfo_batch(self):
+        storage = GitStorage(self.workspace)
+        paths = ['file1', 'nested/deep/dir/file', 'nested/deep', 'nested',
+            '', 'nested/deep/missing', 'file1/file', 'missing']
+        result = storage.pathinfo_batch(paths)
+        self.assertEqual(sorted(result), sorted(paths))
+        self.assertBatch(result, paths, storage.pathinfo)
+
+        storage.checkout(self.revs[0])
+        paths = ['file1', 'file3', 'nested']
+        self.assertBatch(storage.pathinfo_batch(paths), paths,
+            storage.pathinfo)
+
+    def test_811_pathinfo_batch_external(self):
+        storage = GitStorage(self.repodata)
+        storage.checkout(util.ARCHIVE_REVS[1])
+        paths = ['ext/import1/', 'ext/import1/some/file', 'ext/import2',
+            'ext', 'ext/import1']
+        result = storage.pathinfo_batch(paths)
+        self.assertBatch(result, paths, storage.pathinfo)
+        self.assertEqual(result['ext/import1/some/file']['external']['path'],
+            'some/file')
+        paths = ['ext/import1/', 'ext/import1/some/file']
+        self.assertBatch(storage.file_batch(paths), paths, storage.file)
+
+    def test_812_pathinfo_batch_empty(self):
+        empty = join(self.testdir, 'empty')
+        init_repository(join(empty, '.git'), bare=True)
+        storage = GitStorage(DummyWorkspace(empty))
+        result = storage.pathinfo_batch(['', 'file'])
+        self.assertEqual(result['']['permissions'],
+            storage.pathinfo('')['permissions'])
+        self.assertTrue(isinstance(result['file'], PathNotFoundError))
+
+    def assertChanges(self, changes, answer):
+        self.assertEqual([(c['status'], c['oldpath'], c['path'])
+            for c in changes], answer)
+
+    def test_900_diff(self):
+        storage = GitStorage(self.workspace)
+        self.assertChanges(storage.diff(self.revs[1], self.revs[2]), [
+            ('modified', 'file2', 'file2'),
+            ('added', 'file3', 'file3'),
+            ('added', 'image.png', 'image.png'),
+        ])
+        self.assertChanges(storage.diff(self.revs[2], self.revs[0]), [
+            ('modified', 'file1', 'file1'),
+            ('modified', 'file2', 'file2'),
+            ('removed', 'file3', 'file3'),
+            ('removed', 'image.png', 'image.png'),
+        ])
+        self.assertChanges(storage.diff(self.revs[3], self.revs[3]), [])
+        # from the first parent of the revision checked out.
+        self.assertChanges(storage.diff(), [
+            ('added', self.nested_name, self.nested_name)])
+        storage.checkout(self.revs[0])
+        self.assertChanges(storage.diff(), [
+            ('added', 'file1', 'file1'),
+            ('added', 'file2', 'file2'),
+        ])
+        self.assertRaises(RevisionNotFoundError, storage.diff, 'missing')
+
+    def test_901_diff_ids_stats(self):
+        storage = GitStorage(self.workspace)
+        repo = storage.repo
+        change, = list(storage.diff(self.revs[0], self.revs[1]))
+        self.assertEqual(change['old'],
+            repo[self.revs[0]].tree['file1'].hex)
+        self.assertEqual(change['new'],
+            repo[self.revs[1]].tree['file1'].hex)
+        # a line added to the end of the file.
+        self.assertEqual(change['stats'](), (1, 0))
+        change, = list(storage.diff(self.revs[2], self.revs[3]))
+        self.assertEqual(change['old'], None)
+        self.assertEqual(change['stats'](), (3, 0))
+        change = list(storage.diff(self.revs[1], self.revs[2]))[2]
+        # a binary file.
+        self.assertEqual(change['stats'](), (0, 0))
+
+    def test_910_diff_renames(self):
+        storage = GitStorage(self.workspace)
+        repo = storage.repo
+        tbder = repo.TreeBuilder(repo[self.revs[3]].tree)
+        tbder.remove('file3')
+        tbder.insert('moved', repo.create_blob(self.files[0] + 'more\n'),
+            GIT_FILEMODE_BLOB)
+        sig = Signature('user4', '4@example.com', int(time()), 0)
+        rev = repo.create_commit(None, sig, sig, 'moved', tbder.write(),
+            [self.revs[3]]).hex
+        self.assertChanges(storage.diff(self.revs[3], rev), [
+            ('removed', 'file3', 'file3'),
+            ('added', 'moved', 'moved'),
+        ])
+        changes = list(storage.diff(self.revs[3], rev, renames=True))
+        self.assertChanges(changes, [('renamed', 'file3', 'moved')])
+        self.assertEqual(changes[0]['stats'](), (1, 0))
+
+    def test_920_diff_empty(self):
+        empty = join(self.testdir, 'empty')
+        init_repository(join(empty, '.git'), bare=True)
+        storage = GitStorage(DummyWorkspace(empty))
+        self.assertEqual(list(storage.diff()), [])
+
+    def test_921_tree_diff_empty(self):
+        repo = Repository(join(self.repodir, '.git'))
+        tree = repo[self.revs[0]].tree
+        added = pmr2.git.diff.tree_diff(None, tree)
+        self.assertEqual([d.status for d in added.deltas],
+            [GIT_DELTA_ADDED] * len(tree))
+        removed = pmr2.git.diff.tree_diff(tree, None)
+        self.assertEqual([d.status for d in removed.deltas],
+            [GIT_DELTA_DELETED] * len(tree))
+        self.assertEqual([d.old_file.path for d in removed.deltas],
+            [d.new_file.path for d in added.deltas])
+        self.assertEqual(pmr2.git.diff.tree_diff(None, None), None)
+
+    def _large_files(self):
+        # a commit with a file large enough to be a pointer.
+        os.environ[pmr2.git.largefile.ROOT_ENV] = join(self.testdir, 'lfs')
+        self.addCleanup(os.environ.pop, pmr2.git.largefile.ROOT_ENV)
+        store = pmr2.git.largefile.large_file_store()
+        repo = Repository(join(self.repodir, '.git'))
+        data = ''.join('%d,%d\n' % (i, i * i) for i in range(1000))
+        tbder = repo.TreeBuilder(repo[self.revs[3]].tree)
+        pointer = pmr2.git.largefile.make_pointer(*store.add(iter([data])))
+        tbder.insert('data', repo.create_blob(pointer), GIT_FILEMODE_BLOB)
+        tbder.insert('small', repo.create_blob('small'), GIT_FILEMODE_BLOB)
+        sig = Signature('user4', '4@example.com', int(time()), 0)
+        repo.create_commit('refs/heads/master', sig, sig, 'added5',
+            tbder.write(), [self.revs[3]])
+        return store, data
+
+    def test_750_large_files(self):
+        store, data = self._large_files()
+        storage = GitStorage(self.workspace)
+        self.assertEqual(storage.file('data'), data)
+        self.assertEqual(storage.file('small'), 'small')
+        info = storage.fileinfo('data')
+        self.assertEqual(info['size'], len(data))
+        self.assertEqual(info['contents'](), data)
+        self.assertEqual(info['mimetype'](),
+            pmr2.git.utility.magic.from_buffer(data[:1000]))
+        self.assertEqual(storage.pathinfo('data')['size'], len(data))
+        listing = dict((i['basename'], i) for i in storage.listdir(''))
+        self.assertEqual(listing['data']['size'], str(len(data)))
+        self.assertEqual(listing['data']['contents'](), data)
+        self.assertEqual(listing['small']['size'], '5')
+        self.assertEqual(storage.blobstream('data').read(10, 20),
+            data[10:20])
+        self.assertEqual(storage.lines('data', 2, 4), ['2,4\n', '3,9\n'])
+
+        root = '%s-%s' % (self.workspace.id, storage.shortrev)
+        zfile = zipfile.ZipFile(StringIO(storage.archive('zip')))
+        self.assertEqual(zfile.read(root + '/data'), data)
+        tfile = tarfile.open('test', 'r:gz', StringIO(storage.archive('tgz')))
+        self.assertEqual(tfile.extractfile(root + '/data').read(), data)
+
+    def test_751_large_files_missing(self):
+        store, data = self._large_files()
+        large = store.resolve(GitStorage(self.workspace)._get_obj('data'))
+        os.remove(store.path(large.sha))
+        storage = GitStorage(self.workspace)
+        self.assertEqual(storage.fileinfo('data')['size'], len(data))
+        self.assertRaises(PathNotFoundError, storage.file, 'data')
+        self.assertRaises(PathNotFoundError, storage.blobstream, 'data')
+        # archived as the pointer.
+        root = '%s-%s' % (self.workspace.id, storage.shortrev)
+        zfile = zipfile.ZipFile(StringIO(storage.archive('zip')))
+        self.assertEqual(zfile.read(root + '/data'),
+            pmr2.git.largefile.make_pointer(large.sha, len(data)))
+
+    def test_752_large_files_disabled(self):
+        store, data = self._large_files()
+        large = store.resolve(GitStorage(self.workspace)._get_obj('data'))
+        os.environ.pop(pmr2.git.largefile.ROOT_ENV)
+        self.addCleanup(os.environ.setdefault, pmr2.git.largefile.ROOT_ENV,
+            '')
+        storage = GitStorage(self.workspace)
+        pointer = pmr2.git.largefile.make_pointer(large.sha, len(data))
+        self.assertEqual(storage.file('data'), pointer)
+        self.assertEqual(storage.fileinfo('data')['size'], len(pointer))
+        listing = dict((i['basename'], i) for i in storage.listdir(''))
+        self.assertEqual(listing['data']['size'], str(len(pointer)))
+
+    def test_753_large_files_archive_streamed(self):
+        store, data = self._large_files()
+        storage = GitStorage(self.workspace)
+
+        def read(self, start=0, end=None):
+            raise AssertionError('large file read whole')
+
+        read_whole = pmr2.git.largefile.LargeFile.read
+        pmr2.git.largefile.LargeFile.read = read
+        self.addCleanup(setattr, pmr2.git.largefile.LargeFile, 'read',
+            read_whole)
+        root = '%s-%s' % (self.workspace.id, storage.shortrev)
+        zfile = zipfile.ZipFile(StringIO(storage.archive('zip')))
+        self.assertEqual(zfile.read(root + '/data'), data)
+        self.assertEqual(zfile.getinfo(root + '/data').compress_type,
+            zipfile.ZIP_DEFLATED)
+        tfile = tarfile.open('test', 'r:gz', StringIO(storage.archive('tgz')))
+        self.assertEqual(tfile.extractfile(root + '/data').read(), data)
+
 
 class UtilityTestCase(TestCase):
 
@@ -751,6 +1113,13 @@ class UtilityTestCase(TestCase):
         self.assert_(isinstance(storage, GitStorage))
         self.assert_(IStorage.providedBy(storage))
 
+    def test_0002_utility_repository_path(self):
+        path = repository_path(self.workspace)
+        storage = GitStorage(self.workspace)
+        self.assertEqual(Repository(path).path, storage.repo.path)
+        missing = DummyWorkspace(join(self.testdir, 'missing'))
+        self.assertRaises(PathInvalidError, repository_path, missing)
+
     def test_0010_utility_create(self):
         repodir = join(self.testdir, 'create_test')
         workspace = DummyWorkspace(repodir)
@@ -818,6 +1187,459 @@ class UtilityTestCase(TestCase):
             'file1', 'file2'
         ])
 
+    def _commit_other_branch(self, path):
+        repo = Repository(join(path, '.git'))
+        tbder = repo.TreeBuilder()
+        tbder.insert('other', repo.create_blob('other branch\n'),
+            GIT_FILEMODE_BLOB)
+        return repo.create_commit('refs/heads/other',
+            Signature('user1', '1@example.com', int(time()), 0),
+            Signature('user1', '1@example.com', int(time()), 0),
+            'other', tbder.write(), [],
+        ).hex
+
+    def _sync_copying(self, utility, workspace, target):
+        # sync as if the repositories are on different devices.
+        def link_objects(source, target):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+        original = pmr2.git.utility.link_objects
+        pmr2.git.utility.link_objects = link_objects
+        try:
+            return utility.sync(workspace, target)
+        finally:
+            pmr2.git.utility.link_objects = original
+
+    def test_0120_sync_branch_only(self):
+        utility = GitStorageUtility()
+        target = join(self.testdir, 'simple1')
+        other = self._commit_other_branch(target)
+
+        self._sync_copying(utility, self.simple2, target)
+        simple2 = Repository(join(self.testdir, 'simple2', '.git'))
+        self.assertEqual(simple2.revparse_single('master').hex,
+            Repository(join(target, '.git')).revparse_single('master').hex)
+        self.assertFalse(other in simple2)
+
+    def _objects(self, path):
+        # the inodes of the object files, keyed by their paths.
+        root = join(path, '.git', 'objects')
+        result = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            if dirpath == join(root, 'info'):
+                continue
+            for name in filenames:
+                filepath = join(dirpath, name)
+                result[filepath[len(root):]] = os.stat(filepath).st_ino
+        return result
+
+    def test_0130_sync_local_links(self):
+        repodir = join(self.testdir, 'create_test')
+        workspace = DummyWorkspace(repodir)
+        utility = GitStorageUtility()
+        utility.create(workspace)
+        target = join(self.testdir, 'repodata')
+        utility.sync(workspace, target)
+
+        source = Repository(join(target, '.git'))
+        repo = Repository(join(repodir, '.git'))
+        self.assertEqual(repo.revparse_single('master').hex,
+            source.revparse_single('master').hex)
+        # the objects are shared rather than copied.
+        self.assertEqual(self._objects(repodir), self._objects(target))
+        for entry in repo.revparse_single('master').tree:
+            self.assertTrue(entry.id in repo)
+
+    def test_0131_sync_local_link_failure(self):
+        repodir = join(self.testdir, 'create_test')
+        workspace = DummyWorkspace(repodir)
+        utility = GitStorageUtility()
+        utility.create(workspace)
+        target = join(self.testdir, 'repodata')
+        self._sync_copying(utility, workspace, target)
+
+        # copied into a pack of its own.
+        inodes = set(self._objects(target).values())
+        self.assertFalse(inodes.intersection(self._objects(repodir).values()))
+        create_test = utility(workspace)
+        self.assertEqual(sorted(create_test.files()), [
+            '.gitmodules', '1/2/2f2', '1/f1', '1/f2', 'README', 'ext/README',
+            'file1', 'file2'
+        ])
+
+    def test_0132_link_objects(self):
+        source = join(self.testdir, 'import1', '.git', 'objects')
+        target = join(self.testdir, 'linked')
+        os.mkdir(target)
+        self.assertEqual(link_objects(source, target), 10)
+        self.assertEqual(sorted(os.listdir(join(target, 'pack'))), [
+            'pack-e1faefc40f911eeca7740c6b16c72bc21a199860.idx',
+            'pack-e1faefc40f911eeca7740c6b16c72bc21a199860.pack',
+        ])
+        # nothing more to link.
+        self.assertEqual(link_objects(source, target), 0)
+
+    def test_0140_sync_workspace_pool(self):
+        if pmr2.git.pool.git_executable is None:
+            return
+        repodir = join(self.testdir, 'create_test')
+        workspace = DummyWorkspace(repodir)
+        utility = GitStorageUtility()
+        utility.create(workspace)
+        os.environ[pmr2.git.pool.POOL_ROOT_ENV] = join(self.testdir, 'pools')
+        try:
+            utility.syncWorkspace(workspace, self.simple1)
+        finally:
+            del os.environ[pmr2.git.pool.POOL_ROOT_ENV]
+
+        object_pool = pmr2.git.pool.ObjectPool.of(join(repodir, '.git'),
+            join(self.testdir, 'pools'))
+        self.assertEqual(len(object_pool.members()), 2)
+        # nothing was copied into the fork.
+        self.assertEqual(self._objects(repodir), {})
+        create_test = utility(workspace)
+        self.assertEqual(create_test.files(), self.filelist1)
+
+    def test_0150_sync_identifiers(self):
+        utility = GitStorageUtility()
+        workspaces = []
+        for i in range(3):
+            workspace = DummyWorkspace(join(self.testdir, 'bulk%d' % i))
+            utility.create(workspace)
+            workspaces.append(workspace)
+        items = [(w, join(self.testdir, 'simple1')) for w in workspaces]
+        items.append((self.simple2, 'ftp://example.com/simple1'))
+
+        results = utility.syncIdentifiers(items, max_workers=2)
+        self.assertEqual([r.success for r in results],
+            [True, True, True, False])
+        self.assertEqual(results[0].path, join(self.testdir, 'bulk0'))
+        self.assertTrue('not supported' in results[3].error)
+        for workspace in workspaces:
+            self.assertEqual(utility(workspace).files(), self.filelist1)
+
+    def test_0160_sync_http_keep_alive(self):
+        server = util.GitHTTPServer(self.testdir)
+        server.start()
+        self.addCleanup(server.stop)
+
+        utility = GitStorageUtility()
+        for i in range(3):
+            workspace = DummyWorkspace(join(self.testdir, 'http%d' % i))
+            utility.create(workspace)
+            utility.syncIdentifier(workspace, server.url + '/simple1')
+            self.assertEqual(utility(workspace).files(), self.filelist1)
+
+        # three ref advertisements and three fetches over one connection.
+        self.assertEqual(server.connections, 1)
+
+    def _no_fetch(self, local_path, remote_id, branch):
+        self.fail('unexpected fetch from %s' % remote_id)
+
+    def test_0170_sync_unchanged(self):
+        utility = GitStorageUtility()
+        target = join(self.testdir, 'simple1')
+        result = utility.sync(self.simple2, target)
+        self.assertEqual(result,
+            (True, 'Fast-forwarded branch: refs/heads/master'))
+
+        utility._fetch = self._no_fetch
+        result = utility.sync(self.simple2, target)
+        self.assertEqual(result, (True, 'Source and target are identical.'))
+
+    def test_0171_sync_unchanged_last_seen(self):
+        utility = GitStorageUtility()
+        target = join(self.testdir, 'simple2')
+        result = utility.sync(self.simple1, target)
+        self.assertEqual(result, (True, 'No new changes found.'))
+
+        # local is ahead, but neither side moved since.
+        utility._fetch = self._no_fetch
+        result = utility.sync(self.simple1, target)
+        self.assertEqual(result, (True, 'No new changes found.'))
+
+    def test_0172_sync_http_unchanged(self):
+        server = util.GitHTTPServer(self.testdir)
+        server.start()
+        self.addCleanup(server.stop)
+
+        utility = GitStorageUtility()
+        utility.syncIdentifier(self.simple2, server.url + '/simple1')
+        del server.requests[:]
+        result = utility.syncIdentifier(self.simple2, server.url + '/simple1')
+        self.assertEqual(result, (True, 'Source and target are identical.'))
+        self.assertEqual(server.requests, [('GET', '/simple1/info/refs')])
+
+    def _partial_sync(self, workspace, identifier, spec='blob:none'):
+        os.environ[pmr2.git.partial.FILTER_ENV] = spec
+        try:
+            return GitStorageUtility().syncIdentifier(workspace, identifier)
+        finally:
+            del os.environ[pmr2.git.partial.FILTER_ENV]
+
+    def test_0180_sync_partial(self):
+        server = util.GitHTTPServer(self.testdir)
+        server.start()
+        self.addCleanup(server.stop)
+        source = GitStorage(self.simple1)
+        readme = source.file('README')
+
+        utility = GitStorageUtility()
+        workspace = DummyWorkspace(join(self.testdir, 'partial'))
+        utility.create(workspace)
+        self._partial_sync(workspace, server.url + '/simple1')
+
+        repo = Repository(join(self.testdir, 'partial', '.git'))
+        self.assertEqual(repo.config['pmr2.promisor'],
+            server.url + '/simple1')
+        entry = repo.revparse_single('master').tree['README']
+        self.assertEqual(repo.get(entry.oid), None)
+
+        storage = utility(workspace)
+        self.assertEqual(storage.files(), self.filelist1)
+        listing = list(storage.listdir(''))
+        self.assertEqual([i['basename'] for i in listing], self.filelist1)
+        self.assertEqual([i['size'] for i in listing], [''] * 4)
+        self.assertEqual(repo.get(entry.oid), None)
+
+        # fetched as accessed.
+        self.assertEqual(storage.file('README'), readme)
+        self.assertEqual(repo.get(entry.oid).data, readme)
+        self.assertEqual(storage.fileinfo('test1')['contents'](),
+            source.file('test1'))
+        self.assertEqual(listing[2]['contents'](), source.file('test2'))
+        self.assertEqual(storage.blobstream('test3').read(),
+            source.file('test3'))
+
+    def test_0181_sync_partial_limit(self):
+        server = util.GitHTTPServer(self.testdir)
+        server.start()
+        self.addCleanup(server.stop)
+
+        utility = GitStorageUtility()
+        workspace = DummyWorkspace(join(self.testdir, 'partial'))
+        utility.create(workspace)
+        self._partial_sync(workspace, server.url + '/simple1',
+            'blob:limit=1g')
+
+        repo = Repository(join(self.testdir, 'partial', '.git'))
+        tree = repo.revparse_single('master').tree
+        self.assertTrue(all(repo.get(e.oid) is not None for e in tree))
+
+    def test_0182_sync_partial_unsupported(self):
+        server = util.GitHTTPServer(self.testdir, make_wsgi_chain(
+            DictBackend({'/simple1': DulwichRepo(
+                join(self.testdir, 'simple1'))})))
+        server.start()
+        self.addCleanup(server.stop)
+
+        utility = GitStorageUtility()
+        workspace = DummyWorkspace(join(self.testdir, 'partial'))
+        utility.create(workspace)
+        self._partial_sync(workspace, server.url + '/simple1')
+
+        repo = Repository(join(self.testdir, 'partial', '.git'))
+        self.assertRaises(KeyError, repo.config.__getitem__, 'pmr2.promisor')
+        tree = repo.revparse_single('master').tree
+        self.assertTrue(all(repo.get(e.oid) is not None for e in tree))
+
+    def test_0183_sync_workspace_partial(self):
+        server = util.GitHTTPServer(self.testdir)
+        server.start()
+        self.addCleanup(server.stop)
+
+        utility = GitStorageUtility()
+        partial = DummyWorkspace(join(self.testdir, 'partial'))
+        utility.create(partial)
+        self._partial_sync(partial, server.url + '/simple1')
+
+        fork = DummyWorkspace(join(self.testdir, 'fork'))
+        utility.create(fork)
+        utility.syncWorkspace(fork, partial)
+        repo = Repository(join(self.testdir, 'fork', '.git'))
+        self.assertEqual(repo.config['pmr2.promisor'],
+            server.url + '/simple1')
+        self.assertEqual(utility(fork).file('README'),
+            GitStorage(self.simple1).file('README'))
+
+    def test_0184_sync_partial_batch(self):
+        server = util.GitHTTPServer(self.testdir)
+        server.start()
+        self.addCleanup(server.stop)
+        source = GitStorage(self.simple1)
+
+        utility = GitStorageUtility()
+        workspace = DummyWorkspace(join(self.testdir, 'partial'))
+        utility.create(workspace)
+        self._partial_sync(workspace, server.url + '/simple1')
+
+        calls = []
+        fetch_missing = pmr2.git.utility.fetch_missing
+        def fetch(path, shas, pool_manager):
+            calls.append(len(shas))
+            return fetch_missing(path, shas, pool_manager)
+        pmr2.git.utility.fetch_missing = fetch
+        self.addCleanup(setattr, pmr2.git.utility, 'fetch_missing',
+            fetch_missing)
+
+        # the omitted files are fetched in one go.
+        storage = utility(workspace)
+        result = storage.pathinfo_batch(self.filelist1)
+        self.assertEqual(calls, [len(self.filelist1)])
+        for name in self.filelist1:
+            self.assertEqual(result[name]['contents'](), source.file(name))
+        self.assertEqual(calls, [len(self.filelist1)])
+
+    def test_0185_sync_partial_diff(self):
+        server = util.GitHTTPServer(self.testdir)
+        server.start()
+        self.addCleanup(server.stop)
+        source = GitStorage(self.simple1)
+
+        utility = GitStorageUtility()
+        workspace = DummyWorkspace(join(self.testdir, 'partial'))
+        utility.create(workspace)
+        self._partial_sync(workspace, server.url + '/simple1')
+
+        # the blobs for the stats and renames are fetched as needed.
+        storage = utility(workspace)
+        changes = list(storage.diff(renames=True))
+        answer = list(source.diff(renames=True))
+        self.assertEqual([c['path'] for c in changes],
+            [c['path'] for c in answer])
+        self.assertEqual([c['stats']() for c in changes],
+            [c['stats']() for c in answer])
+
+    def test_0186_sync_partial_unavailable(self):
+        server = util.GitHTTPServer(self.testdir)
+        server.start()
+        utility = GitStorageUtility()
+        workspace = DummyWorkspace(join(self.testdir, 'partial'))
+        utility.create(workspace)
+        self._partial_sync(workspace, server.url + '/simple1')
+        server.stop()
+
+        listing = list(utility(workspace).listdir(''))
+        # the omitted blobs can no longer be fetched.
+        self.assertRaises(PathNotFoundError, listing[0]['contents'])
+
+    def test_0190_sync_http_resume(self):
+        server = util.GitHTTPServer(self.testdir)
+        server.start()
+        self.addCleanup(server.stop)
+
+        utility = GitStorageUtility()
+        workspace = DummyWorkspace(join(self.testdir, 'resume'))
+        utility.create(workspace)
+        resume_dir = join(self.testdir, 'resume', '.git', 'pmr2-fetch')
+
+        server.truncate = 500
+        self.assertRaises(ValueError, utility.syncIdentifier, workspace,
+            server.url + '/simple1')
+        self.assertTrue(os.path.getsize(join(resume_dir, 'pack')) > 0)
+        self.assertEqual(utility(workspace).files(), [])
+
+        utility.syncIdentifier(workspace, server.url + '/simple1')
+        self.assertFalse(os.path.exists(resume_dir))
+        self.assertEqual(utility(workspace).files(), self.filelist1)
+
+    def test_0200_repository_stats(self):
+        utility = GitStorageUtility()
+        stats = utility.repositoryStats(self.simple1)
+        self.assertEqual(stats['packs'], 0)
+        self.assertEqual(stats['loose'], 12)
+
+    def test_0210_sync_schedules_maintenance(self):
+        queue = pmr2.git.maintenance.queue
+        pmr2.git.maintenance.queue = pmr2.git.maintenance.MaintenanceQueue()
+        try:
+            utility = GitStorageUtility()
+            utility.sync(self.simple2, join(self.testdir, 'simple1'))
+            self.assertEqual(pmr2.git.maintenance.queue.pending(),
+                [join(self.testdir, 'simple2', '.git')])
+            # nothing new, nothing to maintain.
+            pmr2.git.maintenance.queue.flush()
+            utility.sync(self.simple2, join(self.testdir, 'simple1'))
+            self.assertEqual(pmr2.git.maintenance.queue.pending(), [])
+        finally:
+            pmr2.git.maintenance.queue = queue
+
+    def test_0220_sync_schedules_prewarm(self):
+        utility = GitStorageUtility()
+        utility.sync(self.simple2, join(self.testdir, 'simple1'))
+        path = join(self.testdir, 'simple2', '.git')
+        self.assertEqual(pmr2.git.derived.queue.pending(),
+            [(path, 'simple2')])
+        pmr2.git.derived.queue.flush()
+        head = Repository(path).revparse_single('HEAD').hex
+        self.assertEqual(pmr2.git.derived.DerivedData(path).keys('archive'),
+            [pmr2.git.derived.archive_key(head, 'simple2', 'tgz'),
+             pmr2.git.derived.archive_key(head, 'simple2', 'zip')])
+
+    def test_0221_sync_prewarm_workspace_id(self):
+        # the archives are named by the id of the workspace, which need
+        # not be the name of its directory.
+        class Workspace(DummyWorkspace):
+            id = 'renamed'
+
+        utility = GitStorageUtility()
+        utility.syncIdentifier(Workspace(join(self.testdir, 'simple2')),
+            join(self.testdir, 'simple1'))
+        path = join(self.testdir, 'simple2', '.git')
+        self.assertEqual(pmr2.git.derived.queue.pending(), [(path, 'renamed')])
+        pmr2.git.derived.queue.flush()
+
+        workspace = Workspace(join(self.testdir, 'bulk'))
+        utility.create(workspace)
+        utility.syncIdentifiers([(workspace, join(self.testdir, 'simple1'))])
+        path = join(self.testdir, 'bulk', '.git')
+        self.assertEqual(pmr2.git.derived.queue.pending(), [(path, 'renamed')])
+
+    def test_0230_sync_fast_forward_raced(self):
+        # a push lands in between the sync reading and updating the ref.
+        locked_refs = pmr2.git.utility.locked_refs
+        pushed = []
+
+        class RacedRefs(pmr2.git.lock.LockedRefsContainer):
+            def set_if_equals(self, name, old_ref, new_ref, *a, **kw):
+                pushed.append(pmr2.git.lock.LockedRefsContainer.set_if_equals(
+                    self, name, old_ref, '0' * 40))
+                return pmr2.git.lock.LockedRefsContainer.set_if_equals(
+                    self, name, old_ref, new_ref, *a, **kw)
+
+        def raced_refs(repo):
+            return RacedRefs(repo.commondir(), repo.controldir())
+
+        pmr2.git.utility.locked_refs = raced_refs
+        try:
+            utility = GitStorageUtility()
+            self.assertRaises(ValueError, utility.sync, self.simple2,
+                join(self.testdir, 'simple1'))
+        finally:
+            pmr2.git.utility.locked_refs = locked_refs
+        self.assertEqual(pushed, [True])
+        # what was pushed stands.
+        self.assertEqual(DulwichRepo(join(self.testdir, 'simple2')).refs[
+            'refs/heads/master'], '0' * 40)
+
+    def test_0121_sync_fallback_head(self):
+        repodir = join(self.testdir, 'create_test')
+        workspace = DummyWorkspace(repodir)
+        utility = GitStorageUtility()
+        utility.create(workspace)
+        target = join(self.testdir, 'simple1')
+        other = self._commit_other_branch(target)
+        source = Repository(join(target, '.git'))
+        head = source.revparse_single('master').hex
+        source.lookup_reference('refs/heads/master').rename(
+            'refs/heads/main')
+        source.set_head('refs/heads/main')
+
+        self._sync_copying(utility, workspace, target)
+        repo = Repository(join(repodir, '.git'))
+        self.assertEqual(repo.revparse_single('master').hex, head)
+        self.assertFalse(other in repo)
+
 
 def test_suite():
     from unittest import TestSuite, makeSuite
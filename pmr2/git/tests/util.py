@@ -1,6 +1,14 @@
 from cStringIO import StringIO
-from os.path import join, dirname
+from os.path import join, dirname, isdir
+import socket
 import tarfile
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from dulwich.web import HTTP_NOT_FOUND
+
+from pmr2.git.server import AuthorizationError, GitServer
 from pmr2.testing.base import TestRequest
 
 ARCHIVE_NAME = 'repodata.tgz'
@@ -23,3 +31,118 @@ def extract_archive(path, archive_path=ARCHIVE_PATH):
     for m in mem:
         tf.extract(m, path)
     tf.close()
+
+
+class _RootAuthorizer(object):
+
+    def __init__(self, root):
+        self.root = root
+
+    def __call__(self, prefix, push, environ, event=False):
+        path = join(self.root, prefix.lstrip('/'))
+        if not isdir(path):
+            raise AuthorizationError(HTTP_NOT_FOUND)
+        return path
+
+
+class _GitRequestHandler(BaseHTTPRequestHandler):
+
+    # keep-alive, unlike the HTTP/1.0 server of wsgiref.
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+            self.server.sockets.append(self.connection)
+
+    def log_message(self, *a):
+        pass
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        with self.server.lock:
+            self.server.requests.append((self.command, path))
+        length = int(self.headers.get('Content-Length') or 0)
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': self.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': str(length),
+            'SERVER_NAME': '127.0.0.1',
+            'SERVER_PORT': str(self.server.server_port),
+            'wsgi.input': StringIO(self.rfile.read(length)),
+            'wsgi.errors': StringIO(),
+            'wsgi.url_scheme': 'http',
+        }
+        for key, value in self.headers.items():
+            environ['HTTP_' + key.upper().replace('-', '_')] = value
+
+        response = []
+        chunks = []
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return chunks.append
+        chunks.extend(self.server.app(environ, start_response))
+        body = ''.join(chunks)
+        status, headers = response
+
+        self.send_response(int(status.split()[0]))
+        for key, value in headers:
+            if key.lower() != 'content-length':
+                self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        truncate = None
+        if self.command == 'POST':
+            with self.server.lock:
+                truncate, self.server.truncate = self.server.truncate, None
+        if truncate is not None:
+            # as if the connection dropped midway.
+            body = body[:truncate]
+            self.close_connection = 1
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+
+class GitHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    A stand-in smart HTTP git server for the repositories under root,
+    counting the connections made to it and logging the requests.  The
+    git services are provided by app, defaulting to the GitServer.
+
+    Setting truncate to some size cuts the response to the next POST
+    request short at that size.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, root, app=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _GitRequestHandler)
+        if app is None:
+            app = GitServer(_RootAuthorizer(root))
+        self.app = app
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.sockets = []
+        self.truncate = None
+        self.url = 'http://127.0.0.1:%d' % self.server_port
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever,
+            kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # end the keep-alive connections still waiting for requests.
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
@@ -0,0 +1,571 @@
+"""
+Git protocol version 2 support for upload-pack.
+
+Only the stateless (HTTP) form of the protocol is implemented, which
+provides the `ls-refs` and `fetch` commands.  Clients that did not ask
+for version 2 (through the `Git-Protocol` header) are served by the
+version 0/1 implementation in dulwich.
+"""
+
+from dulwich.errors import NotGitRepository
+from dulwich.object_store import DiskObjectStore, MissingObjectFinder
+from dulwich.objects import Commit, valid_hexsha
+from dulwich.pack import write_pack_objects
+from dulwich.protocol import agent_string
+from dulwich.protocol import pkt_line
+from dulwich.protocol import SIDE_BAND_CHANNEL_DATA
+from dulwich.protocol import SIDE_BAND_CHANNEL_PROGRESS
+from dulwich.web import get_repo, HTTP_OK
+
+from .revision import REF_RULES
+from .stream import object_size
+
+FLUSH = '0000'
+DELIM = '0001'
+
+# maximum payload for a side-band-64k packet, sans the band byte.
+SIDE_BAND_MAX = 65515
+
+
+def protocol_version(environ):
+    """
+    Return the protocol version requested by the client through the
+    `Git-Protocol` header.
+    """
+
+    for item in environ.get('HTTP_GIT_PROTOCOL', '').split(':'):
+        if item.strip() == 'version=2':
+            return 2
+    return 0
+
+
+def capabilities():
+    return [
+        'version 2',
+        'agent=%s' % agent_string(),
+        'ls-refs',
+        'fetch=shallow filter',
+        'object-format=sha1',
+    ]
+
+
+class ProtocolError(Exception):
+    """
+    Error while processing a version 2 request, reported back to the
+    client as an ERR packet.
+    """
+
+
+def read_pkt_lines(read):
+    """
+    Iterate through the packets of a request, yielding the payloads with
+    the trailing newline removed, or FLUSH or DELIM for the special
+    packets.  Stops after the first flush.
+    """
+
+    while True:
+        size = read(4)
+        if len(size) < 4:
+            raise ProtocolError('unexpected end of request')
+        if size in (FLUSH, DELIM):
+            yield size
+            if size == FLUSH:
+                return
+            continue
+        try:
+            length = int(size, 16)
+        except ValueError:
+            raise ProtocolError('invalid pkt-line length')
+        if length < 4:
+            raise ProtocolError('invalid pkt-line length')
+        data = read(length - 4)
+        if len(data) < length - 4:
+            raise ProtocolError('unexpected end of request')
+        yield data.rstrip('\n')
+
+
+def parse_request(read):
+    """
+    Parse a version 2 request into (command, capabilities, arguments).
+    """
+
+    command = None
+    caps = []
+    args = []
+    target = caps
+    for line in read_pkt_lines(read):
+        if line == FLUSH:
+            break
+        if line == DELIM:
+            target = args
+            continue
+        if target is caps and line.startswith('command='):
+            command = line[len('command='):]
+            continue
+        target.append(line)
+    return command, caps, args
+
+
+def _ref_names(refs, prefixes):
+    """
+    Return the names of the refs matching any of the prefixes, only
+    looking through the parts of the refs namespace that may match.
+    """
+
+    if not prefixes:
+        return set(refs.allkeys())
+
+    names = set()
+    for prefix in prefixes:
+        if 'HEAD'.startswith(prefix) and refs.read_ref('HEAD'):
+            names.add('HEAD')
+        base = prefix.rsplit('/', 1)[0] if '/' in prefix else ''
+        if not base.startswith('refs'):
+            names.update(n for n in refs.allkeys() if n.startswith(prefix))
+            continue
+        for subkey in refs.subkeys(base):
+            name = '%s/%s' % (base, subkey)
+            if name.startswith(prefix):
+                names.add(name)
+    return names
+
+
+def ls_refs(repo, args, write):
+    """
+    The ls-refs command.
+    """
+
+    symrefs = 'symrefs' in args
+    peel = 'peel' in args
+    prefixes = [a[len('ref-prefix '):] for a in args
+        if a.startswith('ref-prefix ')]
+
+    names = _ref_names(repo.refs, prefixes)
+    # HEAD first, then the remaining in order.
+    for name in sorted(names, key=lambda n: (n != 'HEAD', n)):
+        refnames, sha = repo.refs.follow(name)
+        if not sha:
+            # unborn (or dangling) reference.
+            continue
+        line = '%s %s' % (sha, name)
+        if symrefs and len(refnames) > 1:
+            line += ' symref-target:%s' % refnames[-1]
+        if peel:
+            peeled = repo.get_peeled(name)
+            if peeled != sha:
+                line += ' peeled:%s' % peeled
+        write(pkt_line(line + '\n'))
+    write(FLUSH)
+
+
+class SideBandWriter(object):
+    """
+    File-like object that writes through the data side-band.
+    """
+
+    def __init__(self, write):
+        self._write = write
+
+    def write(self, data):
+        while data:
+            chunk, data = data[:SIDE_BAND_MAX], data[SIDE_BAND_MAX:]
+            self._write(pkt_line(chr(SIDE_BAND_CHANNEL_DATA) + chunk))
+
+
+def parse_filter(spec):
+    """
+    Parse an object filter specification into the size limit for blobs,
+    as only the blob filters are supported.
+    """
+
+    if spec == 'blob:none':
+        return 0
+    if spec.startswith('blob:limit='):
+        value = spec[len('blob:limit='):].lower()
+        scale = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}.get(value[-1:])
+        if scale:
+            value = value[:-1]
+        try:
+            return int(value) * (scale or 1)
+        except ValueError:
+            pass
+    raise ProtocolError('unsupported filter: %s' % spec)
+
+
+class FetchRequest(object):
+    """
+    The parsed arguments of a fetch command.
+    """
+
+    def __init__(self, args):
+        self.wants = []
+        self.haves = []
+        self.done = False
+        self.options = set()
+        # shallow clone related.
+        self.shallow = set()
+        self.deepen = None
+        self.deepen_since = None
+        self.deepen_not = []
+        # blob size limit for partial clones.
+        self.blob_limit = None
+        for arg in args:
+            name, _, value = arg.partition(' ')
+            if name == 'want':
+                self.wants.append(self._sha(value))
+            elif name == 'have':
+                self.haves.append(self._sha(value))
+            elif name == 'done':
+                self.done = True
+            elif name == 'shallow':
+                self.shallow.add(self._sha(value))
+            elif name == 'deepen':
+                self.deepen = self._int(value)
+            elif name == 'deepen-since':
+                self.deepen_since = self._int(value)
+            elif name == 'deepen-not':
+                self.deepen_not.append(value)
+            elif name == 'filter':
+                self.blob_limit = parse_filter(value)
+            else:
+                self.options.add(name)
+        if self.deepen is not None and (
+                self.deepen_since is not None or self.deepen_not):
+            # as git does, rather than picking one of them.
+            raise ProtocolError('upload-pack: deepen and deepen-since '
+                '(or deepen-not) cannot be used together')
+
+    @property
+    def deepening(self):
+        return (self.deepen is not None or self.deepen_since is not None or
+            bool(self.deepen_not))
+
+    def _sha(self, value):
+        if not valid_hexsha(value):
+            raise ProtocolError('invalid object id: %s' % value)
+        return value
+
+    def _int(self, value):
+        try:
+            return int(value)
+        except ValueError:
+            raise ProtocolError('invalid value: %s' % value)
+
+
+def find_shallow(store, heads, depth):
+    """
+    Find the commits that form the shallow boundary at depth from heads,
+    with heads being at depth 1.  Returns (shallow, not_shallow).
+    """
+
+    shallow = set()
+    not_shallow = set()
+    todo = [(sha, 1) for sha in heads]
+    seen = {}
+    while todo:
+        sha, current = todo.pop()
+        if seen.get(sha, 0) >= depth - current + 1:
+            continue
+        seen[sha] = depth - current + 1
+        obj = store.peel_sha(sha)
+        if not isinstance(obj, Commit):
+            continue
+        if current < depth:
+            not_shallow.add(obj.id)
+            todo.extend((p, current + 1) for p in obj.parents)
+        else:
+            shallow.add(obj.id)
+    return shallow - not_shallow, not_shallow
+
+
+def find_shallow_since(store, heads, since, excluded=frozenset()):
+    """
+    Find the shallow boundary for commits reachable from heads that are
+    no older than since and not in excluded.  Returns (shallow,
+    not_shallow).
+    """
+
+    included = set()
+    todo = list(heads)
+    while todo:
+        sha = todo.pop()
+        if sha in included:
+            continue
+        obj = store.peel_sha(sha)
+        if not isinstance(obj, Commit):
+            continue
+        included.add(obj.id)
+        todo.extend(p for p in obj.parents if p not in excluded and
+            store[p].commit_time >= since)
+
+    shallow = set()
+    for sha in included:
+        if any(p not in included for p in store[sha].parents):
+            shallow.add(sha)
+    return shallow, included - shallow
+
+
+def _reachable(store, heads):
+    result = set()
+    todo = list(heads)
+    while todo:
+        sha = todo.pop()
+        if sha in result:
+            continue
+        obj = store.peel_sha(sha)
+        if not isinstance(obj, Commit):
+            continue
+        result.add(obj.id)
+        todo.extend(obj.parents)
+    return result
+
+
+class FilteringObjectFinder(MissingObjectFinder):
+    """
+    Find the missing objects, omitting the blobs reached through trees
+    that are at least blob_limit in size.  Explicitly wanted objects are
+    never omitted.
+    """
+
+    def __init__(self, object_store, haves, wants, blob_limit=None,
+            **kw):
+        self.blob_limit = blob_limit
+        self.leaves = set()
+        MissingObjectFinder.__init__(self, object_store, haves, wants, **kw)
+
+    def add_todo(self, entries):
+        entries = list(entries)
+        if self.blob_limit is not None:
+            # tree entries have names, tagged objects do not.
+            self.leaves.update(sha for sha, name, leaf in entries
+                if leaf and name is not None)
+        MissingObjectFinder.add_todo(self, entries)
+
+    def omit(self, sha):
+        if self.blob_limit is None or sha not in self.leaves:
+            return False
+        if self.blob_limit == 0:
+            return True
+        if isinstance(self.object_store, DiskObjectStore):
+            # the size is in the header, so the blob is not inflated.
+            size = object_size(self.object_store, sha)
+        else:
+            size = self.object_store[sha].raw_length()
+        return size >= self.blob_limit
+
+    def __iter__(self):
+        while True:
+            entry = self.next()
+            if entry is None:
+                return
+            if not self.omit(entry[0]):
+                yield entry
+
+
+def _want_reachable(store, want, common, earliest):
+    """
+    Whether the want has some ancestor (inclusive) that is in common,
+    without walking past commits older than the earliest common one.
+    """
+
+    todo = [want]
+    seen = set()
+    while todo:
+        sha = todo.pop()
+        if sha in common:
+            return True
+        if sha in seen:
+            continue
+        seen.add(sha)
+        obj = store[sha]
+        if isinstance(obj, Commit) and obj.commit_time >= earliest:
+            todo.extend(obj.parents)
+    return False
+
+
+class Fetch(object):
+    """
+    The fetch command.
+    """
+
+    def __init__(self, repo, args):
+        self.repo = repo
+        self.store = repo.object_store
+        self.request = FetchRequest(args)
+
+    def progress(self, write, message):
+        if 'no-progress' in self.request.options:
+            return
+        write(pkt_line(chr(SIDE_BAND_CHANNEL_PROGRESS) + message))
+
+    def get_tagged(self):
+        if 'include-tag' not in self.request.options:
+            return {}
+        tagged = {}
+        for name in self.repo.refs.subkeys('refs/tags'):
+            name = 'refs/tags/' + name
+            sha = self.repo.refs[name]
+            peeled = self.repo.get_peeled(name)
+            if peeled != sha:
+                tagged[peeled] = sha
+        return tagged
+
+    def resolve_ref(self, name):
+        """
+        Return the sha of the ref the (possibly abbreviated) name is,
+        looked up as git does, e.g. v1.0 as refs/tags/v1.0.
+        """
+
+        found = [rule % name for rule in REF_RULES
+            if rule % name in self.repo.refs]
+        if len(found) != 1:
+            raise ProtocolError('upload-pack: ambiguous deepen-not: %s' %
+                name)
+        return self.repo.refs[found[0]]
+
+    def acknowledgments(self, common, write):
+        write(pkt_line('acknowledgments\n'))
+        if not common:
+            write(pkt_line('NAK\n'))
+        for sha in common:
+            write(pkt_line('ACK %s\n' % sha))
+
+    def ready(self, common):
+        commits = [self.store[sha] for sha in common]
+        commits = [c for c in commits if isinstance(c, Commit)]
+        if not commits:
+            return False
+        earliest = min(c.commit_time for c in commits)
+        common = set(common)
+        return all(_want_reachable(self.store, want, common, earliest)
+            for want in self.request.wants)
+
+    def find_shallow(self):
+        """
+        Returns the (shallow, unshallow) commits to report to the client
+        if there are changes to the shallow boundary, else None.
+        """
+
+        request = self.request
+        store = self.store
+        if not request.deepening:
+            return None
+        if request.deepen is not None:
+            if 'deepen-relative' in request.options:
+                shallow, not_shallow = find_shallow(
+                    store, request.shallow, request.deepen + 1)
+            else:
+                shallow, not_shallow = find_shallow(
+                    store, request.wants, request.deepen)
+        else:
+            excluded = _reachable(store, [
+                self.resolve_ref(name) for name in request.deepen_not])
+            shallow, not_shallow = find_shallow_since(store, request.wants,
+                request.deepen_since or 0, excluded)
+        return (shallow - request.shallow,
+            request.shallow.intersection(not_shallow))
+
+    def shallow_info(self, shallow, unshallow, write):
+        write(pkt_line('shallow-info\n'))
+        for sha in sorted(shallow):
+            write(pkt_line('shallow %s\n' % sha))
+        for sha in sorted(unshallow):
+            write(pkt_line('unshallow %s\n' % sha))
+        write(DELIM)
+
+    def find_objects(self, common, boundary, wants=()):
+        # the client lacks the parents of its shallow commits, so the
+        # history of its haves ends there.
+        stop = boundary.union(self.request.shallow)
+
+        def get_parents(commit):
+            if commit.id in stop:
+                return []
+            return commit.parents
+
+        return self.store.iter_shas(FilteringObjectFinder(
+            self.store, common, list(self.request.wants) + list(wants),
+            blob_limit=self.request.blob_limit,
+            get_tagged=self.get_tagged, get_parents=get_parents))
+
+    def __call__(self, write):
+        request = self.request
+        for want in request.wants:
+            if want not in self.store:
+                raise ProtocolError('upload-pack: not our ref %s' % want)
+
+        common = [sha for sha in request.haves if sha in self.store]
+
+        if not request.done:
+            self.acknowledgments(common, write)
+            if not self.ready(common):
+                write(FLUSH)
+                return
+            write(pkt_line('ready\n'))
+            write(DELIM)
+
+        boundary = set(request.shallow)
+        deepened = []
+        shallow_info = self.find_shallow()
+        if shallow_info is not None:
+            shallow, unshallow = shallow_info
+            self.shallow_info(shallow, unshallow, write)
+            boundary = boundary.union(shallow).difference(unshallow)
+            # what lies beyond the previous boundary is missing from the
+            # client, whatever its haves are.
+            deepened = [parent for sha in unshallow
+                for parent in self.store[sha].parents]
+
+        objects = self.find_objects(common, boundary, deepened)
+        write(pkt_line('packfile\n'))
+        self.progress(write, 'counting objects: %d, done.\n' % len(objects))
+        write_pack_objects(SideBandWriter(write), objects)
+        write(FLUSH)
+
+
+def fetch(repo, args, write):
+    Fetch(repo, args)(write)
+
+
+commands = {
+    'ls-refs': ls_refs,
+    'fetch': fetch,
+}
+
+
+def get_info_refs(req, backend, mat):
+    """
+    The version 2 capability advertisement for upload-pack.
+    """
+
+    try:
+        get_repo(backend, mat)
+    except NotGitRepository as e:
+        yield req.not_found(str(e))
+        return
+    req.nocache()
+    write = req.respond(HTTP_OK, 'application/x-git-upload-pack-advertisement')
+    for line in capabilities():
+        write(pkt_line(line + '\n'))
+    write(FLUSH)
+
+
+def handle_upload_pack(req, backend, mat):
+    """
+    Handle a version 2 upload-pack command request.
+    """
+
+    try:
+        repo = get_repo(backend, mat)
+    except NotGitRepository as e:
+        yield req.not_found(str(e))
+        return
+    req.nocache()
+    write = req.respond(HTTP_OK, 'application/x-git-upload-pack-result')
+    try:
+        command, caps, args = parse_request(req.environ['wsgi.input'].read)
+        if command not in commands:
+            raise ProtocolError('unknown command %s' % command)
+        commands[command](repo, args, write)
+    except ProtocolError as e:
+        write(pkt_line('ERR %s\n' % e))
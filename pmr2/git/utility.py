@@ -1,5 +1,7 @@
+import errno
+import os
 import re
-from os.path import basename, join
+from os.path import basename, dirname, isdir, join, splitext
 from cStringIO import StringIO
 from hashlib import sha1
 import logging
@@ -15,15 +17,18 @@ from magic import Magic
 from pygit2 import Signature
 from pygit2 import Repository
 from pygit2 import Tree
+from pygit2 import TreeEntry
 from pygit2 import Blob
 from pygit2 import Tag
 from pygit2 import Commit
 from pygit2 import discover_repository, init_repository
 from pygit2 import GIT_SORT_TIME
+from pygit2 import GIT_FILEMODE_COMMIT
+from pygit2 import GIT_DELTA_MODIFIED
 
 import dulwich.objects
+from dulwich.objects import S_ISGITLINK
 from dulwich.repo import Repo
-from dulwich.client import HttpGitClient
 
 from pmr2.app.settings.interfaces import IPMR2GlobalSettings
 from pmr2.app.workspace.exceptions import *
@@ -31,8 +36,23 @@ from pmr2.app.workspace.interfaces import IWorkspace
 from pmr2.app.workspace.storage import StorageUtility
 from pmr2.app.workspace.storage import BaseStorage
 
+from .bloom import ChangedPathIndex
 from .ext import parse_gitmodules, archive_tgz, archive_zip
+from .diff import STATUSES, blob_id, find_renames, line_stats, tree_diff
 from .interfaces import IGitWorkspace
+from .largefile import large_file_store, POINTER_MAX
+from .lock import locked_refs, read_lock
+from . import derived
+from . import maintenance
+from .partial import V2Client, sync_filter, fetch_partial, fetch_missing
+from .partial import get_promisor, set_promisor
+from .pool import join_family, PoolError
+from .resume import ResumableFetch, StreamingHttpGitClient
+from .revision import resolve
+from .lines import LineIndex
+from .stream import BlobStream
+from .sync import BulkSync, http_pool_manager, repo_lock
+from .sync import last_seen, record_seen
 
 GIT_MODULE_FILE = '.gitmodules'
 
@@ -46,6 +66,80 @@ def rfc2822(committer):
         tzoffset(None, committer.offset * 60))
 
 
+def repository_path(context):
+    """
+    Return the path to the bare repository of the workspace context
+    without opening it, for callers that only need to hand the path to
+    another backend (such as the dulwich based protocol view).
+    """
+
+    rp = zope.component.getUtility(IPMR2GlobalSettings).dirOf(context)
+    path = join(rp, '.git')
+    if not isdir(path):
+        raise PathInvalidError('repository does not exist at path')
+    return path
+
+
+def link_objects(source, target):
+    """
+    Hard link the packs and loose objects of the source object store
+    directory into the target, skipping the ones already present.  As
+    object files are never modified, the two stores can safely share
+    them.  Returns the number of files linked; an OSError with errno
+    EXDEV is raised if the two are on different devices.
+    """
+
+    linked = 0
+    for name in sorted(os.listdir(source)):
+        if len(name) == 2:
+            names = [join(name, n) for n in os.listdir(join(source, name))
+                if len(n) == 38]
+        elif name == 'pack':
+            # the pack (and its promisor marker) must be in place before
+            # its index is.
+            names = [join(name, n) for n in sorted(
+                os.listdir(join(source, name)), key=lambda n: (
+                    splitext(n)[0], n.endswith('.idx')))
+                if n.startswith('pack-') and
+                    splitext(n)[1] in ('.pack', '.idx', '.promisor')]
+        else:
+            continue
+        for path in names:
+            if os.path.exists(join(target, path)):
+                continue
+            dirpath = join(target, dirname(path))
+            try:
+                if not isdir(dirpath):
+                    os.makedirs(dirpath)
+                os.link(join(source, path), join(target, path))
+            except OSError as e:
+                # gone (e.g. repacked) or already linked concurrently.
+                if e.errno not in (errno.ENOENT, errno.EEXIST):
+                    raise
+            else:
+                linked += 1
+    return linked
+
+
+class BranchWants(object):
+    """
+    The determine_wants for a dulwich fetch that only asks for the
+    objects of a single branch of the remote, falling back to its HEAD,
+    rather than every ref it has.  The objects already reachable from
+    the local refs are negotiated away by dulwich as usual.
+    """
+
+    def __init__(self, branch, object_store):
+        self.branch = branch
+        self.object_store = object_store
+
+    def __call__(self, refs, depth=None):
+        target = refs.get(self.branch, refs.get('HEAD'))
+        if target is None or target in self.object_store:
+            return []
+        return [target]
+
+
 class GitStorageUtility(StorageUtility):
     title = u'Git'
     command = u'git'
@@ -73,16 +167,61 @@ class GitStorageUtility(StorageUtility):
     def protocol(self, context, request):
         raise NotImplementedError
 
+    def repositoryStats(self, context):
+        """
+        Return the statistics of the objects in the repository of the
+        workspace, i.e. the number and size of its packs and loose
+        objects, which decide whether it is due for a repack.
+        """
+
+        rp = zope.component.getUtility(IPMR2GlobalSettings).dirOf(context)
+        return maintenance.repo_stats(join(rp, '.git'))
+
     def syncIdentifier(self, context, identifier):
         # should be named syncWithIdentifier
         rp = zope.component.getUtility(IPMR2GlobalSettings).dirOf(context)
+        return self._sync(rp, identifier, context.id)
+
+    def syncIdentifiers(self, items, max_workers=8, max_per_host=4):
+        """
+        Sync many workspaces concurrently, with items being a list of
+        (context, identifier) pairs.  Returns a list of SyncResult in
+        the same order, with the outcome or error for each.
+        """
+
+        # the paths and ids are resolved here, as the contexts should
+        # not be used from other threads.
+        settings = zope.component.getUtility(IPMR2GlobalSettings)
+        ids = {}
+        jobs = []
+        for context, identifier in items:
+            rp = settings.dirOf(context)
+            ids[rp] = context.id
+            jobs.append((rp, identifier))
 
+        def sync(rp, identifier):
+            return self._sync(rp, identifier, ids[rp])
+
+        return BulkSync(sync, max_workers=max_workers,
+            max_per_host=max_per_host)(jobs)
+
+    def _sync(self, rp, identifier, workspace_id):
+        with repo_lock(rp):
+            return self._sync_unlocked(rp, identifier, workspace_id)
+
+    def _sync_unlocked(self, rp, identifier, workspace_id):
         # XXX assuming master.
         branch_name = 'master'
         # XXX when we figure out how to let users pick their primary
         # branches, use what they specify instead.
         branch = "refs/heads/%s" % branch_name
 
+        # Most syncs find nothing new, which is known from the ref
+        # advertisement of the remote alone.
+        result = self._check_unchanged(rp, identifier, branch)
+        if result is not None:
+            return result
+
         # Since the network and remote handling aspect between dulwich
         # and pygit2 have different strengths, i.e. dulwich has better
         # remote network handling and fetching without having to create
@@ -100,7 +239,56 @@ class GitStorageUtility(StorageUtility):
         # 3. If merge base between the two have diverted, abort.
         # 4. If remote is fresher, fast forward local.
 
-        return self._fast_forward(rp, merge_target, branch)
+        result = self._fast_forward(rp, merge_target, branch)
+        record_seen(rp, identifier, merge_target,
+            self._local_head(rp, branch), result[1])
+        # the fetch may have added a pack.
+        maintenance.queue.schedule(join(rp, '.git'))
+        # named by the id of the workspace, as for a push.
+        derived.schedule(join(rp, '.git'), workspace_id)
+        return result
+
+    def _check_unchanged(self, rp, identifier, branch):
+        remote_refs = self._remote_refs(identifier)
+        target = remote_refs.get(branch, remote_refs.get('HEAD'))
+        if target is None:
+            return None
+
+        head = self._local_head(rp, branch)
+        if head == target:
+            return True, 'Source and target are identical.'
+
+        # Neither side moved since the last sync, so its outcome stands.
+        seen = last_seen(rp, identifier)
+        if seen is not None and seen[:2] == (target, head):
+            return True, seen[2]
+
+        return None
+
+    def _local_head(self, local_path, branch):
+        try:
+            with read_lock(local_path):
+                return Repo(local_path).refs[branch]
+        except KeyError:
+            return None
+
+    def _http_client(self, root):
+        # the client must not be given credentials, as that would
+        # alter the headers of the shared pool manager.
+        return StreamingHttpGitClient(root, pool_manager=http_pool_manager())
+
+    def _remote_refs(self, remote_id):
+        # Only the ref advertisement, without any negotiation.
+        if remote_id.startswith('http'):
+            root, frag = remote_id.rsplit('/', 1)
+            try:
+                return self._http_client(root).get_refs(frag)
+            except:
+                raise ValueError('error fetching from remote: %s' % remote_id)
+        elif remote_id.startswith('/'):
+            return Repo(remote_id).get_refs()
+        else:
+            raise ValueError('remote not supported: %s' % remote_id)
 
     def _fetch(self, local_path, remote_id, branch):
         # dulwich repo
@@ -108,15 +296,19 @@ class GitStorageUtility(StorageUtility):
 
         # Determine the fetch strategy based on protocol.
         if remote_id.startswith('http'):
-            root, frag = remote_id.rsplit('/', 1)
-            client = HttpGitClient(root)
             try:
-                remote_refs = client.fetch(frag, local)
+                remote_refs = self._fetch_http(local, remote_id, branch)
             except:
                 raise ValueError('error fetching from remote: %s' % remote_id)
         elif remote_id.startswith('/'):
+            determine_wants = BranchWants(branch, local.object_store)
             client = Repo(remote_id)
-            remote_refs = client.fetch(local)
+            remote_refs = self._fetch_local(client, local, determine_wants)
+            # the blobs omitted from a partially synced remote are also
+            # missing here, to be fetched from where it would.
+            promisor = get_promisor(client)
+            if promisor and get_promisor(local) is None:
+                set_promisor(local, promisor)
         else:
             raise ValueError('remote not supported: %s' % remote_id)
 
@@ -130,6 +322,49 @@ class GitStorageUtility(StorageUtility):
 
         return merge_target
 
+    def _fetch_http(self, local, remote_id, branch):
+        filter_spec = sync_filter()
+        if filter_spec:
+            client = V2Client(remote_id, http_pool_manager())
+            if client.supports_filter():
+                return fetch_partial(client, local, branch,
+                    BranchWants(branch, local.object_store), filter_spec)
+            logger.info('remote %s does not support filters, syncing in '
+                'full', remote_id)
+
+        # Carry on from what an interrupted fetch had received.
+        fetch = ResumableFetch(local)
+        fetch.recover()
+        determine_wants = BranchWants(branch, local.object_store)
+        root, frag = remote_id.rsplit('/', 1)
+        client = self._http_client(root)
+        try:
+            return fetch(client, frag, determine_wants)
+        finally:
+            client.close()
+
+    def _fetch_local(self, remote, local, determine_wants):
+        # Repositories on the same server can simply share the object
+        # files through hard links, rather than have the objects copied
+        # into a new pack.
+        remote_refs = remote.get_refs()
+        wants = determine_wants(remote_refs)
+        if not wants:
+            return remote_refs
+
+        try:
+            link_objects(remote.object_store.path, local.object_store.path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            logger.info('cannot link objects from %s (%s), copying instead',
+                remote.path, e)
+        else:
+            if all(want in local.object_store for want in wants):
+                return remote_refs
+
+        return remote.fetch(local, determine_wants=determine_wants)
+
     def _fast_forward(self, local_path, merge_target, branch):
         # pygit2 repo
         repo = Repository(discover_repository(local_path))
@@ -137,12 +372,17 @@ class GitStorageUtility(StorageUtility):
         # convert merge_target from hex into oid.
         fetch_head = repo.revparse_single(merge_target)
 
+        # The branch is only updated if it still is what was read here,
+        # as readers and pushes may get at the repository meanwhile.
+        refs = locked_refs(Repo(local_path))
+
         # try to resolve a common anscestor between fetched and local
         try:
             head = repo.revparse_single(branch)
         except:
             # New repo, create the reference now and finish.
-            repo.create_reference(branch, fetch_head.oid)
+            if not refs.add_if_new(branch, fetch_head.hex):
+                raise ValueError('branch created during sync.')
             return True, 'Created new branch: %s' % branch
 
         if head.oid == fetch_head.oid:
@@ -162,22 +402,30 @@ class GitStorageUtility(StorageUtility):
 
         # This case remains: oid.hex == head.oid.hex
         # Local is the common base, so remote is newer, fast-forward.
-        try:
-            ref = repo.lookup_reference(branch)
-            ref.delete()
-        except KeyError:
-            # assume repo is empty.
-            pass
-
-        repo.create_reference(branch, fetch_head.oid)
+        if not refs.set_if_equals(branch, head.hex, fetch_head.hex):
+            raise ValueError('branch updated during sync.')
 
         return True, 'Fast-forwarded branch: %s' % branch
 
     def syncWorkspace(self, context, source):
         # should be named syncWithWorkspace
-        remote = zope.component.getUtility(IPMR2GlobalSettings).dirOf(source)
+        settings = zope.component.getUtility(IPMR2GlobalSettings)
+        remote = settings.dirOf(source)
+        self._join_family(settings.dirOf(context), remote)
         return self.syncIdentifier(context, remote)
 
+    def _join_family(self, local_path, remote_path):
+        # A new fork shares the object pool of its source (if pooling
+        # is enabled), so the sync that follows has nothing to copy.
+        local = join(local_path, '.git')
+        if Repository(local).listall_references():
+            return
+        try:
+            join_family(local, join(remote_path, '.git'))
+        except PoolError as e:
+            logger.warning('unable to share objects with %s: %s',
+                remote_path, e)
+
 
 class GitStorage(BaseStorage):
 
@@ -195,6 +443,7 @@ class GitStorage(BaseStorage):
             # discover_repository may have failed.
             raise PathInvalidError('repository does not exist at path')
 
+        self.derived = derived.DerivedData(self.repo.path)
         self.checkout('HEAD')
 
     _archiveFormats = {
@@ -218,11 +467,20 @@ class GitStorage(BaseStorage):
         if self.rev:
             return self.rev[:12]
 
+    def _archive(self, fmt, build):
+        # only the archives of the HEAD are kept, as prewarmed.
+        result = self.derived.get('archive', derived.archive_key(
+            self._commit.hex, self.context.id, fmt))
+        if result is None:
+            result = build(self.repo, self._commit, self.context.id,
+                largefiles=large_file_store())
+        return result
+
     def archive_zip(self):
-        return archive_zip(self.repo, self._commit, self.context.id)
+        return self._archive('zip', archive_zip)
 
     def archive_tgz(self):
-        return archive_tgz(self.repo, self._commit, self.context.id)
+        return self._archive('tgz', archive_tgz)
 
     def basename(self, name):
         return name.split('/')[-1]
@@ -235,19 +493,21 @@ class GitStorage(BaseStorage):
             rev = 'HEAD'
 
         self._lastcheckout = rev
-        try:
-            self.__commit = self.repo.revparse_single(rev)
-        except KeyError:
-            if rev == 'HEAD':
-                try:
-                    # fallback to the main branch
-                    self.__commit = self.repo.revparse_single('main')
-                except KeyError:
-                    # probably a new repo.
-                    self.__commit = None
-                return
-            raise RevisionNotFoundError('revision %s not found' % rev)
-            # otherwise a RevisionNotFoundError should be raised.
+        # the refs are resolved while no push or sync is updating them.
+        with read_lock(self.repo.path):
+            try:
+                self.__commit = resolve(self.repo, rev)
+            except KeyError:
+                if rev == 'HEAD':
+                    try:
+                        # fallback to the main branch
+                        self.__commit = resolve(self.repo, 'main')
+                    except KeyError:
+                        # probably a new repo.
+                        self.__commit = None
+                    return
+                raise RevisionNotFoundError('revision %s not found' % rev)
+                # otherwise a RevisionNotFoundError should be raised.
 
     # Unit tests would be useful here, even if this class will only
     # produce output for the browser classes.
@@ -275,8 +535,9 @@ class GitStorage(BaseStorage):
                         raise PathNotFoundError(
                             'cannot traverse into blob at `%s`' % (
                                 '/'.join(breadcrumbs)))
-                    oid = node[fragment].oid
-                    node = self.repo.get(oid)
+                    entry = node[fragment]
+                    oid = entry.oid
+                    node = self._object(entry)
                 breadcrumbs.append(fragment)
                 if node is None:
                     # strange.  Looks like it's either submodules only
@@ -285,8 +546,8 @@ class GitStorage(BaseStorage):
                     # file.
                     if not cls == Blob:
                         # If we want a file, forget it.
-                        submods = parse_gitmodules(self.repo.get(
-                            root[GIT_MODULE_FILE].oid).data)
+                        submods = parse_gitmodules(self._object(
+                            root[GIT_MODULE_FILE]).data)
                         submod = submods.get('/'.join(breadcrumbs))
                         if submod:
                             fragments.reverse()
@@ -313,12 +574,213 @@ class GitStorage(BaseStorage):
         # if cls == Blob:
         raise PathNotFoundError('path `%s` not found' % path)
 
+    def _object(self, entry):
+        # Blobs omitted by a partial sync are fetched on first access,
+        # while submodules have no object in this repository.
+        node = self.repo.get(entry.oid)
+        if node is None and entry.filemode != GIT_FILEMODE_COMMIT:
+            if fetch_missing(self.repo.path, [entry.oid.hex],
+                    http_pool_manager()):
+                node = self.repo.get(entry.oid)
+        return node
+
+    def _get_objs(self, paths, cls=None):
+        """
+        Return what _get_obj returns for each of the paths as a dict, or
+        the PathInvalidError it would raise, with the tree walked once
+        for all of them such that their common prefixes resolve once.
+        The files are given as their tree entries, to be read as needed.
+        """
+
+        result = {}
+        if self._commit is None:
+            for path in paths:
+                if path == '':
+                    result[path] = self._get_empty_root()
+                else:
+                    result[path] = PathNotFoundError(
+                        'path `%s` not found' % path)
+            return result
+
+        # the trie of the fragments of the paths, with the paths ending
+        # at a node kept under None.
+        trie = {}
+        for path in paths:
+            node = trie
+            for fragment in path.split('/'):
+                if fragment:
+                    node = node.setdefault(fragment, {})
+            node.setdefault(None, []).append(path)
+
+        root = self._commit.tree
+        gitmodules = []
+
+        def trie_paths(trie):
+            for key, child in trie.iteritems():
+                if key is None:
+                    for path in child:
+                        yield path
+                else:
+                    for path in trie_paths(child):
+                        yield path
+
+        def fail(trie, error):
+            for path in trie_paths(trie):
+                result[path] = error(path)
+
+        def submodule(trie, breadcrumbs, oid):
+            location = None
+            if cls != Blob:
+                if not gitmodules:
+                    try:
+                        gitmodules.append(parse_gitmodules(self._object(
+                            root[GIT_MODULE_FILE]).data))
+                    except KeyError:
+                        gitmodules.append({})
+                location = gitmodules[0].get('/'.join(breadcrumbs))
+            if not location:
+                message = 'path `%s` failed to resolve as a dir' % (
+                    '/'.join(breadcrumbs))
+                fail(trie, lambda path: PathNotDirError(message))
+                return
+            for path in trie_paths(trie):
+                fragments = [f for f in path.split('/') if f]
+                result[path] = {
+                    '': '_subrepo',
+                    'location': location,
+                    'path': '/'.join(fragments[len(breadcrumbs):]),
+                    'rev': oid.hex,
+                }
+
+        def walk(trie, node, breadcrumbs):
+            for path in trie.get(None, ()):
+                if path in result:
+                    # a file, already given as its entry.
+                    pass
+                elif cls is None or isinstance(node, cls):
+                    result[path] = node
+                elif cls == Tree:
+                    result[path] = PathNotDirError(
+                        'path `%s` is not dir' % path)
+                else:
+                    result[path] = PathNotFoundError(
+                        'path `%s` not found' % path)
+            for fragment, child in trie.iteritems():
+                if fragment is None:
+                    continue
+                if isinstance(node, Blob):
+                    message = 'cannot traverse into blob at `%s`' % (
+                        '/'.join(breadcrumbs))
+                    fail(child, lambda path: PathNotFoundError(message))
+                    continue
+                try:
+                    entry = node[fragment]
+                except KeyError:
+                    fail(child, lambda path: PathNotFoundError(
+                        'path `%s` not found' % path))
+                    continue
+                if entry.type == 'blob' and cls in (None, Blob):
+                    for path in child.get(None, ()):
+                        result[path] = entry
+                    if len(child) == 1:
+                        continue
+                obj = self._object(entry)
+                if obj is None:
+                    submodule(child, breadcrumbs + [fragment], entry.oid)
+                    continue
+                walk(child, obj, breadcrumbs + [fragment])
+
+        walk(trie, root, [])
+        return result
+
+    def _fetch_missing(self, shas):
+        # the blobs omitted by a partial sync, fetched all at once.
+        if not shas or get_promisor(Repo(self.repo.path)) is None:
+            return
+        missing = sorted(set(sha for sha in shas if sha not in self.repo))
+        if missing:
+            fetch_missing(self.repo.path, missing, http_pool_manager())
+
+    def _get_blob(self, path, entry):
+        blob = self._object(entry)
+        if blob is None:
+            raise PathNotFoundError('path `%s` not found' % path)
+        return blob
+
+    def _large_file(self, blob):
+        # the file a Git LFS pointer points to, in the large file mode.
+        largefiles = large_file_store()
+        if largefiles is None:
+            return None
+        return largefiles.resolve(blob)
+
+    def _read(self, path, blob, end=None):
+        large = self._large_file(blob)
+        if large is None:
+            return blob.read_raw()[:end]
+        try:
+            return large.read(0, end)
+        except KeyError:
+            raise PathNotFoundError('contents of `%s` not found' % path)
+
+    def _mimetype(self, path, blob, large):
+        if large is None:
+            return self.derived.mimetype(blob, magic)
+        return magic.from_buffer(self._read(path, blob, derived.MAGIC_BYTES))
+
     def file(self, path):
-        return self._get_obj(path, Blob).data
+        return self._read(path, self._get_obj(path, Blob))
+
+    def blobstream(self, path):
+        """
+        Return the BlobStream of the file at path, to read its contents
+        in chunks or by byte range rather than in full.  In the large
+        file mode, Git LFS pointers give the LargeFile they point to.
+        """
+
+        path = path.strip('/')
+        try:
+            entry = self._commit.tree[path]
+        except (AttributeError, KeyError):
+            raise PathNotFoundError('path `%s` not found' % path)
+        if entry.type != 'blob':
+            raise PathNotFoundError('path `%s` not found' % path)
+        try:
+            result = BlobStream(self.repo.path, entry.hex, self.derived)
+        except KeyError:
+            # omitted by a partial sync.
+            if self._object(entry) is None:
+                raise PathNotFoundError('path `%s` not found' % path)
+            result = BlobStream(self.repo.path, entry.hex, self.derived)
+        if result.size <= POINTER_MAX:
+            large = self._large_file(self.repo[entry.oid])
+            if large is not None:
+                if not large.store.has(large.sha):
+                    raise PathNotFoundError(
+                        'contents of `%s` not found' % path)
+                return large
+        return result
+
+    def lines(self, path, start=0, end=None):
+        """
+        Return the lines from start up to (not including) end of the
+        file at path, counted from 0 and with their line endings, read
+        through the line index of large files.
+        """
+
+        return LineIndex(self.blobstream(path), self.derived).lines(
+            start, end)
+
+    def linecount(self, path):
+        return LineIndex(self.blobstream(path), self.derived).count
 
     def fileinfo(self, path, blob=None):
         if blob is None:
             blob = self._get_obj(path, Blob)
+        large = self._large_file(blob)
+        size = blob.size
+        if large is not None:
+            size = large.size
         return {
             'author': '%s <%s>' % (
                 self._commit.committer.name,
@@ -329,12 +791,12 @@ class GitStorage(BaseStorage):
             'desc': self._commit.message,
             'node': self._commit.hex,
             'date': rfc2822(self._commit.committer),
-            'size': blob.size,
+            'size': size,
             'basename': path.split('/')[-1],
             'file': path,
             'mimetype': lambda: mimetypes.guess_type(path)[0]
-                or magic.from_buffer(blob.read_raw()[:1000]),
-            'contents': blob.read_raw,
+                or self._mimetype(path, blob, large),
+            'contents': lambda: self._read(path, blob),
             'baseview': 'file',
             'fullpath': None,
             'contenttype': None,
@@ -356,7 +818,10 @@ class GitStorage(BaseStorage):
                 try:
                     obj = repo.get_object(node.sha)
                 except KeyError:
-                    # assume this is a submodule type
+                    if not S_ISGITLINK(node.mode):
+                        # a blob omitted by a partial sync.
+                        results.append(name)
+                    # otherwise assume this is a submodule type
                     continue
 
                 if isinstance(obj, dulwich.objects.Blob):
@@ -375,7 +840,7 @@ class GitStorage(BaseStorage):
 
     def roots(self, rev=None):
         if rev is not None:
-            commit = self.repo.revparse_single(rev)
+            commit = resolve(self.repo, rev)
         else:
             commit = self._commit
         if commit is None:
@@ -417,10 +882,10 @@ class GitStorage(BaseStorage):
             # this involves linking the git submodule definitions with
             # the commit objects found here.
 
-            # return trees first:
+            # the entries are told apart by their types, so only the
+            # sizes of the files (which are kept) need their blobs.
             for entry in tree:
-                node = self.repo.get(entry.oid)
-                if node is not None:
+                if entry.type != 'commit':
                     continue
 
                 fullpath = path and '%s/%s' % (path, entry.name) or entry.name
@@ -438,8 +903,7 @@ class GitStorage(BaseStorage):
 
             # return trees first:
             for entry in tree:
-                node = self.repo.get(entry.oid)
-                if not isinstance(node, Tree):
+                if entry.type != 'tree':
                     continue
 
                 fullpath = path and '%s/%s' % (path, entry.name) or entry.name
@@ -456,33 +920,143 @@ class GitStorage(BaseStorage):
                 })
 
             # then return files
+            sizes = self.derived.tree_sizes(self.repo, tree)
             for entry in tree:
-                node = self.repo.get(entry.oid)
-                if not isinstance(node, Blob):
+                if entry.type != 'blob':
                     continue
+                if entry.name in sizes:
+                    size = str(sizes[entry.name])
+                else:
+                    # omitted by a partial sync, only fetched if read.
+                    size = ''
 
                 fullpath = path and '%s/%s' % (path, entry.name) or entry.name
+                contents = lambda entry=entry, fullpath=fullpath: self._read(
+                    fullpath, self._get_blob(fullpath, entry))
 
                 yield self.format(**{
                     'permissions': '-rw-r--r--',
                     'contenttype': 'file',
                     'node': self.rev,
                     'date': rfc2822(self._commit.committer).date(),
-                    'size': str(node.size),
+                    'size': size,
                     'path': fullpath,
                     'desc': self._commit.message,
-                    'contents': lambda: node.read_raw(),
+                    'contents': contents,
                 })
 
         return _listdir()
 
+    def file_batch(self, paths):
+        """
+        Return the contents of the files at the paths as a dict keyed by
+        path, with the contents of each read when its value is called,
+        and the PathInvalidError of each path that is not a file in place
+        of its value.  The tree is walked once for all the paths.
+        """
+
+        result = self._get_objs(paths, Blob)
+        self._fetch_missing([obj.hex for obj in result.itervalues()
+            if isinstance(obj, TreeEntry)])
+        for path, obj in result.items():
+            if not isinstance(obj, PathInvalidError):
+                result[path] = lambda path=path, entry=obj: self._read(
+                    path, self._get_blob(path, entry))
+        return result
+
+    def pathinfo_batch(self, paths):
+        """
+        Return the pathinfo of each of the paths as a dict keyed by path,
+        with the PathInvalidError of each path that cannot be resolved in
+        place of its pathinfo.  The tree is walked once for all the
+        paths.
+        """
+
+        if self._commit is None and self._lastcheckout != 'HEAD':
+            return dict((path, PathNotFoundError('commit not found'))
+                for path in paths)
+        result = self._get_objs(paths)
+        self._fetch_missing([obj.hex for obj in result.itervalues()
+            if isinstance(obj, TreeEntry)])
+        for path, obj in result.items():
+            if isinstance(obj, PathInvalidError):
+                continue
+            if isinstance(obj, TreeEntry):
+                try:
+                    obj = self._get_blob(path, obj)
+                except PathNotFoundError as e:
+                    result[path] = e
+                    continue
+            result[path] = self._pathinfo(path, obj)
+        return result
+
+    def _resolve_commit(self, rev):
+        try:
+            return resolve(self.repo, rev)
+        except KeyError:
+            raise RevisionNotFoundError('revision %s not found' % rev)
+
+    def _line_stats(self, old, new):
+        self._fetch_missing([sha for sha in (old, new) if sha])
+        return line_stats(self.repo, old, new)
+
+    def diff(self, old=None, new=None, renames=False):
+        """
+        Return the changes from the revision old to the revision new (by
+        default, the one checked out) as an iterator of dicts, with the
+        status (added, removed, modified or renamed), path and oldpath,
+        and the ids of the blobs of each changed file.  Their stats are
+        the (additions, deletions) in lines, computed when called.  With
+        no old revision, the changes are those from the first parent.
+        """
+
+        if new is None:
+            commit = self._commit
+        else:
+            commit = self._resolve_commit(new)
+        if old is not None:
+            old_tree = self._resolve_commit(old).tree
+        elif commit is not None and commit.parents:
+            old_tree = commit.parents[0].tree
+        else:
+            old_tree = None
+        diff = tree_diff(old_tree, commit and commit.tree)
+        if diff is None:
+            return iter([])
+
+        if renames:
+            # the similarity of the files added and removed is computed
+            # from their contents.
+            self._fetch_missing([sha for delta in diff.deltas
+                for sha in (blob_id(delta.old_file), blob_id(delta.new_file))
+                if sha and delta.status != GIT_DELTA_MODIFIED])
+            find_renames(diff)
+
+        def _diff():
+            for delta in diff.deltas:
+                old_id = blob_id(delta.old_file)
+                new_id = blob_id(delta.new_file)
+                yield {
+                    'status': STATUSES.get(delta.status, 'modified'),
+                    'path': delta.new_file.path,
+                    'oldpath': delta.old_file.path,
+                    'old': old_id,
+                    'new': new_id,
+                    'stats': lambda old=old_id, new=new_id: self._line_stats(
+                        old, new),
+                }
+
+        return _diff()
+
     def pathinfo(self, path):
         if self._commit is None: 
             if self._lastcheckout != 'HEAD':
                 raise PathNotFoundError('commit not found')
             # give an exception to HEAD
 
-        obj = self._get_obj(path)
+        return self._pathinfo(path, self._get_obj(path))
+
+    def _pathinfo(self, path, obj):
         if isinstance(obj, Blob):
             return self.fileinfo(path, obj)
         elif isinstance(obj, dict):
@@ -518,9 +1092,13 @@ class GitStorage(BaseStorage):
             'contents': lambda: self.listdir(path)
         })
 
-    def log(self, start, count, branch=None, shortlog=False):
+    def log(self, start, count, branch=None, shortlog=False, path=None):
         """
         start and branch are literally the same thing.
+
+        With path, only the commits that changed what is at the path are
+        listed; the commits that the changed-path filters show did not
+        change it are passed over without reading their trees.
         """
 
         def _log(iterator):
@@ -536,23 +1114,42 @@ class GitStorage(BaseStorage):
                     'desc': commit.message
                 }
 
-        if start is None:
-            # assumption.
-            start = 'HEAD'
-            try:
-                self.repo.revparse_single(start)
-            except KeyError:
-                return _log([])
-
         try:
-            rev = self.repo.revparse_single(start).hex
+            # assumption.
+            rev = resolve(self.repo, start or 'HEAD').hex
         except KeyError:
+            if start is None:
+                return _log([])
             raise RevisionNotFoundError('revision %s not found' % start)
 
-        iterator = enumerate(self.repo.walk(rev, GIT_SORT_TIME))
+        commits = self.repo.walk(rev, GIT_SORT_TIME)
+        if path:
+            commits = self._touching(commits, path.strip('/'))
+        iterator = enumerate(commits)
 
         return _log(iterator)
 
+    def _entry_id(self, tree, path):
+        try:
+            return tree[path].id
+        except KeyError:
+            return None
+
+    def _touching(self, commits, path):
+        # the commits with the entry at path unlike that of every parent.
+        maybe_changed = ChangedPathIndex(self.derived).changed_filter(path)
+        for commit in commits:
+            if not maybe_changed(commit.hex):
+                continue
+            current = self._entry_id(commit.tree, path)
+            parents = [self._entry_id(parent.tree, path)
+                for parent in commit.parents]
+            if not parents:
+                # the root commit added the path, if it has it.
+                parents = [None]
+            if current not in parents:
+                yield commit
+
     def clonecmd(self):
         try:
             info = self.file('.gitmodules')
@@ -26,10 +26,13 @@ setup(name='pmr2.git',
           'setuptools',
           # -*- Extra requirements: -*-
           'pygit2',
-          'dulwich>=0.11.0',
+          'dulwich>=0.19.0',
           'python-magic>=0.4.9',
       ],
       entry_points="""
       # -*- Entry points: -*-
+      [console_scripts]
+      pmr2_git_server = pmr2.git.server:main
+      pmr2_git_pool = pmr2.git.pool:main
       """,
       )